@@ -5,7 +5,7 @@ import struct
 import logging
 import re
 import numpy as np
-from PyQt5.QtGui import QQuaternion, QVector3D
+from applications.pos2vmd_qt import QQuaternion, QVector3D
 from applications.VmdWriter import VmdBoneFrame
 
 logger = logging.getLogger("__main__").getChild(__name__)
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import struct
-from PyQt5.QtGui import QQuaternion, QVector3D
+from applications.pos2vmd_qt import QQuaternion, QVector3D
 
 class VmdBoneFrame():
     def __init__(self, frame=0):
@@ -50,14 +50,21 @@ class VmdWriter():
 
     def write_vmd_file(self, filename, bone_frames, showik_frames):
         """Write VMD data to a file"""
+        self.write_vmd_tracks(filename, bone_frames, showik_frames, len(bone_frames))
+
+    def write_vmd_tracks(self, filename, bone_tracks, showik_frames, bone_frame_count=None):
+        """Write VMD data to a file (bone_tracks: BoneTrack list)"""
+        if bone_frame_count == None:
+            bone_frame_count = sum(len(bt) for bt in bone_tracks)
+
         fout = open(filename, "wb")
         # header
         fout.write(b'Vocaloid Motion Data 0002\x00\x00\x00\x00\x00')
         fout.write(b'Trace Model Name    ')
         # bone frames
-        fout.write(struct.pack('<L', len(bone_frames))) # ボーンフレーム数
-        for bf in bone_frames:
-            bf.write(fout)
+        fout.write(struct.pack('<L', bone_frame_count)) # ボーンフレーム数
+        for bt in bone_tracks:
+            bt.write(fout)
         fout.write(struct.pack('<L', 0)) # 表情キーフレーム数
         fout.write(struct.pack('<L', 0)) # カメラキーフレーム数
         fout.write(struct.pack('<L', 0)) # 照明キーフレーム数
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_batch.py - 複数resultディレクトリの並列読み込み
+#
+# 各ディレクトリの入力ファイルの読み込み・解析をスレッド(もしくはプロセス)プールで並列に行い、
+# 読み込めたものから順に変換キューに積む
+# 変換側はキューから取り出したクリップを順次処理するので、読み込みと変換が重なる
+
+import os
+import queue
+import logging
+import threading
+import concurrent.futures
+import numpy as np
+
+from applications import pos2vmd_utils
+from applications import pos2vmd_bundle
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# キューの終端
+END_OF_QUEUE = None
+
+# 3dpose-gan のposファイル名(resultディレクトリにない場合もある)
+POSITION_GAN_FILE_NAME = "pos_gan.txt"
+
+
+# 1クリップ分の読み込み済み入力
+# position_list_to_vmd_multi には、バンドルの代わりにそのまま渡せる
+class ClipInput():
+    def __init__(self, target, base_dir, positions, smoothed_2d, depths, depth_confs, start_frame, position_file=None, positions_gan=None, position_gan_file=None):
+        self.target = target
+        self.base_dir = base_dir
+        self.positions = positions
+        # 関節位置の読み込み元の pos.txt(バンドルから読み込んだ場合はNone)
+        self.position_file = position_file
+        # 3dpose-gan の関節位置とその読み込み元(使わない場合・ない場合はNone)
+        self.positions_gan = positions_gan
+        self.position_gan_file = position_gan_file
+        self.smoothed_2d = smoothed_2d
+        self.depths = depths
+        self.depth_confs = depth_confs
+        self.start_frame = start_frame
+
+    @property
+    def bundle_file(self):
+        return self.target
+
+    @property
+    def has_depth(self):
+        return self.depths is not None and self.depth_confs is not None
+
+    # 関節位置をフレーム・関節で引けるリストとして返す
+    def read_positions_multi(self):
+        return pos2vmd_utils.PositionList(self.positions, self.position_file)
+
+    # 3dpose-gan の関節位置をフレーム・関節で引けるリストとして返す(ない場合はNone)
+    def read_positions_gan_multi(self):
+        if self.positions_gan is None:
+            return None
+
+        return pos2vmd_utils.PositionList(self.positions_gan, self.position_gan_file)
+
+
+# 読み込みに失敗したクリップ
+class ClipError():
+    def __init__(self, target, error):
+        self.target = target
+        self.error = error
+
+
+# resultディレクトリ(もしくはバンドル)の入力を読み込む
+# is_gan: 3dpose-gan のposファイルがあれば読み込む(バンドルの場合は、バンドルを作った元のディレクトリから読む)
+def load_result_dir(target, is_cache=False, is_gan=False):
+    if pos2vmd_bundle.is_bundle_file(target):
+        with pos2vmd_bundle.load_bundle(target) as bundle:
+            positions_gan, position_gan_file = load_positions_gan(bundle.base_dir, is_cache, is_gan)
+            return ClipInput(target, bundle.base_dir, np.array(bundle.positions), bundle.smoothed_2d, bundle.depths, bundle.depth_confs, bundle.start_frame, \
+                             None, positions_gan, position_gan_file)
+
+    files = {}
+    for key, file_name in pos2vmd_bundle.RESULT_FILE_NAMES.items():
+        files[key] = os.path.join(target, file_name)
+
+    positions = np.array(pos2vmd_utils.read_positions_multi(files["pos"], is_cache).positions)
+    smoothed_2d = pos2vmd_utils.load_smoothed_2d(files["smoothed"], is_cache)
+    start_frame = pos2vmd_utils.load_start_frame(files["start_frame"])
+    depths, depth_confs = pos2vmd_utils.load_depth(files["depth"], files["conf"], is_cache)
+
+    if depths is not None:
+        # プロセス間で受け渡せるよう、memmapではなく通常の配列にしておく
+        depths, depth_confs = np.array(depths), np.array(depth_confs)
+
+    positions_gan, position_gan_file = load_positions_gan(target, is_cache, is_gan)
+
+    return ClipInput(target, target, positions, smoothed_2d, depths, depth_confs, start_frame, files["pos"], positions_gan, position_gan_file)
+
+
+# 3dpose-gan の関節位置と、その読み込み元を読み込む(使わない場合・ファイルがない場合は (None, None))
+def load_positions_gan(base_dir, is_cache=False, is_gan=False):
+    if is_gan == False or base_dir is None:
+        return None, None
+
+    position_gan_file = os.path.join(base_dir, POSITION_GAN_FILE_NAME)
+    if os.path.exists(position_gan_file) == False:
+        return None, None
+
+    return np.array(pos2vmd_utils.read_positions_multi(position_gan_file, is_cache).positions), position_gan_file
+
+
+def load_result_dir_safe(target, is_cache=False, is_gan=False):
+    try:
+        return load_result_dir(target, is_cache, is_gan)
+    except Exception as e:
+        return ClipError(target, e)
+
+
+# 複数のresultディレクトリを並列に読み込み、読み込めたものから変換キューに積む
+# workers: 並列数(0以下はCPU数), is_process: Trueの場合はプロセスプールで読み込む
+# queue_size: 変換待ちとして保持する最大クリップ数(読み込み中のものを含む)
+# is_gan: 3dpose-gan のposファイルがあれば一緒に読み込む
+def start_ingest(targets, workers=0, is_cache=False, is_process=False, queue_size=4, is_gan=False):
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    workers = max(1, min(workers, len(targets)))
+    queue_size = max(queue_size, workers)
+
+    clip_queue = queue.Queue()
+    # メモリを使いすぎないよう、読み込み中・変換待ちの合計を制限する
+    slots = threading.BoundedSemaphore(queue_size)
+
+    # プールが壊れた(ワーカーが落ちた)場合、以降は読み込みを投入しない
+    broken = threading.Event()
+
+    # 読み込みが終わったら(失敗した場合も)、変換キューに積む
+    def on_done(future, target):
+        try:
+            clip = future.result()
+        except Exception as e:
+            if isinstance(e, concurrent.futures.BrokenExecutor):
+                broken.set()
+            clip = ClipError(target, e)
+
+        clip_queue.put(clip)
+
+    def feed():
+        try:
+            if is_process:
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            else:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+            with executor:
+                futures = []
+                for target in targets:
+                    slots.acquire()
+
+                    if broken.is_set():
+                        clip_queue.put(ClipError(target, concurrent.futures.BrokenExecutor("読み込みプールが停止しています")))
+                        continue
+
+                    try:
+                        future = executor.submit(load_result_dir_safe, target, is_cache, is_gan)
+                    except Exception as e:
+                        # 投入できない場合(プールが壊れている場合など)、そのクリップは失敗とする
+                        if isinstance(e, concurrent.futures.BrokenExecutor):
+                            broken.set()
+                        clip_queue.put(ClipError(target, e))
+                        continue
+
+                    future.add_done_callback(lambda f, target=target: on_done(f, target))
+                    futures.append(future)
+
+                concurrent.futures.wait(futures)
+        finally:
+            # 途中で失敗しても、変換側が待ち続けないよう必ず終端を積む
+            clip_queue.put(END_OF_QUEUE)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    return IngestQueue(clip_queue, slots, feeder)
+
+
+# 変換キュー
+# 取り出したクリップ(ClipInput もしくは ClipError)の分だけ、次の読み込みを進める
+class IngestQueue():
+    def __init__(self, clip_queue, slots, feeder):
+        self.clip_queue = clip_queue
+        self.slots = slots
+        self.feeder = feeder
+
+    def __iter__(self):
+        while True:
+            clip = self.clip_queue.get()
+            if clip is END_OF_QUEUE:
+                break
+
+            self.slots.release()
+            yield clip
+
+        self.feeder.join()
+
+
+# 複数のresultディレクトリを並列に読み込む
+def iter_ingest(targets, workers=0, is_cache=False, is_process=False, queue_size=4, is_gan=False):
+    return iter(start_ingest(targets, workers, is_cache, is_process, queue_size, is_gan))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_bone.py - トレースモデルのボーンCSV
+#
+# PmxEditorで出力したボーンCSVを一度だけ解析して、ボーン名(日本語・英語)で引けるようにする
+
+from applications.pos2vmd_qt import QVector3D
+import csv
+import io
+import logging
+import numpy as np
+
+from applications import pos2vmd_cache
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# 処理で使うボーンの日本語名と英語名(英語名は小文字で比較する)
+BONE_ENGLISH_NAMES = {
+    "センター": "center",
+    "グルーブ": "groove",
+    "上半身": "upper body",
+    "上半身2": "upper body2",
+    "下半身": "lower body",
+    "首": "neck",
+    "左足": "leg_l",
+    "左ひざ": "knee_l",
+    "左足首": "ankle_l",
+    "左つま先": "l toe",
+    "右足": "leg_r",
+    "右ひざ": "knee_r",
+    "右足首": "ankle_r",
+    "右つま先": "r toe",
+    "左足ＩＫ": "leg ik_l",
+    "右足ＩＫ": "leg ik_r"
+}
+
+# ボーンCSVのエンコード候補
+BONE_CSV_ENCODINGS = ('utf_8', 'shift-jis')
+
+
+class BoneModel():
+    def __init__(self, bone_csv_file, names, english_names, positions):
+        self.bone_csv_file = bone_csv_file
+        # ボーン名(CSVの行順)
+        self.names = names
+        # ボーン英語名(CSVの行順)
+        self.english_names = english_names
+        # ボーン位置 (ボーン数, 3)
+        self.positions = positions
+
+        # 同じ名前が複数あった場合、後の行を優先する(従来のCSV走査と同じ)
+        self.name_index = {}
+        for n, name in enumerate(names):
+            self.name_index[name] = n
+
+        self.english_index = {}
+        for n, english_name in enumerate(english_names):
+            self.english_index[english_name.lower()] = n
+
+        # 足の各部の長さ(ひざ-足首, 足-ひざ)
+        self.left_leg_lengths = self.calc_leg_lengths("左")
+        self.right_leg_lengths = self.calc_leg_lengths("右")
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, bone_name):
+        return self.get_index(bone_name) >= 0
+
+    # ボーンのINDEX(日本語名もしくは英語名のいずれかに一致する最後の行)
+    # 見つからない場合、-1
+    def get_index(self, bone_name, english_name=None):
+        if english_name is None:
+            english_name = BONE_ENGLISH_NAMES.get(bone_name, bone_name)
+
+        return max(self.name_index.get(bone_name, -1), self.english_index.get(english_name.lower(), -1))
+
+    # ボーン位置(ボーンがない場合、原点)
+    def get_position(self, bone_name, english_name=None):
+        idx = self.get_index(bone_name, english_name)
+        if idx < 0:
+            return QVector3D()
+
+        return QVector3D(*self.positions[idx])
+
+    # ボーン位置の配列(ボーンがない場合、原点)
+    def get_position_array(self, bone_name, english_name=None):
+        idx = self.get_index(bone_name, english_name)
+        if idx < 0:
+            return np.zeros(3)
+
+        return self.positions[idx]
+
+    # 片足の各部の長さ(ひざ-足首, 足-ひざ)
+    # QVector3Dで計算した場合と同じ値になるよう、差分はfloat32、長さはdoubleで求めてfloat32に丸める
+    def calc_leg_lengths(self, direction):
+        joints = np.array([self.get_position_array(direction + bone_name) for bone_name in ["足首", "ひざ", "足"]], dtype=np.float32)
+        diffs = joints[:-1] - joints[1:]
+        return [float(v) for v in np.sqrt(np.sum(diffs.astype(np.float64) ** 2, axis=1)).astype(np.float32)]
+
+    @property
+    def left_leg_length(self):
+        return self.left_leg_lengths[0] + self.left_leg_lengths[1]
+
+    @property
+    def right_leg_length(self):
+        return self.right_leg_lengths[0] + self.right_leg_lengths[1]
+
+    # 両足の長さ（RHip-RKnee-RAnkle, LHip-LKnee-LAnkle）
+    @property
+    def leg_length(self):
+        return self.right_leg_lengths[0] + self.right_leg_lengths[1] + self.left_leg_lengths[0] + self.left_leg_lengths[1]
+
+    @property
+    def has_groove(self):
+        return "グルーブ" in self
+
+    @property
+    def has_upper2(self):
+        return "上半身2" in self
+
+
+# ボーンCSVの文字列を解析する
+def parse_bone_model(bone_csv_file, text):
+    names = []
+    english_names = []
+    positions = []
+
+    for row in csv.reader(io.StringIO(text)):
+        # ボーン行のみ(IKLinkなどの行はボーン名の列にIKボーン名が入っているため対象外)
+        if len(row) < 8 or row[0] != "Bone":
+            continue
+
+        names.append(row[1])
+        english_names.append(row[2])
+        positions.append((float(row[5]), float(row[6]), float(row[7])))
+
+    return BoneModel(bone_csv_file, names, english_names, np.array(positions, dtype=np.float64).reshape(-1, 3))
+
+
+# ボーンCSVを読み込む
+def read_bone_model(bone_csv_file):
+    with open(bone_csv_file, "rb") as bf:
+        fbytes = bf.read()
+
+    for encoding in BONE_CSV_ENCODINGS:
+        try:
+            text = fbytes.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+
+        logger.debug("%s: encoding: %s", bone_csv_file, encoding)
+        return parse_bone_model(bone_csv_file, text)
+
+    raise Exception("unknown encoding!")
+
+
+# ボーンモデルを取得する(解析結果はパスと更新日時で覚えておく)
+def load_bone_model(bone_csv_file):
+    return pos2vmd_cache.load_by_mtime(bone_csv_file, read_bone_model)
+
+
+# 覚えているボーンモデルを破棄する
+def clear_bone_model_cache():
+    pos2vmd_cache.clear_mtime_cache(read_bone_model)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_bundle.py - 1クリップ分の入力をまとめた .npz バンドル
+#
+# pos.txt, smoothed.txt, depth.txt, conf.txt, start_frame.txt を数値配列のまま1ファイルに圧縮して保存する
+# 読み込み時は必要な配列だけを初めて参照したときに展開する
+
+import os
+import json
+import datetime
+import logging
+import numpy as np
+
+from applications import pos2vmd_utils
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# バンドル形式のバージョン(格納する配列の形式を変えたら上げる)
+BUNDLE_VERSION = 1
+
+# resultディレクトリに作るバンドルのファイル名
+BUNDLE_FILE_NAME = "session.npz"
+
+# resultディレクトリの入力ファイル名
+RESULT_FILE_NAMES = {
+    "pos": "pos.txt",
+    "smoothed": "smoothed.txt",
+    "depth": "depth.txt",
+    "conf": "conf.txt",
+    "start_frame": "start_frame.txt"
+}
+
+
+# バンドルかどうか
+def is_bundle_file(path):
+    return os.path.isfile(path) and path.lower().endswith(".npz")
+
+
+# resultディレクトリのバンドルのパス
+def get_bundle_path(base_dir):
+    return os.path.join(base_dir, BUNDLE_FILE_NAME)
+
+
+# 1クリップ分の入力をバンドルとして保存する
+def save_bundle(bundle_file, positions, smoothed_2d, start_frame, depths=None, depth_confs=None, meta=None):
+    arrays = {
+        "pos": np.asarray(positions, dtype=np.float64),
+        "smoothed": np.asarray(smoothed_2d, dtype=np.float64),
+        "start_frame": np.array(start_frame, dtype=np.int64)
+    }
+
+    if depths is not None and depth_confs is not None:
+        arrays["depth"] = np.asarray(depths, dtype=np.float64)
+        arrays["conf"] = np.asarray(depth_confs, dtype=np.float64)
+
+    bundle_meta = {
+        "version": BUNDLE_VERSION,
+        "created": "{0:%Y%m%d_%H%M%S}".format(datetime.datetime.now()),
+        "frames": int(arrays["pos"].shape[0])
+    }
+    if meta is not None:
+        bundle_meta.update(meta)
+
+    arrays["meta"] = np.array(json.dumps(bundle_meta, ensure_ascii=False))
+
+    # 書きかけのファイルを読まないよう、一旦別名で保存してから置き換える
+    # (savez は拡張子 .npz を補うので、一時ファイルも .npz で終わらせる)
+    tmp_file = bundle_file + ".tmp.npz"
+    np.savez_compressed(tmp_file, **arrays)
+    os.replace(tmp_file, bundle_file)
+
+    return bundle_file
+
+
+# resultディレクトリのテキストファイル群をバンドルに変換する
+def convert_result_dir(base_dir, bundle_file=None, is_cache=False):
+    if bundle_file is None:
+        bundle_file = get_bundle_path(base_dir)
+
+    files = {}
+    for key, file_name in RESULT_FILE_NAMES.items():
+        files[key] = os.path.join(base_dir, file_name)
+
+    positions = pos2vmd_utils.read_positions_multi(files["pos"], is_cache).positions
+    smoothed_2d = pos2vmd_utils.load_smoothed_2d(files["smoothed"], is_cache)
+    start_frame = pos2vmd_utils.load_start_frame(files["start_frame"])
+    depths, depth_confs = pos2vmd_utils.load_depth(files["depth"], files["conf"], is_cache)
+
+    meta = {"source": os.path.abspath(base_dir)}
+
+    logger.info("バンドル作成: %s", bundle_file)
+
+    return save_bundle(bundle_file, positions, smoothed_2d, start_frame, depths, depth_confs, meta)
+
+
+# バンドルの読み込み
+# 各配列は初めて参照したときに展開する
+class SessionBundle():
+    def __init__(self, bundle_file):
+        self.bundle_file = bundle_file
+        self.npz = np.load(bundle_file, allow_pickle=False)
+        self.arrays = {}
+
+        self.meta = json.loads(str(self.npz["meta"]))
+        if self.meta.get("version") != BUNDLE_VERSION:
+            self.close()
+            raise ValueError("バンドルの形式が違います: {0} version={1}".format(bundle_file, self.meta.get("version")))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.npz.close()
+
+    def get(self, key):
+        if key not in self.arrays:
+            if key not in self.npz.files:
+                return None
+            self.arrays[key] = self.npz[key]
+
+        return self.arrays[key]
+
+    @property
+    def base_dir(self):
+        return os.path.dirname(os.path.abspath(self.bundle_file))
+
+    # 関節位置 (フレーム数, 17, 3)
+    @property
+    def positions(self):
+        return self.get("pos")
+
+    # 関節二次元情報 (フレーム数, 18, 3)
+    @property
+    def smoothed_2d(self):
+        return self.get("smoothed")
+
+    # 深度 (フレーム数, 列数)、ない場合はNone
+    @property
+    def depths(self):
+        return self.get("depth")
+
+    # 深度信頼度 (フレーム数, 列数)、ない場合はNone
+    @property
+    def depth_confs(self):
+        return self.get("conf")
+
+    @property
+    def has_depth(self):
+        return "depth" in self.npz.files and "conf" in self.npz.files
+
+    @property
+    def start_frame(self):
+        return int(self.get("start_frame"))
+
+    # 関節位置をフレーム・関節で引けるリストとして返す
+    def read_positions_multi(self):
+        return pos2vmd_utils.PositionList(np.array(self.positions))
+
+
+# バンドルを開く
+def load_bundle(bundle_file):
+    return SessionBundle(bundle_file)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_cache.py - 解析済み入力データの .npy キャッシュ
+#
+# pos.txt などのテキストを一度解析したら、同じディレクトリに .npy を保存しておき、
+# 次回以降は元ファイルのサイズ・更新日時・ハッシュを確認したうえで memmap で読み込む
+# 元ファイル以外のファイル(ボーンCSVなど)にも依存する解析結果は、それらのパスと更新日時も記録して確認する
+#
+# ボーンCSV・傾きモーション・可動域・フィルター設定のような小さな設定ファイルは、
+# ファイルには保存せず、解析結果をプロセス内でパスと更新日時で覚えておく(load_by_mtime)
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import collections
+import numpy as np
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# キャッシュ形式のバージョン(解析結果の形式を変えたら上げる)
+CACHE_VERSION = 1
+
+# プロセス内で覚えておく解析結果の数
+MTIME_CACHE_SIZE = 32
+
+
+# キャッシュファイルのパス
+def get_cache_path(src_file, kind):
+    return "{0}.{1}.npy".format(src_file, kind)
+
+
+# キャッシュのメタ情報ファイルのパス
+def get_meta_path(src_file, kind):
+    return "{0}.{1}.json".format(src_file, kind)
+
+
+# ファイルのハッシュ値
+def calc_file_hash(src_file):
+    h = hashlib.sha1()
+    with open(src_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# 依存ファイルの状態 {絶対パス: 更新日時}
+def make_depends(depend_files):
+    return {os.path.abspath(f): os.stat(f).st_mtime_ns for f in depend_files}
+
+
+# 元ファイルの状態
+def make_meta(src_file, kind, digest=None, depend_files=()):
+    st = os.stat(src_file)
+    return {
+        "version": CACHE_VERSION,
+        "kind": kind,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha1": digest if digest is not None else calc_file_hash(src_file),
+        "depends": make_depends(depend_files)
+    }
+
+
+# キャッシュが元ファイル(と依存ファイル)に対して有効か
+def is_valid_cache(src_file, kind, depend_files=()):
+    cache_file = get_cache_path(src_file, kind)
+    meta_file = get_meta_path(src_file, kind)
+
+    if os.path.exists(cache_file) == False or os.path.exists(meta_file) == False:
+        return False
+
+    try:
+        with open(meta_file, "r") as mf:
+            meta = json.load(mf)
+    except (OSError, ValueError):
+        return False
+
+    st = os.stat(src_file)
+
+    if meta.get("version") != CACHE_VERSION or meta.get("kind") != kind or meta.get("size") != st.st_size:
+        return False
+
+    if meta.get("depends", {}) != make_depends(depend_files):
+        return False
+
+    if meta.get("mtime_ns") == st.st_mtime_ns:
+        # サイズも更新日時も同じなら、そのまま使う
+        return True
+
+    # 更新日時だけ違う場合(コピーやtouch)、中身のハッシュで判定する
+    digest = calc_file_hash(src_file)
+    if meta.get("sha1") != digest:
+        return False
+
+    # 中身が同じなので、次回のために更新日時を記録し直す
+    write_meta(src_file, kind, make_meta(src_file, kind, digest, depend_files))
+
+    return True
+
+
+def write_meta(src_file, kind, meta):
+    meta_file = get_meta_path(src_file, kind)
+    tmp_file = meta_file + ".tmp"
+    with open(tmp_file, "w") as mf:
+        json.dump(meta, mf)
+    os.replace(tmp_file, meta_file)
+
+
+# キャッシュを保存する
+def save_cache(src_file, kind, values, depend_files=()):
+    cache_file = get_cache_path(src_file, kind)
+    # 書きかけのファイルを読まないよう、一旦別名で保存してから置き換える
+    tmp_file = cache_file + ".tmp.npy"
+    np.save(tmp_file, np.ascontiguousarray(values))
+    os.replace(tmp_file, cache_file)
+    write_meta(src_file, kind, make_meta(src_file, kind, depend_files=depend_files))
+
+
+# キャッシュがあればそれを、なければloaderで解析してキャッシュを作る
+# depend_files: 元ファイル以外に解析結果が依存するファイル(どれかの更新日時が変わったら作り直す)
+# 戻り値は書き込み可能な配列(memmapはコピーオンライトなので、キャッシュファイルは変わらない)
+def load_cached(src_file, kind, loader, depend_files=()):
+    cache_file = get_cache_path(src_file, kind)
+
+    if is_valid_cache(src_file, kind, depend_files):
+        logger.debug("キャッシュ読み込み: %s", cache_file)
+        return np.load(cache_file, mmap_mode="c")
+
+    values = loader(src_file)
+
+    try:
+        save_cache(src_file, kind, values, depend_files)
+        logger.debug("キャッシュ保存: %s", cache_file)
+    except OSError as e:
+        # 書き込めないディレクトリでも処理は続ける
+        logger.warning("キャッシュを保存できませんでした: %s %s", cache_file, e)
+
+    return values
+
+
+# キャッシュを削除する
+def remove_cache(src_file, kind):
+    for path in [get_cache_path(src_file, kind), get_meta_path(src_file, kind)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+_mtime_cache = collections.OrderedDict()
+_mtime_lock = threading.Lock()
+
+# ファイルを loader(path) で解析した結果を返す
+# (loader, パス) ごとに覚えておき、更新日時が変わっていなければ解析し直さない
+# 覚えておくのは最近使った MTIME_CACHE_SIZE 件まで
+def load_by_mtime(path, loader):
+    key = (loader, os.path.abspath(path))
+    mtime_ns = os.stat(path).st_mtime_ns
+
+    with _mtime_lock:
+        cached = _mtime_cache.get(key)
+        if cached is not None and cached[0] == mtime_ns:
+            _mtime_cache.move_to_end(key)
+            return cached[1]
+
+    value = loader(path)
+
+    with _mtime_lock:
+        _mtime_cache[key] = (mtime_ns, value)
+        _mtime_cache.move_to_end(key)
+        while len(_mtime_cache) > MTIME_CACHE_SIZE:
+            _mtime_cache.popitem(last=False)
+
+    return value
+
+
+# load_by_mtime で覚えている解析結果を破棄する
+# loader を指定した場合は、その loader の結果だけを破棄する
+def clear_mtime_cache(loader=None):
+    with _mtime_lock:
+        if loader is None:
+            _mtime_cache.clear()
+            return
+
+        for key in [key for key in _mtime_cache.keys() if key[0] is loader]:
+            del _mtime_cache[key]
@@ -1,18 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 #
-from PyQt5.QtGui import QQuaternion, QVector4D, QVector3D, QMatrix4x4
+from applications.pos2vmd_qt import QQuaternion, QVector4D, QVector3D, QMatrix4x4
 import logging
-import csv
 import numpy as np
 import math
-import copy
-import json
 
-from applications import pos2vmd_utils, pos2vmd_filter, pos2vmd_reduce
+from applications import pos2vmd_utils, pos2vmd_filter_preset, pos2vmd_bone, pos2vmd_skeleton, pos2vmd_math, pos2vmd_ik, pos2vmd_contact, pos2vmd_calibration
 
 logger = logging.getLogger("__main__").getChild(__name__)
 
+# 関節名から関節位置のINDEXへの対応
+J = pos2vmd_skeleton.H36M.joints
+
 # 全身で最も直立している姿勢をいくつか返す
 def calc_upright_body(bone_frame_dic):
     return calc_upright_bones(bone_frame_dic, ["上半身", "上半身2", "下半身", "左足", "左ひざ", "右足", "右ひざ"])
@@ -23,18 +23,16 @@ def calc_upright_bones(bone_frame_dic, target_bones):
     # ソート用に新しく辞書を生成する
     upright_bones_dic = {}
 
-    keys =[]
-    values =[]
-    for n in range(len(bone_frame_dic[target_bones[0]])):
-        keys.append(bone_frame_dic[target_bones[0]][n].frame)
-        angles = []
-        for bone_name in target_bones:
-            if len(bone_frame_dic[bone_name]) > n:
-                eular = bone_frame_dic[bone_name][n].rotation.toEulerAngles()
-                angles.append(abs(eular.x()))
-                angles.append(abs(eular.y()))
-                angles.append(abs(eular.z()))
-        values.append( np.nanmax(angles) )
+    # 各ボーンのオイラー角の絶対値 (キーフレーム数, ボーン数 * 3)
+    # キーフレームが足りないボーンはNaNにして無視する
+    frame_num = len(bone_frame_dic[target_bones[0]])
+    angles = np.full((frame_num, len(target_bones) * 3), np.nan)
+    for m, bone_name in enumerate(target_bones):
+        bone_num = min(frame_num, len(bone_frame_dic[bone_name]))
+        angles[:bone_num, m * 3:(m + 1) * 3] = np.abs(bone_frame_dic[bone_name].eulers[:bone_num])
+
+    keys = bone_frame_dic[target_bones[0]].frames.tolist()
+    values = np.nanmax(angles, axis=1).tolist()
 
     # logger.info(keys)
     # logger.info(values)
@@ -109,21 +107,21 @@ def is_almost_same_idx(idxs, n, app):
 
 def calc_upright_bone(bone_frame_dic, bone_name):
 
-    # ソート用に新しく配列を生成する
-    upright_bones = []
-    for bone in bone_frame_dic[bone_name]:
-        upright_bones.append(copy.deepcopy(bone))
+    track = bone_frame_dic[bone_name]
 
     logger.debug("ソート前: %s", bone_name)
-    for n, b in enumerate(upright_bones[:10]):
+    for b in track[:10]:
         logger.debug("{0}: {1}, {2}, {3}".format(b.frame, b.rotation.x(), b.rotation.y(), b.rotation.z()))
 
     # オイラー角の絶対値合計値昇順でソートする。NaNは無視する
-    upright_bones.sort(key=lambda x: np.nanmax(np.array([abs(x.rotation.toEulerAngles().x()), abs(x.rotation.toEulerAngles().y()), abs(x.rotation.toEulerAngles().z())]))) 
+    eulers = track.eulers
+    values = np.nanmax(np.abs(eulers), axis=1).tolist()
+    upright_idxs = sorted(range(len(track)), key=lambda n: values[n])
+    upright_bones = track.take(upright_idxs)
 
     logger.info("ソート後: %s", bone_name)
-    for n, b in enumerate(upright_bones[:10]):
-        logger.info("{0}: {1}, {2}, {3}".format(b.frame, b.rotation.toEulerAngles().x(), b.rotation.toEulerAngles().y(), b.rotation.toEulerAngles().z()))
+    for n in upright_idxs[:10]:
+        logger.info("{0}: {1}, {2}, {3}".format(track.frames[n], eulers[n, 0], eulers[n, 1], eulers[n, 2]))
 
     # # 1/300までのインデックスのみターゲットにする
     # upright_idxs = []
@@ -134,67 +132,29 @@ def calc_upright_bone(bone_frame_dic, bone_name):
 
 
 # IKの計算
-def calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, upright_idxs, heelpos):
+# contacts: 足の接地区間(接地区間の間は基準フレームのIKをコピーする)
+def calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, upright_idxs, heelpos, contacts):
     logger.debug("bone_csv_file: "+ bone_csv_file)
 
     upright_idx = upright_idxs[0]
 
-    # ボーンファイルを開く
-    with open(bone_csv_file, "r", encoding=pos2vmd_utils.get_file_encoding(bone_csv_file)) as bf:
-        reader = csv.reader(bf)
-
-        for row in reader:
-
-            if row[1] == "下半身" or row[2].lower() == "lower body":
-                # 下半身ボーン
-                lower_body_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "左足" or row[2].lower() == "leg_l":
-                # 左足ボーン
-                left_leg_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "左ひざ" or row[2].lower() == "knee_l":
-                # 左ひざボーン
-                left_knee_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "左足首" or row[2].lower() == "ankle_l":
-                # 左足首ボーン
-                left_ankle_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "左つま先" or row[2].lower() == "l toe":
-                # 左つま先ボーン
-                left_toes_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
+    # ボーンモデル(解析済みのものがあれば、それを使う)
+    bone_model = pos2vmd_bone.load_bone_model(bone_csv_file)
 
-            if row[1] == "右足" or row[2].lower() == "leg_r":
-                # 右足ボーン
-                right_leg_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "右ひざ" or row[2].lower() == "knee_r":
-                # 右ひざボーン
-                right_knee_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "右足首" or row[2].lower() == "ankle_r":
-                # 右足首ボーン
-                right_ankle_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "右つま先" or row[2].lower() == "r toe":
-                # 右つま先ボーン
-                right_toes_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[0] == "Bone" and (row[1] == "左足ＩＫ" or row[2].lower() == "leg ik_l"):
-                # 左足ＩＫボーン
-                left_leg_ik_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[0] == "Bone" and (row[1] == "右足ＩＫ" or row[2].lower() == "leg ik_r"):
-                # 右足ＩＫボーン
-                right_leg_ik_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "センター" or row[2].lower() == "center":
-                # センターボーン
-                center_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
+    right_leg_bone = bone_model.get_position("右足")
+    right_ankle_bone = bone_model.get_position("右足首")
+    center_bone = bone_model.get_position("センター")
 
     # 2Dの直立フレームの腰の位置
-    center_upright_2d_y = (smoothed_2d[upright_idx][pos2vmd_utils.SMOOTHED_2D_INDEX["RHip"]].y() + smoothed_2d[upright_idx][pos2vmd_utils.SMOOTHED_2D_INDEX["LHip"]].y()) / 2
+    center_upright_2d_y = (pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, upright_idx, "RHip").y() + pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, upright_idx, "LHip").y()) / 2
+
+    # 全フレーム・両足分の足IKの位置と回転を2ボーンIKでまとめて求めておく
+    # (各フレームの計算に使うセンター・下半身・足・ひざは、そのフレームの処理までは書き換えられない)
+    iks = pos2vmd_ik.LegIKSolver(bone_model).solve(bone_frame_dic["センター"].positions.copy(), bone_frame_dic["下半身"].rotations, \
+                                                   [bone_frame_dic["左足"].rotations, bone_frame_dic["右足"].rotations], \
+                                                   [bone_frame_dic["左ひざ"].rotations, bone_frame_dic["右ひざ"].rotations])
+    left_iks = [v[pos2vmd_ik.LEG_DIRECTIONS.index("左")] for v in iks]
+    right_iks = [v[pos2vmd_ik.LEG_DIRECTIONS.index("右")] for v in iks]
 
     # 前回フレーム
     prev_left_frame = 0
@@ -208,8 +168,8 @@ def calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, uprigh
         # logger.debug("前回左y={0}, 今回左y={1}, 差分={2}".format(smoothed_2d[prev_left_frame][4].y(), smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["LAnkle"]].y(), abs(np.diff([smoothed_2d[prev_left_frame][4].y(), smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["LAnkle"]].y()]))))
 
         #左足IK
-        if n > 0 and abs(np.diff([smoothed_2d[prev_left_frame][pos2vmd_utils.SMOOTHED_2D_INDEX["LAnkle"]].x(), smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["LAnkle"]].x()])) < 5 and abs(np.diff([smoothed_2d[prev_left_frame][pos2vmd_utils.SMOOTHED_2D_INDEX["LAnkle"]].y(), smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["LAnkle"]].y()])) < 5:
-            # ほぼ動いていない場合、前回分をコピー
+        if n > 0 and contacts.left.anchors[n] != n:
+            # 接地区間の間(基準フレームからほぼ動いていない場合)、前回分をコピー
             # logger.debug("前回左IKコピー")
 
             # 前回からほぼ動いていない場合、前回の値をコピーする
@@ -219,10 +179,7 @@ def calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, uprigh
         else:
             # 前回から動いている場合、計算する
             # 左足IK
-            (left_ankle_pos, left_ik_rotation, left_leg_diff_rotation) = \
-                calc_IK_matrix(center_bone, lower_body_bone, left_leg_bone, left_knee_bone, left_ankle_bone, left_toes_bone, left_leg_ik_bone \
-                    , bone_frame_dic["センター"][n].position \
-                    , bone_frame_dic["下半身"][n].rotation, bone_frame_dic["左足"][n].rotation, bone_frame_dic["左ひざ"][n].rotation )
+            (left_ankle_pos, left_ik_rotation, left_leg_diff_rotation) = get_IK_frame(left_iks, n)
 
             # 前回登録フレームとして保持
             prev_left_frame = n
@@ -231,8 +188,8 @@ def calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, uprigh
         # logger.debug("前回右y={0}, 今回右y={1}, 差分={2}".format(smoothed_2d[prev_left_frame][3].y(), smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["RAnkle"]].y(), abs(np.diff([smoothed_2d[prev_left_frame][3].y(), smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["RAnkle"]].y()]))))
             
         # 右足IK
-        if n > 0 and abs(np.diff([smoothed_2d[prev_right_frame][pos2vmd_utils.SMOOTHED_2D_INDEX["RAnkle"]].x(), smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["RAnkle"]].x()])) < 5 and abs(np.diff([smoothed_2d[prev_right_frame][pos2vmd_utils.SMOOTHED_2D_INDEX["RAnkle"]].y(), smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["RAnkle"]].y()])) < 5:
-            # ほぼ動いていない場合、前回分をコピー
+        if n > 0 and contacts.right.anchors[n] != n:
+            # 接地区間の間(基準フレームからほぼ動いていない場合)、前回分をコピー
             # logger.debug("前回右IKコピー")
 
             right_ankle_pos = bone_frame_dic["右足ＩＫ"][prev_right_frame].position
@@ -240,10 +197,7 @@ def calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, uprigh
             right_leg_diff_rotation = bone_frame_dic["右足"][prev_right_frame].rotation
         else:          
             # 右足IK
-            (right_ankle_pos, right_ik_rotation, right_leg_diff_rotation) = \
-                calc_IK_matrix(center_bone, lower_body_bone, right_leg_bone, right_knee_bone, right_ankle_bone, right_toes_bone, right_leg_ik_bone \
-                    , bone_frame_dic["センター"][n].position \
-                    , bone_frame_dic["下半身"][n].rotation, bone_frame_dic["右足"][n].rotation, bone_frame_dic["右ひざ"][n].rotation )
+            (right_ankle_pos, right_ik_rotation, right_leg_diff_rotation) = get_IK_frame(right_iks, n)
             
             # 前回登録フレームとして保持
             prev_right_frame = n
@@ -255,7 +209,7 @@ def calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, uprigh
             # センターZを動かさない
             # logger.info("n=%s, previdx=%s", n, prev_frame)
             # logger.info("z変更前=%s", bone_frame_dic["センター"][n].position.z())
-            bone_frame_dic["センター"][n].position.setZ( bone_frame_dic["センター"][prev_frame].position.z() )
+            bone_frame_dic["センター"].positions[n, 2] = bone_frame_dic["センター"][prev_frame].position.z()
             # logger.info("z変更後=%s", bone_frame_dic["センター"][n].position.z())
 
 
@@ -289,13 +243,13 @@ def calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, uprigh
             right_ankle_pos.setY( right_ankle_pos.y() - ankle_pos_max )
 
             # FIXME センターががくがくする？要調査
-            bone_frame_dic["センター"][n].position.setY( bone_frame_dic["センター"][n].position.y() - ankle_pos_max )
+            bone_frame_dic["センター"].positions[n, 1] = bone_frame_dic["センター"][n].position.y() - ankle_pos_max
             
             # logger.debug("center.y2:{0}".format(bone_frame_dic["センター"][n].position.y()))    
 
             # X回転もさせず、接地させる
-            left_ik_rotation = QQuaternion.fromEulerAngles(0, left_ik_rotation.toEulerAngles().y(), left_ik_rotation.toEulerAngles().z() )
-            right_ik_rotation = QQuaternion.fromEulerAngles(0, right_ik_rotation.toEulerAngles().y(), right_ik_rotation.toEulerAngles().z() )
+            left_ik_rotation = calc_x_zero_rotation(left_ik_rotation)
+            right_ik_rotation = calc_x_zero_rotation(right_ik_rotation)
 
         # FIXME ジャンプしてる時と浮いてる時の区別がつかないので、一旦保留        
         # if bone_frame_dic["センター"][n].position.y() > 0 \
@@ -324,14 +278,14 @@ def calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, uprigh
             left_ankle_pos.setY(0)
 
             # X回転もさせず、接地させる
-            left_ik_rotation = QQuaternion.fromEulerAngles(0, left_ik_rotation.toEulerAngles().y(), left_ik_rotation.toEulerAngles().z() )
+            left_ik_rotation = calc_x_zero_rotation(left_ik_rotation)
 
         if (right_ankle_pos.y() < 0 and left_ankle_pos.y() >= 0):
             # 右足だけの場合マイナス値は0に補正
             right_ankle_pos.setY(0)
 
             # X回転もさせず、接地させる
-            right_ik_rotation = QQuaternion.fromEulerAngles(0, right_ik_rotation.toEulerAngles().y(), right_ik_rotation.toEulerAngles().z() )
+            right_ik_rotation = calc_x_zero_rotation(right_ik_rotation)
 
         # if abs(bone_frame_dic["上半身"][n].rotation.toEulerAngles().y()) < 30 and left_ankle_pos.y() == 0:
         #     # 正面向きでY位置が0の場合、回転させず、接地させる
@@ -353,7 +307,7 @@ def calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, uprigh
         if ( abs(bone_frame_dic["センター"][n].position.y()) > bone_center_ankle_y ):
             new_center_y = bone_frame_dic["センター"][n].position.y() - ( center_bone[1] - right_leg_bone[1] )
             logger.debug("陥没センターY上書き n={0}, y={1}, new_y={2}".format(n, bone_frame_dic["センター"][n].position.y(), new_center_y))
-            bone_frame_dic["センター"][n].position.setY(new_center_y)
+            bone_frame_dic["センター"].positions[n, 1] = new_center_y
 
         bone_frame_dic["左足ＩＫ"][n].position = left_ankle_pos
         bone_frame_dic["左足ＩＫ"][n].rotation = left_ik_rotation
@@ -367,332 +321,87 @@ def calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, uprigh
         #     sys.exit()
 
     #　ひざは登録除去
-    bone_frame_dic["左ひざ"] = []
-    bone_frame_dic["右ひざ"] = []
+    bone_frame_dic["左ひざ"].clear()
+    bone_frame_dic["右ひざ"].clear()
+
+# 片足分の LegIKSolver.solve の結果から1フレーム分を取り出す
+def get_IK_frame(iks, n):
+    ankle_pos, ik_rotation, leg_diff_rotation = iks
+    return QVector3D(*ankle_pos[n].tolist()), QQuaternion(*ik_rotation[n].tolist()), QQuaternion(*leg_diff_rotation[n].tolist())
+
+# X回転だけ0にした回転(オイラー角への変換は1回だけ行う)
+def calc_x_zero_rotation(rotation):
+    euler = rotation.toEulerAngles()
+    return QQuaternion.fromEulerAngles(0, euler.y(), euler.z())
 
 # IK回転の計算
+# 足IKの位置は calc_center_ik_position で計算した値を使用し、回転は両足の連鎖のFK(LegIKSolver)で求めた、FKと同じ状態の足首の向きとする
 def calc_IK_rotation(bone_frame_dic, bone_csv_file, positions_multi):
     logger.debug("bone_csv_file: "+ bone_csv_file)
 
-    # ボーンファイルを開く
-    with open(bone_csv_file, "r", encoding=pos2vmd_utils.get_file_encoding(bone_csv_file)) as bf:
-        reader = csv.reader(bf)
-
-        # とりあえず初期化
-        lower_body_bone = QVector3D()
-        left_leg_bone = QVector3D()
-        left_knee_bone = QVector3D()
-        left_ankle_bone = QVector3D()
-        left_toes_bone = QVector3D()
-        right_leg_bone = QVector3D()
-        right_knee_bone = QVector3D()
-        right_ankle_bone = QVector3D()
-        right_toes_bone = QVector3D()
-        left_leg_ik_bone = QVector3D()
-        right_leg_ik_bone = QVector3D()
-        center_bone = QVector3D()
-
-        for row in reader:
-
-            if row[1] == "下半身" or row[2].lower() == "lower body":
-                # 下半身ボーン
-                lower_body_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "左足" or row[2].lower() == "leg_l":
-                # 左足ボーン
-                left_leg_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "左ひざ" or row[2].lower() == "knee_l":
-                # 左ひざボーン
-                left_knee_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "左足首" or row[2].lower() == "ankle_l":
-                # 左足首ボーン
-                left_ankle_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "左つま先" or row[2].lower() == "l toe":
-                # 左つま先ボーン
-                left_toes_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "右足" or row[2].lower() == "leg_r":
-                # 右足ボーン
-                right_leg_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "右ひざ" or row[2].lower() == "knee_r":
-                # 右ひざボーン
-                right_knee_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "右足首" or row[2].lower() == "ankle_r":
-                # 右足首ボーン
-                right_ankle_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "右つま先" or row[2].lower() == "r toe":
-                # 右つま先ボーン
-                right_toes_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[0] == "Bone" and (row[1] == "左足ＩＫ" or row[2].lower() == "leg ik_l"):
-                # 左足ＩＫボーン
-                left_leg_ik_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[0] == "Bone" and (row[1] == "右足ＩＫ" or row[2].lower() == "leg ik_r"):
-                # 右足ＩＫボーン
-                right_leg_ik_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "センター" or row[2].lower() == "center":
-                # センターボーン
-                center_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
+    M = pos2vmd_math
+    positions = np.asarray(positions_multi.positions)
 
-    for n in range(len(bone_frame_dic["左足"])):
+    # ボーンモデル(解析済みのものがあれば、それを使う)
+    bone_model = pos2vmd_bone.load_bone_model(bone_csv_file)
 
-        # 左足IK
-        (_, left_ik_rotation, left_leg_diff_rotation) = \
-            calc_IK_matrix(center_bone, lower_body_bone, left_leg_bone, left_knee_bone, left_ankle_bone, left_toes_bone, left_leg_ik_bone \
-                , bone_frame_dic["センター"][n].position \
-                , bone_frame_dic["下半身"][n].rotation, bone_frame_dic["左足"][n].rotation, bone_frame_dic["左ひざ"][n].rotation )
+    # 全フレーム・両足分の足IKの回転をまとめて求める
+    # (足IKの位置は calc_center_ik_position の値、足の回転はFKのままとするので、IKのひざ位置に合わせた足の回転は使わない)
+    _, all_ik_rotations, _ = pos2vmd_ik.LegIKSolver(bone_model).solve(bone_frame_dic["センター"].positions, bone_frame_dic["下半身"].rotations, \
+                                                                        [bone_frame_dic["左足"].rotations, bone_frame_dic["右足"].rotations], \
+                                                                        [bone_frame_dic["左ひざ"].rotations, bone_frame_dic["右ひざ"].rotations])
 
-        # positionは、cal_IK_postionで計算した値を使用する
-        left_ankle_pos = bone_frame_dic["左足ＩＫ"][n].position
+    for direction_name, knee_joint_name in [("左", "LKnee"), ("右", "RKnee")]:
+        ik_track = bone_frame_dic["{0}足ＩＫ".format(direction_name)]
 
-        # 右足IK
-        (_, right_ik_rotation, right_leg_diff_rotation) = \
-            calc_IK_matrix(center_bone, lower_body_bone, right_leg_bone, right_knee_bone, right_ankle_bone, right_toes_bone, right_leg_ik_bone \
-                , bone_frame_dic["センター"][n].position \
-                , bone_frame_dic["下半身"][n].rotation, bone_frame_dic["右足"][n].rotation, bone_frame_dic["右ひざ"][n].rotation )
+        # FKと同じ状態の足首の向き
+        ik_rotations = all_ik_rotations[pos2vmd_ik.LEG_DIRECTIONS.index(direction_name)].copy()
 
-        right_ankle_pos = bone_frame_dic["右足ＩＫ"][n].position
+        ankle_y = ik_track.positions[:, 1]
+        # 膝が立っている場合
+        is_knee_up = positions[:, J[knee_joint_name], 1] > 3
 
-        # 足が埋まっている場合 （TODO 足の接地の改善）
-        if left_ankle_pos.y() < 0:
-            left_ankle_pos.setY(0)
-            # 膝が立っている場合
-            if positions_multi[n][5].y() > 3:
-                left_ik_rotation.setX(0)
-        # 足が地面に近い場合
-        elif left_ankle_pos.y() < 1:
-            if positions_multi[n][5].y() > 3:
-                left_ik_rotation.setX(left_ik_rotation.x()*left_ankle_pos.y())
-
-        # 足が埋まっている場合
-        if right_ankle_pos.y() < 0:
-            right_ankle_pos.setY(0)
-             # 膝が立っている場合
-            if positions_multi[n][2].y() > 3:
-                right_ik_rotation.setX(0)
-        # 足が地面に近い場合
-        elif right_ankle_pos.y() < 1:
-            if positions_multi[n][2].y() > 3:
-                right_ik_rotation.setX(right_ik_rotation.x()*right_ankle_pos.y())
+        # 足が埋まっている場合は回転のXを0、足が地面に近い場合は高さに応じて小さくする（TODO 足の接地の改善）
+        ik_rotations[:, M.QX] = np.where(is_knee_up & (ankle_y < 0), 0, \
+                                         np.where(is_knee_up & (ankle_y >= 0) & (ankle_y < 1), ik_rotations[:, M.QX] * ankle_y, ik_rotations[:, M.QX]))
 
-        bone_frame_dic["左足ＩＫ"][n].position = left_ankle_pos
-        bone_frame_dic["左足ＩＫ"][n].rotation = left_ik_rotation
-        #bone_frame_dic["左足"][n].rotation = left_leg_diff_rotation
-
-        bone_frame_dic["右足ＩＫ"][n].position = right_ankle_pos
-        bone_frame_dic["右足ＩＫ"][n].rotation = right_ik_rotation
-        #bone_frame_dic["右足"][n].rotation = right_leg_diff_rotation
+        # 足が埋まっている場合、地面に上げる
+        ik_track.positions[:, 1] = np.where(ankle_y < 0, 0, ankle_y)
+        ik_track.rotations = ik_rotations
 
     #　ひざは登録除去
-    bone_frame_dic["左ひざ"] = []
-    bone_frame_dic["右ひざ"] = []
-
-
-# 行列でIKの位置を求める
-def calc_IK_matrix(center_bone, lower_body_bone, leg_bone, knee_bone, ankle_bone, toes_bone, ik_bone, center_pos, lower_body_rotation, leg_rotation, knee_rotation):
-
-    # logger.debug("calc_IK_matrix ------------------------")
-
-    # IKを求める ----------------------------
-
-    # ローカル位置
-    trans_vs = [0 for i in range(6)]
-    # センターのローカル位置
-    trans_vs[0] = center_bone + center_pos - ik_bone
-    # 下半身のローカル位置
-    trans_vs[1] = lower_body_bone - center_bone
-    # 足のローカル位置
-    trans_vs[2] = leg_bone - lower_body_bone
-    # ひざのローカル位置 
-    trans_vs[3] = knee_bone - leg_bone
-    # 足首のローカル位置
-    trans_vs[4] = ankle_bone - knee_bone
-    # つま先のローカル位置
-    trans_vs[5] = toes_bone - ankle_bone
-    
-    # 加算用クォータニオン
-    add_qs = [0 for i in range(6)]
-    # センターの回転
-    add_qs[0] = QQuaternion()
-    # 下半身の回転
-    add_qs[1] = lower_body_rotation
-    # 足の回転
-    add_qs[2] = leg_rotation
-    # ひざの回転
-    add_qs[3] = knee_rotation
-    # 足首の回転
-    add_qs[4] = QQuaternion()
-    # つま先の回転
-    add_qs[5] = QQuaternion()
-
-    # 行列
-    matrixs = [0 for i in range(6)]
-
-    for n in range(len(matrixs)):
-        # 行列を生成
-        matrixs[n] = QMatrix4x4()
-        # 移動
-        matrixs[n].translate(trans_vs[n])
-        # 回転
-        matrixs[n].rotate(add_qs[n])
-
-        # logger.debug("matrixs[n] n={0}".format(n))
-        # logger.debug(matrixs[n])
-
-    # 足付け根の位置
-    leg_pos = matrixs[0] * matrixs[1] * QVector4D(trans_vs[2], 1)
-
-    # logger.debug("leg_pos")
-    # logger.debug(leg_pos.toVector3D())
-
-    # ひざの位置
-    knee_pos = matrixs[0] * matrixs[1] * matrixs[2] * QVector4D(trans_vs[3], 1)
-
-    # logger.debug("knee_pos")
-    # logger.debug(knee_pos.toVector3D())
-
-    # 足首の位置(行列の最後は掛けない)
-    ankle_pos = matrixs[0] * matrixs[1] * matrixs[2] * matrixs[3] * QVector4D(trans_vs[4], 1)
-    # logger.debug("ankle_pos {0}".format(ankle_pos.toVector3D()))
-
-    # logger.debug("ankle_pos")
-    # logger.debug(ankle_pos.toVector3D())
-
-    # つま先の位置
-    toes_pos = matrixs[0] * matrixs[1] * matrixs[2] * matrixs[3] * matrixs[4] * QVector4D(trans_vs[5], 1)
-    # logger.debug("toes_pos {0}".format(toes_pos.toVector3D()))
-
-    # 足付け根から足首までの距離
-    ankle_leg_diff = ankle_pos - leg_pos
-
-    # logger.debug("ankle_leg_diff")
-    # logger.debug(ankle_leg_diff)
-    # logger.debug(ankle_leg_diff.length())
-
-    # ひざから足付け根までの距離
-    knee_leg_diff = knee_bone - leg_bone
-
-    # logger.debug("knee_leg_diff")
-    # logger.debug(knee_leg_diff)
-    # logger.debug(knee_leg_diff.length())
-
-    # 足首からひざまでの距離
-    ankle_knee_diff = ankle_bone - knee_bone
-
-    # logger.debug("ankle_knee_diff")
-    # logger.debug(ankle_knee_diff)
-    # logger.debug(ankle_knee_diff.length())
-
-    # つま先から足首までの距離
-    toes_ankle_diff = toes_bone - ankle_bone
-
-    # logger.debug("toes_ankle_diff")
-    # logger.debug(toes_ankle_diff)
-    # logger.debug(toes_ankle_diff.length())
-
-    # 三辺から角度を求める
-
-    # 足の角度
-    leg_angle = calc_leg_angle(ankle_leg_diff, knee_leg_diff, ankle_knee_diff)
-    # logger.debug("leg_angle:   {0}".format(leg_angle))
-
-    # ひざの角度
-    knee_angle = calc_leg_angle(knee_leg_diff, ankle_knee_diff, ankle_leg_diff)
-    # logger.debug("knee_angle:  {0}".format(knee_angle))
-
-    # 足首の角度
-    ankle_angle = calc_leg_angle(ankle_knee_diff, ankle_leg_diff, knee_leg_diff)
-    # logger.debug("ankle_angle: {0}".format(ankle_angle))
-
-    # 足の回転 ------------------------------
-
-    # 足の付け根からひざへの方向を表す青い単位ベクトル(長さ1)
-    # 足の付け根から足首へのベクトルをX軸回りに回転させる
-    knee_v = QQuaternion.fromEulerAngles(leg_angle * -1, 0, 0) * ankle_leg_diff.toVector3D().normalized()
-
-    # logger.debug("knee_v")
-    # logger.debug(knee_v)
-
-    # FKのひざの位置
-    ik_knee_3d = knee_v * knee_leg_diff.length() + leg_pos.toVector3D()
-
-    # logger.debug("ik_knee_3d")
-    # logger.debug(ik_knee_3d)
-
-    # IKのひざ位置からFKのひざ位置に回転させる
-    leg_diff_rotation = QQuaternion.rotationTo(knee_pos.toVector3D(), ik_knee_3d)
-
-    # logger.debug("leg_diff_rotation")
-    # logger.debug(leg_diff_rotation)
-    # logger.debug(leg_diff_rotation.toEulerAngles())
-
-    # 足IKの回転（足首の角度）-------------------------
-
-    # FKと同じ状態の足首の向き
-    ik_rotation = lower_body_rotation * leg_rotation * knee_rotation
-    # logger.debug("ik_rotation {0}".format(ik_rotation.toEulerAngles()))
-
-    return (ankle_pos.toVector3D(), ik_rotation, leg_diff_rotation)
-
-
+    bone_frame_dic["左ひざ"].clear()
+    bone_frame_dic["右ひざ"].clear()
 
-# 三辺から足の角度を求める
-def calc_leg_angle(a, b, c):
 
-    if a.length() == 0 or b.length() == 0:
-        # 0割対策
-        return 0
-
-    cos = ( pow(a.length(), 2) + pow(b.length(), 2) - pow(c.length(), 2) ) / ( 2 * a.length() * b.length() )
-
-    # logger.debug("cos")
-    # logger.debug(cos)
-
-    radian = np.arccos(cos)
-
-    # logger.debug("radian")
-    # logger.debug(radian)
-
-    angle = np.rad2deg(radian)
-
-    # logger.debug("angle")
-    # logger.debug(angle)
-
-    return angle
+# Openposeの各関節の重み
+DEPTH_JOINT_WEIGHTS = [0.1,0.8,0.4,0.1,0.05,0.4,0.1,0.05,0.7,0.3,0.1,0.7,0.3,0.1,0.05,0.05,0.05,0.05]
+# 関節間の深度(深度の19列目以降)の関節の組み合わせ
+DEPTH_JOINT_PAIRS = [(0,1),(1,2),(2,3),(3,4),(1,5),(5,6),(6,7),(1,8),(8,9),(9,10),(1,11),(11,12),(12,13),(0,14),(14,16),(0,15),(15,17)]
+# 関節と関節間の重み (35,)。関節間の重みは両端の関節の重みの平均
+DEPTH_WEIGHTS = np.array(DEPTH_JOINT_WEIGHTS + [np.mean([DEPTH_JOINT_WEIGHTS[s], DEPTH_JOINT_WEIGHTS[e]]) for s, e in DEPTH_JOINT_PAIRS])
+# 関節だけの列数(関節間の信頼度がない場合は、関節間の列を使わない)
+DEPTH_JOINT_NUM = len(DEPTH_JOINT_WEIGHTS)
 
 # センターZの計算 
-def calc_center_z(bone_frame_dic, smoothed_2d, depths, depth_confs, start_frame, center_xy_scale, center_z_scale, depth_smooth_times, is_ik, base_dir, now_str):
+# contacts: 足の接地区間(足IKのZを止める区間)
+def calc_center_z(bone_frame_dic, smoothed_2d, depths, depth_confs, start_frame, center_xy_scale, center_z_scale, depth_smooth_times, is_ik, base_dir, now_str, contacts):
 
     if center_z_scale == 0:
         return
 
+    if is_ik == False:
+        # 足IKを使わない場合、センターZは深度から変更しない
+        return
+
     # 直立インデックス 
     # upright_idx = upright_idxs[0]
 
     # for ds in depths:
     #     logger.info("B) %s: Neck: %s, RHip: %s, LHip: %s", ds[pos2vmd_utils.DEPTH_INDEX["index"]], ds[pos2vmd_utils.DEPTH_INDEX["Neck"]], ds[pos2vmd_utils.DEPTH_INDEX["RHip"]], ds[pos2vmd_utils.DEPTH_INDEX["LHip"]])
 
-    nd_depths = np.array(depths)
-    nd_confs = np.array(depth_confs)
-
-    # Openposeの各関節の重み
-    weights = [0.1,0.8,0.4,0.1,0.05,0.4,0.1,0.05,0.7,0.3,0.1,0.7,0.3,0.1,0.05,0.05,0.05,0.05]
-
-    # 関節間の重みを計算する
-    all_weights = weights
-    for (start_idx, end_idx, start_w, end_w) in [(0,1,weights[0],weights[1]),(1,2,weights[1],weights[2]),(2,3,weights[2],weights[3]),(3,4,weights[3],weights[4]), \
-            (1,5,weights[1],weights[5]),(5,6,weights[5],weights[6]),(6,7,weights[6],weights[7]),(1,8,weights[1],weights[8]),(8,9,weights[8],weights[9]), \
-            (9,10,weights[9],weights[10]),(1,11,weights[1],weights[11]),(11,12,weights[11],weights[12]),(12,13,weights[12],weights[13]),(0,14,weights[0],weights[14]), \
-            (14,16,weights[14],weights[16]),(0,15,weights[0],weights[15]),(15,17,weights[15],weights[17])]:
-        all_weights.append(np.mean([start_w, end_w]))
+    nd_depths = np.asarray(depths, dtype=np.float64)
+    nd_confs = np.asarray(depth_confs, dtype=np.float64)
 
     # # 一旦大きくする
     # nd_depths[:,1:] *= (center_z_scale * 10)
@@ -767,25 +476,7 @@ def calc_center_z(bone_frame_dic, smoothed_2d, depths, depth_confs, start_frame,
     # 統合深度取得
     # depth_values = np.average(nd_depths_avgs[:,[pos2vmd_utils.DEPTH_INDEX["Neck"], pos2vmd_utils.DEPTH_INDEX["RHip"], pos2vmd_utils.DEPTH_INDEX["LHip"]]], axis=1)
     # depth_values = np.argmax(nd_depths[:,[2,3,6,9,10,12,13]], axis=1)
-    depth_values = []
-    for frame in range(nd_depths.shape[0]):
-        # depth_values.append(np.mean(nd_depths[frame,1:][nd_depths[frame,1:].nonzero()]))
-        # フレーム単位の信頼度から重みを再計算する
-        frame_weights = all_weights * np.array(nd_confs[frame][1:])
-
-        end_idx = len(nd_confs[frame][1:])
-        if nd_confs[frame][19:].max() < 0.1:
-            # 18以降が信頼度ない場合、無視
-            end_idx = 19
-
-        if np.median(nd_confs[frame][1:end_idx]) < 0.2 or np.all(nd_depths[frame][1:end_idx+1] == 0):
-            # 信頼度が低い場合、信頼できるデータが無いので過去データ流用
-            if frame == 0:
-                depth_values.append(0)
-            else:
-                depth_values.append(depth_values[frame - 1])
-        else:
-            depth_values.append(np.average(nd_depths[frame][1:end_idx+1], weights=frame_weights[:end_idx]))
+    depth_values = calc_depth_values(nd_depths, nd_confs)
 
     # # np.savetxt('depth2.txt', nd_depths, fmt='%.10f')
 
@@ -874,7 +565,7 @@ def calc_center_z(bone_frame_dic, smoothed_2d, depths, depth_confs, start_frame,
     # depth_value_avgs = depth_values
 
     # 前後フレームで深度平均をとる
-    depth_value_avgs = calc_move_average(depth_values, 11)
+    depth_value_avgs = pos2vmd_utils.calc_move_average(depth_values, 11)
 
     # # 中央値を取る
     # depth_value_avgs = []
@@ -889,105 +580,48 @@ def calc_center_z(bone_frame_dic, smoothed_2d, depths, depth_confs, start_frame,
     # depthf = open(depth_avgs_path, 'w')
 
     # 深度からセンターZを求める
+    frame_num = min(len(depth_values), len(bone_frame_dic["センター"]))
+    if frame_num == 0 or depth_smooth_times <= 0:
+        return
+
+    # センターZを加味する前のZ位置
+    now_center_zs = bone_frame_dic["センター"].positions[:frame_num, 2].copy()
+    now_left_zs = bone_frame_dic["左足ＩＫ"].positions[:frame_num, 2].copy()
+    now_right_zs = bone_frame_dic["右足ＩＫ"].positions[:frame_num, 2].copy()
+
+    # 両足の間のどの辺にセンターZがあるか割合
+    # 0F目で求めた割合を全フレームで保持する(1F目以降は前回比率を引き継ぐ)
+    z_rate = calc_center_z_rate(now_center_zs[0], now_left_zs[0], now_right_zs[0], 0.5)
+
+    # 足IKのZを取るフレーム
+    # どちらかの足が動いている(接地区間の基準フレームの)場合はそのフレーム、
+    # 右足も左足も動いていない場合は、前回インデックスで近い方(基準フレームの新しい方)を採用して、センターZを前回から動かさない
+    src_frames = contacts.latest_anchors[:frame_num]
+
+    depth_value_avgs = np.asarray(depth_value_avgs, dtype=np.float64)[:frame_num]
+
     for n in range(depth_smooth_times):
-        center_z_list = []
-        left_leg_ik_z_list = []
-        right_leg_ik_z_list = []
-
-        # 前回動いたフレーム
-        prev_left_frame = 0
-        prev_right_frame = 0
-        prev_z_rate = 0.5
-
-        for frame, (org_depth, now_depth) in enumerate(zip(depth_values, depth_value_avgs)):
-            if frame >= len(bone_frame_dic["センター"]):
-                break
-
-            # センターZ倍率から求める
-            center_z = now_depth * center_z_scale * -1 if n == 0 else now_depth
-            logger.debug("frame: %s, now: %s, z:%s", frame, now_depth, center_z)
-
-            # センターZを加味する前のZ位置
-            now_center_z = bone_frame_dic["センター"][frame].position.z()
-
-            if is_ik:
-                now_left_z = bone_frame_dic["左足ＩＫ"][frame].position.z()
-                now_right_z = bone_frame_dic["右足ＩＫ"][frame].position.z()
-
-                # 両足の間のどの辺にセンターZがあるか割合
-                if frame > 0 and prev_left_frame != frame and prev_right_frame != frame:
-                    # 前回から動いていない場合、前回比率保持
-                    z_rate = prev_z_rate
-                else:
-                    z_rate = abs((max(now_right_z, now_left_z) - now_center_z) / (max(now_right_z, now_left_z) - min(now_right_z, now_left_z)))
-                    z_rate = prev_z_rate if z_rate > 1 else z_rate
-                
-                if frame == 0:
-                    left_leg_ik_z = bone_frame_dic["左足ＩＫ"][frame].position.z() + center_z
-                    right_leg_ik_z = bone_frame_dic["右足ＩＫ"][frame].position.z() + center_z
-                else:
-                    left_leg_diff = bone_frame_dic["左足ＩＫ"][frame].position - bone_frame_dic["左足ＩＫ"][prev_left_frame].position
-                    if abs(left_leg_diff.x()) > 0.2 or abs(left_leg_diff.y()) > 0.2:
-                        # 左足IKが前回から動いていたら、フレーム登録
-                        prev_left_frame = frame
-
-                    right_leg_diff = bone_frame_dic["右足ＩＫ"][frame].position - bone_frame_dic["右足ＩＫ"][prev_right_frame].position
-                    if abs(right_leg_diff.x()) > 0.2 or abs(right_leg_diff.y()) > 0.2:
-                        # logger.info("右足ＩＫ: %s -> %s", bone_frame_dic["右足ＩＫ"][prev_right_frame].position, bone_frame_dic["右足ＩＫ"][frame].position)
-                        # 右足IKが前回から動いていたら、フレーム登録
-                        prev_right_frame = frame
-                    
-                    if prev_left_frame != frame and prev_right_frame != frame:
-                        # 右足も左足も動いていない場合、センターZを前回から動かさない
-                        # 前回インデックスで近い方採用
-                        prev_frame = prev_left_frame if prev_left_frame > prev_right_frame else prev_right_frame
-                        left_leg_ik_z = left_leg_ik_z_list[prev_frame]
-                        right_leg_ik_z = right_leg_ik_z_list[prev_frame]
-                    else:
-                        # どっちか動いている場合、そのままセンターZ適用
-                        left_leg_ik_z = bone_frame_dic["左足ＩＫ"][frame].position.z() + center_z
-                        right_leg_ik_z = bone_frame_dic["右足ＩＫ"][frame].position.z() + center_z
-                    # else:
-                    #     # どっちかが動いている場合、センターZ部分適用
-                    #     if prev_left_frame == frame:
-                    #         # 左足が動いている場合
-                    #         calc_center_z = center_z_list[prev_right_frame]     # センターは動いていない右に合わせる
-                    #         left_leg_ik_z = now_left_z + calc_center_z          # 左はセンターを加味して動かす
-                    #         right_leg_ik_z = right_leg_ik_z_list[prev_right_frame]   # 右は前のそのまま
-                    #     else:
-                    #         # 右足が動いている場合
-                    #         calc_center_z = center_z_list[prev_left_frame]     # センターは動いていない左に合わせる
-                    #         right_leg_ik_z = now_right_z + calc_center_z          # 右はセンターを加味して動かす
-                    #         left_leg_ik_z = left_leg_ik_z_list[prev_left_frame]   # 左は前のそのまま
-
-                # センターZは両足の間に再設定する
-                calc_center_z = min(right_leg_ik_z, (left_leg_ik_z)) - ((min(right_leg_ik_z, (left_leg_ik_z)) - max(right_leg_ik_z, (left_leg_ik_z))) * z_rate)
-                # depthf.write("{0}({7}), o: {1}, n:{2}, z:{3}, c:{4}, l:{5}, r:{6}\n".format(frame, org_depth, now_depth, center_z, calc_center_z, left_leg_ik_z, right_leg_ik_z, n))
-
-                center_z_list.append(calc_center_z)
-                left_leg_ik_z_list.append(left_leg_ik_z)
-                right_leg_ik_z_list.append(right_leg_ik_z)
-
-                prev_z_rate = z_rate
-            else:
-                center_z_list.append(now_center_z)
+        # センターZ倍率から求める
+        center_zs = depth_value_avgs * center_z_scale * -1 if n == 0 else depth_value_avgs
+
+        left_leg_ik_zs = (now_left_zs + center_zs)[src_frames]
+        right_leg_ik_zs = (now_right_zs + center_zs)[src_frames]
+
+        # センターZは両足の間に再設定する
+        min_zs = np.minimum(right_leg_ik_zs, left_leg_ik_zs)
+        max_zs = np.maximum(right_leg_ik_zs, left_leg_ik_zs)
+        calc_center_zs = min_zs - ((min_zs - max_zs) * z_rate)
 
         # 前後フレームで深度平均をとる
-        depth_value_avgs = calc_move_average(center_z_list, 11)
+        depth_value_avgs = pos2vmd_utils.calc_move_average(calc_center_zs, 11)
 
         # ユーロフィルターをかける
         depth_value_avgs = filter_depths(depth_value_avgs)
 
-    if is_ik:
-        # Z最終設定
-        for frame, (calc_center_z, left_leg_ik_z, right_leg_ik_z) in enumerate(zip(center_z_list, left_leg_ik_z_list, right_leg_ik_z_list)):
-            bone_frame_dic["センター"][frame].position.setZ(calc_center_z)
-            bone_frame_dic["左足ＩＫ"][frame].position.setZ(left_leg_ik_z)
-            bone_frame_dic["右足ＩＫ"][frame].position.setZ(right_leg_ik_z)
-    else:
-        # Z最終設定
-        for frame, calc_center_z in enumerate(center_z_list):
-            bone_frame_dic["センター"][frame].position.setZ(calc_center_z)
+    # Z最終設定
+    bone_frame_dic["センター"].positions[:frame_num, 2] = calc_center_zs
+    bone_frame_dic["左足ＩＫ"].positions[:frame_num, 2] = left_leg_ik_zs
+    bone_frame_dic["右足ＩＫ"].positions[:frame_num, 2] = right_leg_ik_zs
 
         # if frame == 0:
         #     # center_z_list.append(center_z)
@@ -1344,16 +978,61 @@ def calc_center_z(bone_frame_dic, smoothed_2d, depths, depth_confs, start_frame,
     #     # # センターZは両足の間に再設定する
     #     # bone_frame_dic["センター"][frame].position.setZ( np.average([bone_frame_dic["左足ＩＫ"][frame].position.z(), bone_frame_dic["右足ＩＫ"][frame].position.z()]) )
 
+# 深度と信頼度 (フレーム数, 36) から、フレームごとの統合深度 (フレーム数,) を求める
+# 信頼度の重み付きで関節(と関節間)の深度を平均し、信頼できるデータが無いフレームは直前のフレームの値で埋める
+def calc_depth_values(nd_depths, nd_confs):
+    frame_num = nd_depths.shape[0]
+    if frame_num == 0:
+        return np.zeros(0)
+
+    # 先頭列はINDEXなので除く
+    depths = nd_depths[:, 1:len(DEPTH_WEIGHTS)+1]
+    confs = nd_confs[:, 1:len(DEPTH_WEIGHTS)+1]
+
+    # 関節間(18以降)が信頼度ない場合、無視
+    is_joint_onlys = np.max(confs[:, DEPTH_JOINT_NUM:], axis=1) < 0.1
+    end_idxs = np.where(is_joint_onlys, DEPTH_JOINT_NUM + 1, confs.shape[1])
+
+    # 使う列 (フレーム数, 35)
+    columns = np.arange(confs.shape[1])
+    is_used = columns < end_idxs[:, np.newaxis]
+
+    # 信頼度の中央値(関節間を使う場合も、最後の1列は含めない)
+    conf_medians = np.where(is_joint_onlys, np.median(confs[:, :DEPTH_JOINT_NUM], axis=1), np.median(confs[:, :-1], axis=1))
+
+    # フレーム単位の信頼度から重みを再計算する
+    frame_weights = np.where(is_used, DEPTH_WEIGHTS * confs, 0)
+    weight_sums = np.sum(frame_weights, axis=1)
+
+    # 信頼度が低い場合、深度が全部取れていない場合は、信頼できるデータが無いので過去データ流用
+    is_valids = (conf_medians >= 0.2) & np.any(is_used & (depths != 0), axis=1) & (weight_sums > 0)
+
+    depth_values = np.sum(frame_weights * depths, axis=1) / np.where(weight_sums > 0, weight_sums, 1)
+
+    # 直前の信頼できるフレームのINDEX(先頭から信頼できない場合は-1)
+    valid_idxs = np.maximum.accumulate(np.where(is_valids, np.arange(frame_num), -1))
+
+    return np.where(valid_idxs >= 0, depth_values[np.maximum(valid_idxs, 0)], 0)
+
+# センターZの両足の間の割合(割合が取れない場合は prev_z_rate)
+def calc_center_z_rate(now_center_z, now_left_z, now_right_z, prev_z_rate):
+    max_z = max(now_right_z, now_left_z)
+    min_z = min(now_right_z, now_left_z)
+
+    if max_z == min_z:
+        return prev_z_rate
+
+    z_rate = abs((max_z - now_center_z) / (max_z - min_z))
+
+    return prev_z_rate if z_rate > 1 else z_rate
+
 def filter_depths(depth_value_avgs):
-    # JSONファイルから設定を読み込む
-    config = json.load(open("filter/config_depth.json", "r"))
+    # 深度用フィルタ(設定は1回だけ読み込んで使い回す)
+    dfilter = pos2vmd_filter_preset.load_filter_preset("depth").compile()
 
-    dfilter = pos2vmd_filter.OneEuroFilter(**config)
+    depth_value_avgs = np.asarray(depth_value_avgs, dtype=np.float64)
 
-    for frame in range(len(depth_value_avgs)):
-        depth_value_avgs[frame] = dfilter( depth_value_avgs[frame], frame )
-    
-    return depth_value_avgs
+    return dfilter(depth_value_avgs[:, np.newaxis], np.arange(len(depth_value_avgs)))[:, 0]
 
 def smooth_depth(depth_values, smooth_times):
     # 深度の位置円滑化
@@ -1401,35 +1080,15 @@ def calc_center(bone_frame_dic, smoothed_2d, bone_csv_file, upright_idxs, center
     # 直立インデックス
     upright_idx = upright_idxs[0]    
 
-    # ボーンファイルを開く
-    with open(bone_csv_file, "r",  encoding=pos2vmd_utils.get_file_encoding(bone_csv_file)) as bf:
-        reader = csv.reader(bf)
-
-        for row in reader:
-
-            if row[1] == "センター" or row[2].lower() == "center":
-                # センターボーン
-                center_3d = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "首" or row[2].lower() == "neck":
-                # 首ボーン
-                neck_3d = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "右足" or row[2].lower() == "leg_r":
-                # 右足ボーン
-                right_leg_3d = QVector3D(float(row[5]), float(row[6]), float(row[7]))
+    # ボーンモデル(解析済みのものがあれば、それを使う)
+    bone_model = pos2vmd_bone.load_bone_model(bone_csv_file)
 
-            if row[1] == "左足" or row[2].lower() == "leg_l":
-                # 左足ボーン
-                left_leg_3d = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "右足首" or row[2].lower() == "ankle_r":
-                # 右足首ボーン
-                right_ankle_3d = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "左足首" or row[2].lower() == "ankle_l":
-                # 左足首ボーン
-                left_ankle_3d = QVector3D(float(row[5]), float(row[6]), float(row[7]))
+    center_3d = bone_model.get_position("センター")
+    neck_3d = bone_model.get_position("首")
+    right_leg_3d = bone_model.get_position("右足")
+    left_leg_3d = bone_model.get_position("左足")
+    right_ankle_3d = bone_model.get_position("右足首")
+    left_ankle_3d = bone_model.get_position("左足首")
 
     # logger.debug("neck_3d")
     # logger.debug(neck_3d)
@@ -1447,7 +1106,7 @@ def calc_center(bone_frame_dic, smoothed_2d, bone_csv_file, upright_idxs, center
     # logger.debug(smoothed_2d[upright_idx])
 
     # 直立フレームの三角形面積
-    smoothed_upright_area = pos2vmd_utils.calc_triangle_area(smoothed_2d[upright_idx][pos2vmd_utils.SMOOTHED_2D_INDEX["Neck"]], smoothed_2d[upright_idx][pos2vmd_utils.SMOOTHED_2D_INDEX["RHip"]], smoothed_2d[upright_idx][pos2vmd_utils.SMOOTHED_2D_INDEX["LHip"]])
+    smoothed_upright_area = pos2vmd_utils.calc_triangle_area(pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, upright_idx, "Neck"), pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, upright_idx, "RHip"), pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, upright_idx, "LHip"))
 
     # logger.debug("upright_area")
     # logger.debug(smoothed_upright_area)
@@ -1459,13 +1118,13 @@ def calc_center(bone_frame_dic, smoothed_2d, bone_csv_file, upright_idxs, center
     # logger.debug(upright_xy_scale)
 
     # 直立フレームの左足と右足の位置のY平均
-    upright_leg_avg = abs((smoothed_2d[upright_idx][pos2vmd_utils.SMOOTHED_2D_INDEX["RHip"]].y() + smoothed_2d[upright_idx][pos2vmd_utils.SMOOTHED_2D_INDEX["LHip"]].y()) / 2)
+    upright_leg_avg = abs((pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, upright_idx, "RHip").y() + pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, upright_idx, "LHip").y()) / 2)
 
     # 直立フレームの首・左足と右足の位置のX平均
-    upright_neck_leg_x_avg = (smoothed_2d[upright_idx][pos2vmd_utils.SMOOTHED_2D_INDEX["Neck"]].x() + smoothed_2d[upright_idx][pos2vmd_utils.SMOOTHED_2D_INDEX["RHip"]].x() + smoothed_2d[upright_idx][pos2vmd_utils.SMOOTHED_2D_INDEX["LHip"]].x()) / 3
+    upright_neck_leg_x_avg = (pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, upright_idx, "Neck").x() + pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, upright_idx, "RHip").x() + pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, upright_idx, "LHip").x()) / 3
 
     # 直立フレームの左足首と右足首の位置の平均
-    upright_ankle_avg = abs((smoothed_2d[upright_idx][pos2vmd_utils.SMOOTHED_2D_INDEX["RAnkle"]].y() + smoothed_2d[upright_idx][pos2vmd_utils.SMOOTHED_2D_INDEX["LAnkle"]].y()) / 2)
+    upright_ankle_avg = abs((pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, upright_idx, "RAnkle").y() + pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, upright_idx, "LAnkle").y()) / 2)
 
     # logger.debug("upright_ankle_avg")
     # logger.debug(upright_ankle_avg)
@@ -1513,7 +1172,7 @@ def calc_center(bone_frame_dic, smoothed_2d, bone_csv_file, upright_idxs, center
         logger.debug("センター計算 frame={0}".format(n))
 
         # 左足と右足の位置の小さい方
-        ankle_min = np.min([smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["RAnkle"]].y(), smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["LAnkle"]].y()])
+        ankle_min = np.min([pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, n, "RAnkle").y(), pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, n, "LAnkle").y()])
 
         # logger.debug("ankle_min")
         # logger.debug(ankle_min)
@@ -1522,7 +1181,7 @@ def calc_center(bone_frame_dic, smoothed_2d, bone_csv_file, upright_idxs, center
         # logger.debug(ankle_min * upright_ankle_scale)
 
         # 左足と右足の位置の平均
-        leg_avg = abs((smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["RHip"]].y() + smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["LHip"]].y()) / 2)
+        leg_avg = abs((pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, n, "RHip").y() + pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, n, "LHip").y()) / 2)
         
         # 足の上下差
         leg_diff = upright_leg_avg - leg_avg
@@ -1531,15 +1190,15 @@ def calc_center(bone_frame_dic, smoothed_2d, bone_csv_file, upright_idxs, center
         center_y = (leg_diff * upright_xy_scale) - (ankle_min * upright_ankle_scale)
 
         # 踵補正を入れて設定する
-        bone_frame_dic["センター"][n].position.setY(center_y + heelpos)
+        bone_frame_dic["センター"].positions[n, 1] = center_y + heelpos
         # bone_frame_dic["センター"][n].position.setY((leg_diff * upright_xy_scale))
         
         # 首・左足・右足の中心部分をX軸移動
-        x_avg = ((smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["Neck"]].x() + smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["RHip"]].x() + smoothed_2d[n][pos2vmd_utils.SMOOTHED_2D_INDEX["LHip"]].x()) / 3) \
+        x_avg = ((pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, n, "Neck").x() + pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, n, "RHip").x() + pos2vmd_utils.get_smoothed_2d_vector(smoothed_2d, n, "LHip").x()) / 3) \
                     - upright_neck_leg_x_avg + upright_adjust_neck_leg_x_avg
         center_x = x_avg * upright_xy_scale
 
-        bone_frame_dic["センター"][n].position.setX(center_x)
+        bone_frame_dic["センター"].positions[n, 0] = center_x
 
         logger.debug("center {0} x={1}, y={2}".format(n, center_x, center_y))
 
@@ -1808,152 +1467,40 @@ def calc_center(bone_frame_dic, smoothed_2d, bone_csv_file, upright_idxs, center
 
 
 # センターと足IKの位置をpos.txtデータから計算
-def calc_center_ik_position(bone_frame_dic, positions_multi, bone_csv_file, smoothed_2d, heelpos, is_ik):
-    # ボーンファイルを開く
-    with open(bone_csv_file, "r",  encoding=pos2vmd_utils.get_file_encoding(bone_csv_file)) as bf:
-        reader = csv.reader(bf)
-
-        # とりあえず初期化
-        left_leg_bone = QVector3D()
-        left_knee_bone = QVector3D()
-        left_ankle_bone = QVector3D()
-        right_leg_bone = QVector3D()
-        right_knee_bone = QVector3D()
-        right_ankle_bone = QVector3D()
-
-        for row in reader:
-            if row[1] == "左足" or row[2].lower() == "leg_l":
-                # 左足ボーン
-                left_leg_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "左ひざ" or row[2].lower() == "knee_l":
-                # 左ひざボーン
-                left_knee_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "左足首" or row[2].lower() == "ankle_l":
-                # 左足首ボーン
-                left_ankle_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "右足" or row[2].lower() == "leg_r":
-                # 右足ボーン
-                right_leg_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "右ひざ" or row[2].lower() == "knee_r":
-                # 右ひざボーン
-                right_knee_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-            if row[1] == "右足首" or row[2].lower() == "ankle_r":
-                # 右足首ボーン
-                right_ankle_bone = QVector3D(float(row[5]), float(row[6]), float(row[7]))
-
-    # MMD上の両足の長さ（RHip-RKnee-RAnkle, LHip-LKnee-LAnkle）を計算
-    mmd_leg_length = (right_ankle_bone-right_knee_bone).length() + (right_knee_bone-right_leg_bone).length() \
-                   + (left_ankle_bone-left_knee_bone).length() + (left_knee_bone-left_leg_bone).length()
-
-    # 左右方向のmmdとbaselineのスケール比率は、固定値とする
-    scale_mmd_base_const = 18.83 / 1743 # = ミクさんの両足の長さ(18.83ミクセル:1506mm)/教師データの両足の長さ平均(1743mm)
-
-    # 上下方向のスケール比率は、pos.txtの足の長さに合わせて変動値とする
-    # pos.txtの両足の長さ（RHip-RKnee-RAnkle, LHip-LKnee-LAnkle）
-    base_leg_length = []
-    for frame, positions in enumerate(positions_multi):
-        # 3dBaseLineでの足の長さ合計（RHip-RKnee-RAnkle, LHip-LKnee-LAnkle）を計算
-        base_leg_length.append( (positions[3] - positions[2]).length() + (positions[2] - positions[1]).length()
-                                + (positions[6] - positions[5]).length() + (positions[5] - positions[4]).length()
-                              )
-    # 前後の計91フレームで移動平均をとる
-    move_ave_base_leg_length = calc_move_average(base_leg_length, 91)
-
-    # 平均 
-    ave_base_leg_length = np.mean(base_leg_length)
-
-    # pos.txtのyは接地時の足首の位置を0としているため、その分のバイアス
-    bias_y = (left_ankle_bone + right_ankle_bone)/2
+# 全フレーム分を配列でまとめて計算する
+# contacts: 足の接地区間(指定がない場合はここで求める)
+def calc_center_ik_position(bone_frame_dic, positions_multi, bone_csv_file, smoothed_2d, heelpos, is_ik, contacts=None, calibration=None):
+    # ボーンモデル(解析済みのものがあれば、それを使う)
+    bone_model = pos2vmd_bone.load_bone_model(bone_csv_file)
 
-    # 前回フレーム
-    prev_left_frame = 0
-    prev_right_frame = 0
+    left_leg_bone = bone_model.get_position_array("左足")
+    left_ankle_bone = bone_model.get_position_array("左足首")
+    right_leg_bone = bone_model.get_position_array("右足")
+    right_ankle_bone = bone_model.get_position_array("右足首")
 
-    for frame, positions in enumerate(positions_multi):
-        base_leg = move_ave_base_leg_length[frame]
-        # pos.txtの足の長さが正しく取れない時のため、上限、下限を設ける
-        if base_leg < ave_base_leg_length * 0.9:
-            base_leg = ave_base_leg_length * 0.9
-        if base_leg > ave_base_leg_length * 1.1:
-            base_leg = ave_base_leg_length * 1.1
-
-        # MMD上の足の長さと3dBaseLine上の足の長さの比率
-        scale_mmd_base = mmd_leg_length/base_leg
-
-        # センターIK
-        hip_pos = QVector3D(scale_mmd_base_const * positions[0].x(),
-                            scale_mmd_base * positions[0].y(),
-                            scale_mmd_base_const * positions[0].z()
-                        )
-        hip_mmd = bias_y + hip_pos
-        hip_mmd_diff = hip_mmd - (left_leg_bone + right_leg_bone)/2
-        # 踵補正を入れて設定する
-        heelpos_common = -0.2 # 0.2沈める
-        hip_mmd_diff.setY(hip_mmd_diff.y() + heelpos_common + heelpos)
-        bone_frame_dic["センター"][frame].position = hip_mmd_diff
+    # 関節位置 (フレーム数, 17, 3)
+    positions = np.asarray(positions_multi.positions, dtype=np.float64)
 
-        if is_ik:
-            # 右足IK
-            right_ankle_pos = QVector3D(scale_mmd_base_const * positions[3].x(),
-                                        scale_mmd_base * positions[3].y(),
-                                        scale_mmd_base_const * positions[3].z()
-                                )
-            right_ankle_mmd = bias_y + right_ankle_pos
-            right_ankle_mmd_diff = right_ankle_mmd - right_ankle_bone
-            # 踵補正を入れて設定する
-            right_ankle_mmd_diff.setY(right_ankle_mmd_diff.y() + heelpos_common + heelpos)
+    # MMD上の足の長さと3dBaseLine上の足の長さの比率と、足首の高さのバイアス
+    # (踵補正などの設定に依存しないので、保存したものがあればそれを使う)
+    if calibration is None:
+        calibration = pos2vmd_calibration.calc_calibration(positions, bone_model)
 
-            # 左足IK
-            left_ankle_pos = QVector3D(scale_mmd_base_const * positions[6].x(),
-                                        scale_mmd_base * positions[6].y(),
-                                        scale_mmd_base_const * positions[6].z()
-                                )
-            left_ankle_mmd = bias_y + left_ankle_pos
-            left_ankle_mmd_diff = left_ankle_mmd - left_ankle_bone
-            # 踵補正を入れて設定する
-            left_ankle_mmd_diff.setY(left_ankle_mmd_diff.y() + heelpos_common + heelpos)
-
-            # bone_frame_dic["右足ＩＫ"][frame].position = right_ankle_mmd_diff
-            # bone_frame_dic["左足ＩＫ"][frame].position = left_ankle_mmd_diff
+    # 踵補正
+    heelpos_common = -0.2 # 0.2沈める
+    heel_offset = np.array([0, heelpos_common + heelpos, 0])
 
-            # 足止め処理
-            if frame == 0:
-                # 0F目の場合、そのまま前回分として保持
-                bone_frame_dic["右足ＩＫ"][frame].position = right_ankle_mmd_diff
-                bone_frame_dic["左足ＩＫ"][frame].position = left_ankle_mmd_diff
-            else:
-                if abs(np.diff([smoothed_2d[prev_left_frame][pos2vmd_utils.SMOOTHED_2D_INDEX["LAnkle"]].x(), smoothed_2d[frame][pos2vmd_utils.SMOOTHED_2D_INDEX["LAnkle"]].x()])) < 10 and abs(np.diff([smoothed_2d[prev_left_frame][pos2vmd_utils.SMOOTHED_2D_INDEX["LAnkle"]].y(), smoothed_2d[frame][pos2vmd_utils.SMOOTHED_2D_INDEX["LAnkle"]].y()])) < 10:
-                    #左足IKが前回からほとんど動いていない場合、前回からコピーする
-                    bone_frame_dic["左足ＩＫ"][frame].position = copy.deepcopy(bone_frame_dic["左足ＩＫ"][prev_left_frame].position)
-                else:
-                    # 動いている場合、前回計算フレームとして保持
-                    prev_left_frame = frame
-                    bone_frame_dic["左足ＩＫ"][frame].position = left_ankle_mmd_diff
-
-                if abs(np.diff([smoothed_2d[prev_right_frame][pos2vmd_utils.SMOOTHED_2D_INDEX["RAnkle"]].x(), smoothed_2d[frame][pos2vmd_utils.SMOOTHED_2D_INDEX["RAnkle"]].x()])) < 10 and abs(np.diff([smoothed_2d[prev_right_frame][pos2vmd_utils.SMOOTHED_2D_INDEX["RAnkle"]].y(), smoothed_2d[frame][pos2vmd_utils.SMOOTHED_2D_INDEX["RAnkle"]].y()])) < 10:
-                    #右足IKが前回からほとんど動いていない場合、前回からコピーする
-                    bone_frame_dic["右足ＩＫ"][frame].position = copy.deepcopy(bone_frame_dic["右足ＩＫ"][prev_right_frame].position)
-                else:
-                    # 動いている場合、前回計算フレームとして保持
-                    prev_right_frame = frame
-                    bone_frame_dic["右足ＩＫ"][frame].position = right_ankle_mmd_diff
-
-
-
-def calc_move_average(data, n):
-    if len(data) > n:
-        move_avg = np.convolve(data, np.ones(n)/n, 'valid')
-        # 移動平均でデータ数が減るため、前と後ろに同じ値を繰り返しで補填する
-        fore_n = int((n - 1)/2)
-        back_n = n - 1 - fore_n
-        result = np.hstack((np.tile([move_avg[0]], fore_n), move_avg, np.tile([move_avg[-1]], back_n)))
-    else:
-        avg = np.mean(data)
-        result = np.tile([avg], len(data))
+    # センターIK
+    hip_mmd = calibration.to_mmd(positions[:, J["Hip"]])
+    bone_frame_dic["センター"].positions[:] = hip_mmd - (left_leg_bone + right_leg_bone) / 2 + heel_offset
 
-    return result
+    if is_ik:
+        if contacts is None:
+            contacts = pos2vmd_contact.calc_foot_contacts(positions, smoothed_2d)
+
+        for direction_name, joint_name, ankle_bone in [("右", "RFoot", right_ankle_bone), ("左", "LFoot", left_ankle_bone)]:
+            ankle_mmd_diff = calibration.to_mmd(positions[:, J[joint_name]]) - ankle_bone + heel_offset
+
+            # 足止め処理
+            # 接地区間の間は、区間の基準フレームの位置をコピーする
+            bone_frame_dic["{0}足ＩＫ".format(direction_name)].positions[:] = ankle_mmd_diff[contacts[direction_name].anchors]
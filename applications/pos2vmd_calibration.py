@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_calibration.py - 関節位置とボーンモデルの体格キャリブレーション
+#
+# pos.txtの足の長さとトレースモデルの足の長さから、関節位置をMMDの位置にするスケール比率と、
+# 足首の高さのバイアスを求める。踵補正・センターZ倍率・円滑化・間引きの設定には依存しないので、
+# (pos.txt, ボーンモデル) の組ごとに1回だけ求め、pos.txt と同じディレクトリに pos2vmd_cache で保存して次回以降も使う
+#
+# 保存するのは pos.txt の足の長さ(移動平均、上限・下限つき)とその平均で、スケール比率とバイアスはボーンモデルから作り直す
+# 保存ファイルの有効性は pos2vmd_cache のメタ情報(pos.txt のサイズ・更新日時・ハッシュ)と、
+# ボーンCSVなど関節位置の補正に関わるファイルのパス・更新日時で判定するので、関節位置のハッシュは取らない
+
+import os
+import logging
+import numpy as np
+
+from applications import pos2vmd_utils
+from applications import pos2vmd_skeleton
+from applications import pos2vmd_bone
+from applications import pos2vmd_cache
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# 左右方向のmmdとbaselineのスケール比率は、固定値とする
+SCALE_MMD_BASE_CONST = 18.83 / 1743 # = ミクさんの両足の長さ(18.83ミクセル:1506mm)/教師データの両足の長さ平均(1743mm)
+
+# 足の長さの移動平均をとるフレーム数(前後の計)
+LEG_LENGTH_AVERAGE_FRAMES = 91
+# 足の長さの移動平均は、全体の平均のこの割合の範囲に収める
+LEG_LENGTH_CLAMP_RATE = 0.1
+
+
+class Calibration():
+    def __init__(self, scales, base_leg_lengths, ave_base_leg_length, mmd_leg_length, bias_y):
+        # 関節位置からMMD上の位置へのスケール比率 (フレーム数, 3)。左右・前後は固定、上下はフレームごと
+        self.scales = scales
+        # pos.txtの両足の長さ(移動平均、上限・下限つき) (フレーム数,)
+        self.base_leg_lengths = base_leg_lengths
+        # pos.txtの両足の長さの平均
+        self.ave_base_leg_length = ave_base_leg_length
+        # MMD上の両足の長さ
+        self.mmd_leg_length = mmd_leg_length
+        # pos.txtのyは接地時の足首の位置を0としているため、その分のバイアス (3,)
+        self.bias_y = bias_y
+
+    def __len__(self):
+        return self.scales.shape[0]
+
+    # 関節位置 (..., 3) をMMD上の位置にする
+    def to_mmd(self, joint_positions):
+        return self.bias_y + self.scales * joint_positions
+
+
+# 関節位置 (フレーム数, 17, 3) とボーンモデルから、キャリブレーションを求める
+def calc_calibration(positions, bone_model):
+    base_leg, ave_base_leg_length = calc_base_leg_lengths(positions)
+
+    return make_calibration(base_leg, ave_base_leg_length, bone_model)
+
+
+# pos.txtの両足の長さ(移動平均、上限・下限つき) (フレーム数,) とその平均
+def calc_base_leg_lengths(positions):
+    J = pos2vmd_skeleton.H36M.joints
+    positions = np.asarray(positions, dtype=np.float64)
+
+    # 上下方向のスケール比率は、pos.txtの足の長さに合わせて変動値とする
+    # pos.txtの両足の長さ（RHip-RKnee-RAnkle, LHip-LKnee-LAnkle）
+    leg_joints = positions[:, [J["RFoot"], J["RKnee"], J["RHip"], J["LFoot"], J["LKnee"], J["LHip"]]]
+    leg_segments = np.linalg.norm(leg_joints[:, [0, 1, 3, 4]] - leg_joints[:, [1, 2, 4, 5]], axis=-1)
+    base_leg_length = np.sum(leg_segments, axis=1)
+
+    # 前後の計91フレームで移動平均をとる
+    move_ave_base_leg_length = pos2vmd_utils.calc_move_average(base_leg_length, LEG_LENGTH_AVERAGE_FRAMES)
+
+    # 平均
+    ave_base_leg_length = float(np.mean(base_leg_length)) if len(base_leg_length) > 0 else 0.0
+
+    # pos.txtの足の長さが正しく取れない時のため、上限、下限を設ける
+    base_leg = np.clip(move_ave_base_leg_length, ave_base_leg_length * (1 - LEG_LENGTH_CLAMP_RATE), ave_base_leg_length * (1 + LEG_LENGTH_CLAMP_RATE))
+
+    return base_leg, ave_base_leg_length
+
+
+# pos.txtの両足の長さとボーンモデルから、キャリブレーションを作る
+def make_calibration(base_leg, ave_base_leg_length, bone_model):
+    # MMD上の両足の長さ（RHip-RKnee-RAnkle, LHip-LKnee-LAnkle）
+    mmd_leg_length = bone_model.leg_length
+
+    # MMD上の足の長さと3dBaseLine上の足の長さの比率
+    scales = np.empty((len(base_leg), 3))
+    scales[:, [0, 2]] = SCALE_MMD_BASE_CONST
+    scales[:, 1] = mmd_leg_length / base_leg
+
+    # pos.txtのyは接地時の足首の位置を0としているため、その分のバイアス
+    bias_y = (bone_model.get_position_array("左足首") + bone_model.get_position_array("右足首")) / 2
+
+    return Calibration(scales, base_leg, ave_base_leg_length, mmd_leg_length, bias_y)
+
+
+# 保存ファイルの種類(ボーンCSVごとに分ける)
+def get_calibration_kind(bone_csv_file):
+    return "calib_{0}".format(os.path.splitext(os.path.basename(bone_csv_file))[0])
+
+
+# キャリブレーションを取得する
+# position_file: positions の読み込み元の pos.txt。指定した場合は pos.txt と同じディレクトリに保存したものを使い、なければ求めて保存する
+# depend_files: pos.txt 以外に positions(の補正)が依存するファイル。ボーンCSVは常に含める
+def load_calibration(positions, bone_csv_file, position_file=None, depend_files=()):
+    bone_model = pos2vmd_bone.load_bone_model(bone_csv_file)
+
+    if position_file is None:
+        return calc_calibration(positions, bone_model)
+
+    # 保存するのは [足の長さの平均, 各フレームの足の長さ...]
+    def calc_leg_lengths(_):
+        base_leg, ave_base_leg_length = calc_base_leg_lengths(positions)
+        return np.concatenate([[ave_base_leg_length], base_leg])
+
+    depend_files = [bone_csv_file] + [f for f in depend_files if f is not None]
+    leg_lengths = pos2vmd_cache.load_cached(position_file, get_calibration_kind(bone_csv_file), calc_leg_lengths, depend_files)
+
+    return make_calibration(np.array(leg_lengths[1:]), float(leg_lengths[0]), bone_model)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_contact.py - 足の接地区間
+#
+# 足首の2次元位置の移動量・3次元の高さ・2次元の信頼度から、片足ごとの接地(足止め)区間を求める
+# 変換ごとに1回だけ求め、センター・足IKの位置、センターZ、足IKの計算で同じ区間を使う
+#
+# 接地区間は、基準フレーム(足が動いたフレーム)と、そこから足がほとんど動いていない後続フレームの並び
+# 区間は各フレームの基準フレームのINDEX(anchors)と、区間の開始フレーム・長さのランレングスで持つ
+
+import logging
+import numpy as np
+
+from applications import pos2vmd_utils
+from applications import pos2vmd_skeleton
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# 足首の2次元位置が、基準フレームから x, y ともにこれ未満の移動なら接地とみなす(px)
+CONTACT_MOVE_2D = 10
+# 地面からの足首の高さがこれ以上なら接地しない(mm)
+CONTACT_HEIGHT = 100
+# 足首の2次元の信頼度がこれ未満なら接地しない
+# (信頼度があるのは Lifting の visibility から作った2次元位置などに限る。
+#  x, y だけの smoothed.txt は信頼度がすべて1になるので、この判定は常に通る)
+CONTACT_CONFIDENCE = 0.2
+# 両足首の低い方の高さの、このパーセンタイルを地面の高さとする
+GROUND_PERCENTILE = 5
+
+# 足ごとの (足IKのボーン名の左右, 3次元の足首の関節名, 2次元の足首の関節名)
+FEET = [("左", "LFoot", "LAnkle"), ("右", "RFoot", "RAnkle")]
+
+
+# 片足の接地区間
+class FootContact():
+    def __init__(self, anchors):
+        frame_num = len(anchors)
+
+        # 各フレームの基準フレームのINDEX (フレーム数,)
+        self.anchors = anchors
+        # 基準フレームごとの区間の開始フレームと長さ(ランレングス)
+        self.starts = np.flatnonzero(anchors == np.arange(frame_num))
+        self.lengths = np.diff(np.append(self.starts, frame_num))
+
+    def __len__(self):
+        return len(self.anchors)
+
+    # 基準フレームの値で止めているフレーム (フレーム数,)
+    @property
+    def is_locked(self):
+        return self.anchors != np.arange(len(self.anchors))
+
+    # 接地区間(2フレーム以上止めている区間)の開始フレームと長さ
+    @property
+    def intervals(self):
+        is_contacts = self.lengths > 1
+        return self.starts[is_contacts], self.lengths[is_contacts]
+
+
+# 両足の接地区間
+class FootContacts():
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def __len__(self):
+        return len(self.left)
+
+    # 足IKのボーン名の左右("左", "右")で片足の接地区間を返す
+    def __getitem__(self, direction_name):
+        return self.left if direction_name == "左" else self.right
+
+    # 両足とも止めているフレーム (フレーム数,)
+    @property
+    def is_both_locked(self):
+        return self.left.is_locked & self.right.is_locked
+
+    # 各フレームで、両足の基準フレームの新しい方 (フレーム数,)
+    @property
+    def latest_anchors(self):
+        return np.maximum(self.left.anchors, self.right.anchors)
+
+
+# 関節位置 (フレーム数, 17, 3) と関節二次元情報 (フレーム数, 18, 3) から、両足の接地区間を求める
+def calc_foot_contacts(positions, smoothed_2d, move_threshold=CONTACT_MOVE_2D, height_threshold=CONTACT_HEIGHT, confidence_threshold=CONTACT_CONFIDENCE):
+    positions = np.asarray(positions, dtype=np.float64)
+    smoothed_2d = np.asarray(smoothed_2d, dtype=np.float64)
+    joints = pos2vmd_skeleton.H36M.joints
+
+    # 足首の高さ (フレーム数, 2)。pos.txtのyは接地時の足首の位置を0としているが、ずれがあるので地面の高さを推定して引く
+    heights = positions[:, [joints[joint_name] for _, joint_name, _ in FEET], 1]
+    ground = np.percentile(np.min(heights, axis=1), GROUND_PERCENTILE) if heights.shape[0] > 0 else 0
+
+    contacts = []
+    for (direction_name, joint_name, ankle_name), foot_heights in zip(FEET, heights.T):
+        ankle_2d = smoothed_2d[:, pos2vmd_utils.SMOOTHED_2D_INDEX[ankle_name]]
+
+        # 接地しうるフレーム(足首が地面に近く、2次元の位置が信頼できる)
+        # 信頼度での判定は、実際の信頼度がある場合だけ効く(smoothed.txt の x, y だけの場合は1で埋まっている)
+        is_groundeds = ((foot_heights - ground) < height_threshold) & (ankle_2d[:, 2] >= confidence_threshold)
+
+        contact = FootContact(calc_contact_anchors(ankle_2d[:, :2], is_groundeds, move_threshold))
+        logger.debug("接地区間 %s: %s", direction_name, len(contact.intervals[0]))
+
+        contacts.append(contact)
+
+    return FootContacts(*contacts)
+
+
+# 各フレームの基準フレームのINDEX (フレーム数,)
+# 0F目と、基準フレームから足首の2次元位置が x, y のどちらかで threshold 以上動いたフレームを新たな基準とする
+# 接地しえないフレーム(is_groundeds が False)は止めず、そのフレーム自身を基準とする
+def calc_contact_anchors(ankle_2d, is_groundeds, threshold):
+    ankle_2d = np.asarray(ankle_2d, dtype=np.float64)
+    frame_num = ankle_2d.shape[0]
+
+    if frame_num == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # 基準が移るかどうかは直前の基準に依存するため、基準フレームの検出だけは先頭から順に行う
+    # (配列の1行ずつの比較は遅いので、floatのリストで比較する)
+    xs = ankle_2d[:, 0].tolist()
+    ys = ankle_2d[:, 1].tolist()
+    groundeds = np.asarray(is_groundeds, dtype=np.bool_).tolist()
+
+    anchors = [0]
+    anchor_x, anchor_y, anchor_grounded = xs[0], ys[0], groundeds[0]
+    for frame in range(1, frame_num):
+        if anchor_grounded and groundeds[frame] and abs(xs[frame] - anchor_x) < threshold and abs(ys[frame] - anchor_y) < threshold:
+            continue
+
+        anchors.append(frame)
+        anchor_x, anchor_y, anchor_grounded = xs[frame], ys[frame], groundeds[frame]
+
+    # 直前の基準フレームで埋める
+    is_anchors = np.zeros(frame_num, dtype=np.bool_)
+    is_anchors[anchors] = True
+
+    return np.maximum.accumulate(np.where(is_anchors, np.arange(frame_num), 0))
@@ -1,12 +1,13 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 #
-from PyQt5.QtGui import QQuaternion, QVector4D, QVector3D, QMatrix4x4
+from applications.pos2vmd_qt import QQuaternion, QVector4D, QVector3D, QMatrix4x4
 import logging
-import json
 import math
 import numpy as np
 
+from applications import pos2vmd_filter_preset
+
 logger = logging.getLogger("__main__").getChild(__name__)
 
 # フィルターをかける
@@ -18,76 +19,54 @@ def smooth_filter(bone_frame_dic, is_groove, smooth_times):
         smooth_angle(bone_frame_dic, smooth_times)
         smooth_IK(bone_frame_dic, smooth_times)
     
-    # JSONファイルから設定を読み込む
-    config_qq = json.load(open("filter/config_qq.json", "r"))
-
-    # JSONファイルから設定を読み込む
-    config_move = json.load(open("filter/config_move.json", "r"))
-
-    # 移動用フィルタ
-    pxfilter = OneEuroFilter(**config_move)
-    pyfilter = OneEuroFilter(**config_move)
-    pzfilter = OneEuroFilter(**config_move)
-
-    # 回転用フィルタ
-    rxfilter = OneEuroFilter(**config_qq)
-    ryfilter = OneEuroFilter(**config_qq)
-    rzfilter = OneEuroFilter(**config_qq)
-    rwfilter = OneEuroFilter(**config_qq)
-
-    for key in bone_frame_dic.keys():
-        for n, frame in enumerate(bone_frame_dic[key]):
-            if key == "グルーブ" and is_groove == False:
-                continue
-
-            if "ＩＫ" in key:
-
-                # IKの場合、次のフレームと全く同値の場合、フィルタをかけない
-                if frame.frame < len(bone_frame_dic[key]) - 1 \
-                and frame.position == bone_frame_dic[key][n+1].position \
-                and frame.rotation == bone_frame_dic[key][n+1].rotation:
-                    
-                    # 位置と回転が同じ場合、同値とみなす
-                    logger.debug("IK同値: %s %s", n, frame.name)
-
-                    # 処理をスキップして次に行く
-                    pxfilter.skip(frame.position.x(), frame.frame)
-                    pyfilter.skip(frame.position.y(), frame.frame)
-                    pzfilter.skip(frame.position.z(), frame.frame)
-
-                    rxfilter.skip(frame.rotation.x(), frame.frame)
-                    ryfilter.skip(frame.rotation.y(), frame.frame)
-                    rzfilter.skip(frame.rotation.z(), frame.frame)
-                    rwfilter.skip(frame.rotation.scalar(), frame.frame)
-
-                    continue
-
-            # XYZそれぞれにフィルターをかける
-            px = pxfilter(frame.position.x(), frame.frame)
-            py = pyfilter(frame.position.y(), frame.frame)
-            pz = pzfilter(frame.position.z(), frame.frame)
-            frame.position = QVector3D(px, py, pz)
-
-            rotation = frame.rotation
-
-            # 同じ回転を表すクォータニオンが正負2通りあるので、wの符号が正のほうに統一する
-            # if rotation.scalar() < 0:
-            #     rotation.setX(rotation.x() * -1)
-            #     rotation.setY(rotation.y() * -1)
-            #     rotation.setZ(rotation.z() * -1)
-            #     rotation.setScalar(rotation.scalar() * -1)
-            
-            if key != "センター" and key != "グルーブ":
-                # XYZそれぞれにフィルターをかける(オイラー角)
-                r = rotation.toEulerAngles()
-                rx = rxfilter(r.x(), frame.frame)
-                ry = ryfilter(r.y(), frame.frame)
-                rz = rzfilter(r.z(), frame.frame)
-                # rw = rwfilter(rotation.scalar(), frame.frame)
-
-                # クォータニオンに戻して保持
-                frame.rotation = QQuaternion.fromEulerAngles(rx, ry, rz)
-    
+    # 同じフレーム並びのボーンをまとめて、全ボーン・全チャンネルに1回でフィルターをかける
+    frame_groups = {}
+    for key, track in bone_frame_dic.items():
+        if key == "グルーブ" and is_groove == False:
+            continue
+
+        if len(track) == 0:
+            continue
+
+        frame_groups.setdefault(track.frames.tobytes(), []).append(key)
+
+    for bone_names in frame_groups.values():
+        smooth_filter_bones(bone_frame_dic, bone_names)
+
+# 同じフレーム並びのボーンにまとめてフィルターをかける
+def smooth_filter_bones(bone_frame_dic, bone_names):
+    tracks = [bone_frame_dic[key] for key in bone_names]
+    frames = tracks[0].frames
+    frame_count = len(frames)
+
+    # IKの場合、次のフレームと全く同値のフレームにはフィルタをかけない(位置と回転が同じ場合、同値とみなす)
+    is_skips = np.zeros((frame_count, len(tracks)), dtype=np.bool_)
+    for n, (key, track) in enumerate(zip(bone_names, tracks)):
+        if "ＩＫ" in key:
+            is_skips[:-1, n] = (track.frames[:-1] < frame_count - 1) \
+                & np.all(track.positions[:-1] == track.positions[1:], axis=1) \
+                & np.all(track.rotations[:-1] == track.rotations[1:], axis=1)
+            logger.debug("IK同値: %s %s", key, np.count_nonzero(is_skips[:, n]))
+
+    # 移動用フィルタ(XYZそれぞれにフィルターをかける)
+    move_filter = pos2vmd_filter_preset.load_filter_preset("move").compile(bone_names, 3)
+    positions = move_filter(np.concatenate([track.positions for track in tracks], axis=1), frames, np.repeat(is_skips, 3, axis=1))
+
+    for n, track in enumerate(tracks):
+        track.positions = positions[:, n*3:(n+1)*3].copy()
+
+    # センター・グルーブ以外は回転にもフィルターをかける(オイラー角)
+    rotation_idxs = [n for n, key in enumerate(bone_names) if key != "センター" and key != "グルーブ"]
+    if len(rotation_idxs) == 0:
+        return
+
+    # 回転用フィルタ(XYZそれぞれにフィルターをかける(オイラー角))
+    rotation_filter = pos2vmd_filter_preset.load_filter_preset("qq").compile([bone_names[n] for n in rotation_idxs], 3)
+    eulers = rotation_filter(np.concatenate([tracks[n].eulers for n in rotation_idxs], axis=1), frames, np.repeat(is_skips[:, rotation_idxs], 3, axis=1))
+
+    for m, n in enumerate(rotation_idxs):
+        # クォータニオンに戻して保持
+        tracks[n].set_eulers(eulers[:, m*3:(m+1)*3], is_skips[:, n] == False)
 
 
 # IKを滑らかにする
@@ -109,20 +88,22 @@ def smooth_angle(bone_frame_dic, smooth_times):
 def smooth_angle_bone(bone_frame_dic, smooth_times, target_bones):
     # 関節の角度円滑化
     for bone_name in target_bones:
+        track = bone_frame_dic[bone_name]
+        if len(track) == 0:
+            continue
+
+        # 前のフレームの補正結果を使って次のフレームを補正するので、1フレームずつ順番に計算する
+        rotations = [QQuaternion(w, x, y, z) for w, x, y, z in track.rotations.tolist()]
+
         for n in range(smooth_times):
-            for frame in range(len(bone_frame_dic[bone_name])):
-                if frame >= 2:
-                    prev2_bf = bone_frame_dic[bone_name][frame - 2]
-                    prev1_bf = bone_frame_dic[bone_name][frame - 1]
-                    now_bf = bone_frame_dic[bone_name][frame]
-
-                    if prev2_bf != now_bf.rotation:
-                        # 角度が違っていたら、球形補正開始
-                        euler = QQuaternion.slerp(prev2_bf.rotation, now_bf.rotation, 0.5).toEulerAngles()
-                        euler.setX(0 if np.isnan(euler.x()) else euler.x())
-                        euler.setY(0 if np.isnan(euler.x()) else euler.y())
-                        euler.setZ(0 if np.isnan(euler.x()) else euler.z())
-                        prev1_bf.rotation = QQuaternion.fromEulerAngles(euler)
+            for frame in range(2, len(rotations)):
+                # 球形補正
+                euler = QQuaternion.slerp(rotations[frame - 2], rotations[frame], 0.5).toEulerAngles()
+                if np.isnan(euler.x()):
+                    euler.setX(0)
+                rotations[frame - 1] = QQuaternion.fromEulerAngles(euler)
+
+        track.rotations = np.array([(q.scalar(), q.x(), q.y(), q.z()) for q in rotations], dtype=np.float64)
 
 def smooth_move(bone_frame_dic, is_groove, smooth_times):
     # センターを滑らかに
@@ -135,28 +116,23 @@ def smooth_move(bone_frame_dic, is_groove, smooth_times):
 def smooth_move_bone(bone_frame_dic, smooth_times, target_bones):
     # 移動の位置円滑化
     for bone_name in target_bones:
+        # 前のフレームの補正結果を使って次のフレームを補正するので、1フレームずつ順番に計算する
+        positions = bone_frame_dic[bone_name].positions
+        frame_count = len(positions)
+
         for n in range(smooth_times):
-            for frame in range(len(bone_frame_dic[bone_name])):
-                if 2 <= frame <= len(bone_frame_dic[bone_name]) - 1:
-                    prev2_bf = bone_frame_dic[bone_name][frame - 2]
-                    prev1_bf = bone_frame_dic[bone_name][frame - 1]
-                    now_bf = bone_frame_dic[bone_name][frame]
-
-                    # 移動ボーンのどこかが動いていたら
-                    if now_bf != prev2_bf:
-                        if 3 <= frame <= len(bone_frame_dic[bone_name]) - 2:
-                            # 5F取れるようであれば、5F
-                            prev3_bf = bone_frame_dic[bone_name][frame - 3]
-                            next_bf = bone_frame_dic[bone_name][frame + 1]
-                        else:
-                            # 取れないようであれば、3Fで採用
-                            prev3_bf = prev2_bf
-                            next_bf = now_bf
-
-                        # 線形補正(prev1自身は含めず、突飛な値を落とす)
-                        new_prev1_pos = prev2_bf.position + now_bf.position + prev3_bf.position + next_bf.position
-                        new_prev1_pos /= 4
-                        prev1_bf.position = new_prev1_pos
+            for frame in range(2, frame_count):
+                if 3 <= frame <= frame_count - 2:
+                    # 5F取れるようであれば、5F
+                    prev3_frame = frame - 3
+                    next_frame = frame + 1
+                else:
+                    # 取れないようであれば、3Fで採用
+                    prev3_frame = frame - 2
+                    next_frame = frame
+
+                # 線形補正(prev1自身は含めず、突飛な値を落とす)
+                positions[frame - 1] = (positions[frame - 2] + positions[frame] + positions[prev3_frame] + positions[next_frame]) / 4
 
 
 
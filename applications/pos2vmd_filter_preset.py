@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_filter_preset.py - OneEuroFilter の設定(プリセット)と複数チャンネル一括のフィルター
+#
+# filter/config_{プリセット名}.json を読み込んで(パスと更新日時で)覚えておき、
+# ボーン名の並びごとに、全ボーン・全チャンネル分のパラメータを配列にしたフィルターを作る(作ったものは使い回す)
+# フィルターは (フレーム数, チャンネル数) の値を1フレームずつ、全チャンネルまとめて OneEuroFilter と同じ計算で処理する
+# (チャンネルごとに独立した状態を持つので、ボーンをまたいで前のボーンの値を引き継がない)
+#
+# config_{プリセット名}.json の形式(bones は省略可。値はスカラーか、チャンネルごとのリスト [x, y, z])
+#   { "freq": 30, "mincutoff": 1.0, "beta": 0.0, "dcutoff": 1.0,
+#     "bones": { "ボーン名": {"mincutoff": [x, y, z], "beta": 0.5}, ... } }
+
+import os
+import json
+import math
+import logging
+import threading
+import numpy as np
+from os.path import dirname, realpath
+
+from applications import pos2vmd_cache
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# フィルター設定のディレクトリ(カレントディレクトリによらず、プロジェクトの filter/ を読む)
+FILTER_DIR = os.path.join(realpath(dirname(realpath(__file__)) + '/..'), "filter")
+
+# OneEuroFilter のパラメータ名と既定値
+PARAM_DEFAULTS = {"freq": 30, "mincutoff": 1.0, "beta": 0.0, "dcutoff": 1.0}
+
+
+# 複数チャンネル一括の OneEuroFilter
+# パラメータはチャンネルごとの配列 (チャンネル数,)
+class BatchOneEuroFilter():
+    def __init__(self, freqs, mincutoffs, betas, dcutoffs):
+        self.freqs = np.asarray(freqs, dtype=np.float64)
+        self.mincutoffs = np.asarray(mincutoffs, dtype=np.float64)
+        self.betas = np.asarray(betas, dtype=np.float64)
+        self.dcutoffs = np.asarray(dcutoffs, dtype=np.float64)
+
+        if np.any(self.freqs <= 0):
+            raise ValueError("freq should be >0")
+        if np.any(self.mincutoffs <= 0):
+            raise ValueError("mincutoff should be >0")
+        if np.any(self.dcutoffs <= 0):
+            raise ValueError("dcutoff should be >0")
+
+    def __len__(self):
+        return len(self.freqs)
+
+    # values: 値 (フレーム数, チャンネル数)
+    # timestamps: 各フレームのタイムスタンプ (フレーム数,)
+    # skips: フィルターをかけないフレーム (フレーム数, チャンネル数)。その値で状態だけ更新する(OneEuroFilter.skip と同じ)
+    # フィルター結果 (フレーム数, チャンネル数) を返す。skips のフレームは元の値のまま
+    def __call__(self, values, timestamps, skips=None):
+        values = np.asarray(values, dtype=np.float64)
+        results = values.copy()
+
+        frame_num, channel_num = values.shape
+        if frame_num == 0:
+            return results
+
+        if skips is None:
+            skips = np.zeros(values.shape, dtype=np.bool_)
+        is_all_calls = np.any(skips, axis=1) == False
+
+        freqs = self.freqs.copy()
+
+        # 値の前回の入力と出力、状態があるか
+        x_ys = np.zeros(channel_num)
+        x_ss = np.zeros(channel_num)
+        x_inits = np.zeros(channel_num, dtype=np.bool_)
+        # 変化量の前回の出力、状態があるか
+        dx_ss = np.zeros(channel_num)
+        dx_inits = np.zeros(channel_num, dtype=np.bool_)
+
+        lasttime = None
+        for n, timestamp in enumerate(np.asarray(timestamps).tolist()):
+            # ---- update the sampling frequency based on timestamps
+            if lasttime and timestamp and lasttime != timestamp:
+                freqs[:] = 1.0 / (timestamp - lasttime)
+            lasttime = timestamp
+
+            x = values[n]
+            te = 1.0 / freqs
+
+            # ---- estimate the current variation per second
+            dx = np.where(x_inits, (x - x_ys) * freqs, 0.0)
+            alpha_ds = calc_alpha(te, self.dcutoffs)
+            edx = np.where(dx_inits, alpha_ds * dx + (1.0 - alpha_ds) * dx_ss, dx)
+            # ---- use it to update the cutoff frequency
+            cutoffs = self.mincutoffs + self.betas * np.abs(edx)
+            # ---- filter the given value
+            alphas = calc_alpha(te, cutoffs)
+            filtered = np.where(x_inits, alphas * x + (1.0 - alphas) * x_ss, x)
+
+            if is_all_calls[n]:
+                dx_ss = edx
+                dx_inits[:] = True
+                x_ss = filtered
+                results[n] = filtered
+            else:
+                # スキップするチャンネルは、変化量の状態を前回の値、値の状態を今回の値にする
+                is_skips = skips[n]
+                dx_ss = np.where(is_skips, x_ys, edx)
+                dx_inits = np.where(is_skips, x_inits, True)
+                x_ss = np.where(is_skips, x, filtered)
+                results[n] = x_ss
+
+            x_ys = x
+            x_inits[:] = True
+
+        return results
+
+
+# OneEuroFilter の平滑化係数
+def calc_alpha(te, cutoffs):
+    tau = 1.0 / (2 * math.pi * cutoffs)
+    return 1.0 / (1.0 + tau / te)
+
+
+# OneEuroFilter の設定
+class OneEuroPreset():
+    def __init__(self, name, config):
+        self.name = name
+        # 全体のパラメータ
+        self.params = {k: config.get(k, v) for k, v in PARAM_DEFAULTS.items()}
+        # ボーンごとの上書き
+        self.bones = config.get("bones", {})
+
+        # 作ったフィルターを覚えておく
+        self._filters = {}
+        self._lock = threading.Lock()
+
+    # ボーン・チャンネルのパラメータ
+    def get_param(self, param_name, bone_name=None, channel=0):
+        value = self.bones.get(bone_name, {}).get(param_name, self.params[param_name])
+        if isinstance(value, (list, tuple)):
+            return value[channel]
+
+        return value
+
+    # ボーン名の並び × チャンネル数のフィルターを作る(ボーンごとにチャンネルが並ぶ)
+    # ボーン名を指定しない場合は、全体のパラメータだけのフィルター
+    def compile(self, bone_names=None, channel_num=1):
+        bone_names = [None] if bone_names is None else list(bone_names)
+        key = (tuple(bone_names), channel_num)
+
+        with self._lock:
+            dfilter = self._filters.get(key)
+            if dfilter is not None:
+                return dfilter
+
+        params = {k: [self.get_param(k, b, c) for b in bone_names for c in range(channel_num)] for k in PARAM_DEFAULTS.keys()}
+        dfilter = BatchOneEuroFilter(params["freq"], params["mincutoff"], params["beta"], params["dcutoff"])
+
+        with self._lock:
+            self._filters[key] = dfilter
+
+        return dfilter
+
+
+# フィルター設定ファイルのパス
+def get_filter_preset_path(name):
+    return os.path.join(FILTER_DIR, "config_{0}.json".format(name))
+
+
+# フィルター設定ファイル(config_{name}.json)を読み込む
+def read_filter_preset(config_file):
+    name = os.path.splitext(os.path.basename(config_file))[0].replace("config_", "", 1)
+
+    with open(config_file, "r") as f:
+        preset = OneEuroPreset(name, json.load(f))
+
+    logger.debug("フィルター設定読み込み: %s %s", config_file, preset.params)
+
+    return preset
+
+
+# フィルター設定(filter/config_{name}.json)を取得する
+# 読み込んだ設定はパスと更新日時で覚えておき、ファイルが変わっていなければ読み直さない
+def load_filter_preset(name):
+    return pos2vmd_cache.load_by_mtime(get_filter_preset_path(name), read_filter_preset)
+
+
+# 覚えているフィルター設定を破棄する
+def clear_filter_preset_cache():
+    pos2vmd_cache.clear_mtime_cache(read_filter_preset)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_fk.py - 全フレーム一括の順運動学(FK)
+#
+# 親から子へ並んだボーンの連鎖について、ボーンごとのローカル位置(親からの移動量)と回転を
+# (フレーム数, ボーン数, 3) / (フレーム数, ボーン数, 4) の配列で受け取り、
+# 全フレーム分の各ボーンのグローバル位置を、4x4行列の積でまとめて求める
+#
+# 各ボーンの行列は QMatrix4x4 に translate(ローカル位置) → rotate(回転) したものと同じで、
+# ボーンの位置は 親までの行列の積 * QVector4D(ローカル位置, 1) と同じになる
+
+import logging
+import numpy as np
+
+from applications import pos2vmd_math
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# 足IKの計算に使うボーンの連鎖({0}には左右が入る)
+LEG_CHAIN_BONE_NAMES = ["センター", "下半身", "{0}足", "{0}ひざ", "{0}足首", "{0}つま先"]
+# 足の連鎖の各ボーンのINDEX
+LEG_CHAIN_CENTER = 0
+LEG_CHAIN_LOWER_BODY = 1
+LEG_CHAIN_LEG = 2
+LEG_CHAIN_KNEE = 3
+LEG_CHAIN_ANKLE = 4
+LEG_CHAIN_TOES = 5
+
+
+# ボーンの連鎖の全フレーム分のグローバル位置 (..., ボーン数, 3)
+# translations: 各ボーンの親からのローカル位置 (..., ボーン数, 3)
+# rotations: 各ボーンの回転 (..., ボーン数, 4)
+def calc_fk_positions(translations, rotations):
+    translations = np.asarray(translations, dtype=np.float64)
+    rotations = np.asarray(rotations, dtype=np.float64)
+
+    # 全フレーム・全ボーンの行列をまとめて作る (..., ボーン数, 4, 4)
+    matrices = pos2vmd_math.translation_rotation_matrix(translations, rotations)
+
+    # 連鎖の根元から順に、親までの行列の積を全フレーム分まとめて掛けていく
+    bone_num = matrices.shape[-3]
+    globals_ = np.empty(matrices.shape)
+    globals_[..., 0, :, :] = matrices[..., 0, :, :]
+    for n in range(1, bone_num):
+        globals_[..., n, :, :] = np.einsum("...ij,...jk->...ik", globals_[..., n - 1, :, :], matrices[..., n, :, :])
+
+    # 各ボーンの位置は、そのボーンまでの行列の移動成分
+    return globals_[..., :3, 3]
+
+
+# ボーンモデル上の位置から、連鎖の各ボーンの親からのローカル位置 (ボーン数, 3) を求める
+# 先頭のボーンは root_position からの位置とする
+def calc_bone_translations(bone_positions, root_position=None):
+    bone_positions = np.asarray(bone_positions, dtype=np.float64)
+
+    translations = np.empty(bone_positions.shape)
+    translations[0] = bone_positions[0] if root_position is None else bone_positions[0] - root_position
+    translations[1:] = bone_positions[1:] - bone_positions[:-1]
+
+    return translations
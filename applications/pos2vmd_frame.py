@@ -1,605 +1,451 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 #
-from PyQt5.QtGui import QQuaternion, QVector4D, QVector3D, QMatrix4x4
+from applications.pos2vmd_qt import QQuaternion, QVector3D
 import logging
 
-from applications.VmdWriter import VmdBoneFrame
-from applications.VmdReader import VmdReader, VmdMotion
-import math
+from applications import pos2vmd_math
+from applications import pos2vmd_rom
+from applications import pos2vmd_skeleton
+import collections
+import numpy as np
 
 logger = logging.getLogger("__main__").getChild(__name__)
 
-
-# 3D推定位置から関節角度生成
-def position_to_frame(bone_frame_dic, pos, pos_gan, smoothed_2d, frame, is_upper2_body, slope_motion):
-    logger.debug("角度計算 frame={0}".format(str(frame)))
+# 関節位置の骨格定義と、関節名からINDEXへの対応
+SKELETON = pos2vmd_skeleton.H36M
+J = SKELETON.joints
+
+# 関節角度を求めるボーン(関節角度の配列 (フレーム数, ボーン数, 4) の並び)
+ROTATION_BONE_NAMES = ["上半身", "上半身2", "下半身", "首", "頭", "左肩", "左腕", "左ひじ", "右肩", "右腕", "右ひじ", \
+                       "左足", "左ひざ", "右足", "右ひざ"]
+
+# 全フレーム分の関節角度の候補
+# rotations, positions: 3d-pose-baseline の体幹で計算した関節角度と、補正後の関節位置
+# gan_rotations, gan_positions: 3dpose-gan の体幹で計算した関節角度と、補正後の関節位置(3dpose-ganがない場合はNone)
+# gan_trunk_eulers: 3dpose-gan の上半身・上半身2・下半身のオイラー角 (フレーム数, 3, 3)(3dpose-ganがない場合はNone)
+FrameCandidates = collections.namedtuple("FrameCandidates", ["rotations", "positions", "gan_rotations", "gan_positions", "gan_trunk_eulers"])
+
+# 全フレーム分の関節角度をまとめて計算する(フレーム単位のループなし)
+# positions は (フレーム数, 17, 3) の配列で、関節位置の補正を直接書き込む
+# rom_table: 関節可動域(指定がない場合は rom/config_rom.json)
+def positions_to_frames(bone_frame_dic, positions, is_upper2_body, slope_motion, positions_gan=None, rom_table=None):
+    candidates = calc_frame_candidates(positions, positions_gan, is_upper2_body, slope_motion, rom_table)
+    set_candidate_frames(bone_frame_dic, positions, candidates)
+
+# 全フレーム分の関節角度の候補を求める
+# 3dpose-gan がある場合は、3dpose-gan の体幹で計算した候補も作っておく(どちらを採用するかは resolve_gan_frames で決める)
+# フレーム同士の依存はないので、フレームを分割して計算してから concat_frame_candidates で繋げても同じ結果になる
+def calc_frame_candidates(pos, pos_gan, is_upper2_body, slope_motion, rom_table=None):
+    if rom_table is None:
+        rom_table = pos2vmd_rom.load_rom_table()
 
     # 上半身の方向の安定化のため脊椎を20mm後ろへ動かす(LSld, RSld, Hipでできる平面の垂直方向へ動かす)
-    up = QVector3D.crossProduct((pos[0] - pos[14]), (pos[14] - pos[11])).normalized()
-    pos[7] += up * 20
-
-    # 体幹の回転
-    upper_body_rotation1, upper_body_rotation2, upper_correctqq, lower_body_rotation, lower_correctqq, is_gan \
-        = position_to_frame_trunk(bone_frame_dic, frame, pos, pos_gan, is_upper2_body, slope_motion)
-
-    # 上半身
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x8f\xe3\x94\xbc\x90\x67' # '上半身'
-    bf.rotation = upper_body_rotation1
-    bone_frame_dic["上半身"].append(bf)
-
-    # 上半身2(角度がある場合のみ登録)
-    if upper_body_rotation2 != QQuaternion():
-        bf = VmdBoneFrame(frame)
-        bf.name = b'\x8f\xe3\x94\xbc\x90\x67\x32' # '上半身2'
-        bf.rotation = upper_body_rotation2
-        bone_frame_dic["上半身2"].append(bf)
-
-    # 下半身
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x89\xba\x94\xbc\x90\x67' # '下半身'
-    bf.rotation = lower_body_rotation
-    bone_frame_dic["下半身"].append(bf)
+    pos[:, J["Spine"]] += calc_trunk_normals(pos) * 20
+
+    # 3d-pose-baseline による体幹の回転
+    trunk = calc_trunk_rotations(pos, is_upper2_body, slope_motion, rom_table)
 
     # 頭の方向の安定化のためNeck/NoseとHeadを少し後ろへ動かす(LSld, RSld, Hipでできる平面の垂直方向へ動かす)
-    up = QVector3D.crossProduct((pos[0] - pos[14]), (pos[14] - pos[11])).normalized()
-    pos[9] += up * 100
-    pos[10] += up * 100
-
-    neck_rotation, head_rotation = \
-        position_to_frame_head(frame, pos, pos_gan, upper_body_rotation1, upper_body_rotation2, upper_correctqq, is_gan, slope_motion)
-
-    # 首
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x8e\xf1' # '首'
-    bf.rotation = neck_rotation
-    bone_frame_dic["首"].append(bf)
-
-    # 頭
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x93\xaa' # '頭'
-    bf.rotation = head_rotation
-    bone_frame_dic["頭"].append(bf)
-
-    # 左肩の初期値
-    gan_left_shoulder_initial_orientation = QQuaternion.fromDirection(QVector3D(1, 0, 0), QVector3D(0, 1, 0))
-    left_shoulder_initial_orientation = QQuaternion.fromDirection(QVector3D(2, -0.8, 0), QVector3D(0.5, -0.5, -1))
-    left_arm_initial_orientation = QQuaternion.fromDirection(QVector3D(1.73, -1, 0), QVector3D(1, 1.73, 0))
-
-    # 左手系の回転
-    left_shoulder_rotation, left_arm_rotation, left_elbow_rotation = \
-        position_to_frame_arm_one_side(frame, pos, pos_gan, upper_correctqq, upper_body_rotation1, upper_body_rotation2, gan_left_shoulder_initial_orientation, left_shoulder_initial_orientation, left_arm_initial_orientation, LEFT_POINT, is_gan, slope_motion, "左")
-
-    # 左肩
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x8d\xb6\x8C\xA8' # '左肩'
-    bf.rotation = left_shoulder_rotation
-    bone_frame_dic["左肩"].append(bf)
-    
-    # 左腕
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x8d\xb6\x98\x72' # '左腕'
-    bf.rotation = left_arm_rotation
-    bone_frame_dic["左腕"].append(bf)
-    
-    # 左ひじ
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x8d\xb6\x82\xd0\x82\xb6' # '左ひじ'
-    bf.rotation = left_elbow_rotation
-    bone_frame_dic["左ひじ"].append(bf)
-    
-    # 右肩の初期値
-    gan_right_shoulder_initial_orientation = QQuaternion.fromDirection(QVector3D(-1, 0, 0), QVector3D(0, -1, 0))
-    right_shoulder_initial_orientation = QQuaternion.fromDirection(QVector3D(-2, -0.8, 0), QVector3D(0.5, 0.5, 1))
-    right_arm_initial_orientation = QQuaternion.fromDirection(QVector3D(-1.73, -1, 0), QVector3D(1, -1.73, 0))
-
-    # 右手系の回転
-    right_shoulder_rotation, right_arm_rotation, right_elbow_rotation = \
-        position_to_frame_arm_one_side(frame, pos, pos_gan, upper_correctqq, upper_body_rotation1, upper_body_rotation2, gan_right_shoulder_initial_orientation, right_shoulder_initial_orientation, right_arm_initial_orientation, RIGHT_POINT, is_gan, slope_motion, "右")
-    
-    # 右肩
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x89\x45\x8C\xA8' # '右肩'
-    bf.rotation = right_shoulder_rotation
-    bone_frame_dic["右肩"].append(bf)
-    
-    # 右腕
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x89\x45\x98\x72' # '右腕'
-    bf.rotation = right_arm_rotation
-    bone_frame_dic["右腕"].append(bf)
-    
-    # 右ひじ
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x89\x45\x82\xd0\x82\xb6' # '右ひじ'
-    bf.rotation = right_elbow_rotation
-    bone_frame_dic["右ひじ"].append(bf)
-
-    # 左足と左ひざの回転
-    left_leg_rotation, left_knee_rotation = \
-        position_to_frame_leg_one_side(frame, pos, pos_gan, lower_correctqq, lower_body_rotation, LEFT_POINT, ["左足", "左ひざ"], is_gan, slope_motion, "左")
+    pos[:, SKELETON.index(["Neck/Nose", "Head"])] += calc_trunk_normals(pos)[:, np.newaxis] * 100
+
+    if pos_gan is None:
+        rotations = calc_bone_rotations(pos, None, trunk, False, slope_motion, rom_table)
+        return FrameCandidates(rotations, pos, None, None, None)
+
+    # 3dpose-gan による体幹の回転
+    gan_trunk = calc_gan_trunk_rotations(pos_gan, is_upper2_body)
+
+    # 膝の位置補正は採用した足の回転によって変わるので、候補ごとに関節位置を持つ
+    gan_pos = pos.copy()
+
+    rotations = calc_bone_rotations(pos, pos_gan, trunk, False, slope_motion, rom_table)
+    gan_rotations = calc_bone_rotations(gan_pos, pos_gan, gan_trunk, True, slope_motion, rom_table)
+
+    # 3dpose-gan の体幹のオイラー角は、採用候補の判定と前フレームとの比較の両方で使う
+    return FrameCandidates(rotations, pos, gan_rotations, gan_pos, pos2vmd_math.to_euler_angles(gan_rotations[:, :3]))
+
+# LSld, RSld, Hipでできる平面の法線(全フレーム分)
+def calc_trunk_normals(pos):
+    rshoulder = pos[:, J["RShoulder"]]
+    return pos2vmd_math.normalized(pos2vmd_math.cross_product(pos[:, J["Hip"]] - rshoulder, rshoulder - pos[:, J["LShoulder"]]))
+
+# 分割して計算した候補を繋げる
+def concat_frame_candidates(candidates_list):
+    def concat(field):
+        values = [getattr(c, field) for c in candidates_list]
+        if any(v is None for v in values):
+            return None
+        return np.concatenate(values)
+
+    return FrameCandidates(*[concat(field) for field in FrameCandidates._fields])
+
+# 候補から採用する関節角度を決めて、キーフレームとして登録する
+# positions には採用した候補の補正後の関節位置を書き戻す
+def set_candidate_frames(bone_frame_dic, positions, candidates):
+    rotations = candidates.rotations
+    chosen_positions = candidates.positions
+
+    if candidates.gan_rotations is not None:
+        is_gans = resolve_gan_frames(candidates)
+        logger.debug("gan採用: %s", np.flatnonzero(is_gans))
+
+        rotations = np.where(is_gans[:, np.newaxis, np.newaxis], candidates.gan_rotations, rotations)
+        chosen_positions = np.where(is_gans[:, np.newaxis, np.newaxis], candidates.gan_positions, chosen_positions)
+
+    if chosen_positions is not positions:
+        positions[:] = chosen_positions
+
+    frame_num = rotations.shape[0]
+
+    for n, bone_name in enumerate(ROTATION_BONE_NAMES):
+        if bone_name == "上半身2":
+            # 上半身2は角度がある場合のみ登録
+            set_rotation_frames(bone_frame_dic, bone_name, rotations[:, n], pos2vmd_math.is_identity(rotations[:, n]) == False)
+        else:
+            set_rotation_frames(bone_frame_dic, bone_name, rotations[:, n])
+
+    # センター・グルーブ・足ＩＫ(箱だけ作る)
+    for bone_name in ["センター", "グルーブ", "左足ＩＫ", "右足ＩＫ"]:
+        bone_frame_dic[bone_name].set_frames(np.arange(frame_num))
+
+# 3dpose-gan の体幹を採用するフレームを決める
+# 前フレームで採用した体幹との差が angle 度以内の場合のみ採用する
+# 前フレームの結果に依存するので先頭から順に判定するが、オイラー角は先にまとめて求めておく
+def resolve_gan_frames(candidates, angle=45):
+    # 上半身・上半身2・下半身のオイラー角 (フレーム数, 3, 3)
+    eulers = pos2vmd_math.to_euler_angles(candidates.rotations[:, :3]).tolist()
+    gan_eulers = candidates.gan_trunk_eulers.tolist()
+    # 上半身2を登録するか
+    is_upper2s = (pos2vmd_math.is_identity(candidates.rotations[:, 1]) == False).tolist()
+    gan_is_upper2s = (pos2vmd_math.is_identity(candidates.gan_rotations[:, 1]) == False).tolist()
+    is_gan_trunks = is_gan_trunk_frames(candidates.gan_trunk_eulers).tolist()
+
+    frame_num = len(eulers)
+    is_gans = np.zeros(frame_num, dtype=np.bool_)
+
+    prev_euler = None
+    # これまで全フレームで上半身2を登録しているか(上半身2のキーフレームのINDEXがフレーム番号と一致しているか)
+    is_upper2_all = True
+
+    for frame in range(frame_num):
+        if is_gan_trunks[frame]:
+            if frame == 0:
+                # 最初は問答無用でOK
+                is_gans[frame] = True
+            else:
+                # 上半身2は、1F前のキーフレームが1F前のフレームを指している場合のみチェックする
+                bone_idxs = [0, 1, 2] if is_upper2_all else [0, 2]
+                is_gans[frame] = is_smoothed_prev_euler(prev_euler, gan_eulers[frame], bone_idxs, angle)
+
+        if is_gans[frame]:
+            prev_euler = gan_eulers[frame]
+            is_upper2_all = is_upper2_all and gan_is_upper2s[frame]
+        else:
+            prev_euler = eulers[frame]
+            is_upper2_all = is_upper2_all and is_upper2s[frame]
+
+    return is_gans
+
+# 1F前のオイラー角との差分が angle 度以内か
+def is_smoothed_prev_euler(prev_euler, now_euler, bone_idxs, angle):
+    for n in bone_idxs:
+        for prev_degree, now_degree in zip(prev_euler[n], now_euler[n]):
+            if abs(prev_degree - now_degree) > angle:
+                return False
 
-    # 膝がまっすぐのときつま先が不自然に回転することがあり、対策のため膝を20mmから100mm前へ移動する
-    leg_v = left_leg_rotation.toVector4D()
-    leg_x = leg_v.x()
-    leg_y = leg_v.y()
-    leg_z = leg_v.z()
-    leg_w = leg_v.w()
-    m20 = 2.0 * leg_x * leg_z + 2.0 * leg_w * leg_y
-    m22 = 1.0 - 2.0 * leg_x * leg_x - 2.0 * leg_y * leg_y
-    ty = -math.degrees(math.atan2(m20, m22)) # 左脚の角度y
-    # RHip, LHip, LFootでできる平面の垂直方向へ移動
-    up = QVector3D.crossProduct((pos[6] - pos[4]), (pos[4] - pos[1])).normalized()
-    # 左足の回転が大きいほど膝の移動量を増やす(20mmから100mm)
-    pos[5] -= up * (20 + 80 * abs(ty) / 180.0)
-
-    # 左足と左ひざの回転の再計算
-    left_leg_rotation, left_knee_rotation = \
-        position_to_frame_leg_one_side(frame, pos, pos_gan, lower_correctqq, lower_body_rotation, LEFT_POINT, ["左足", "左ひざ"], is_gan, slope_motion, "左")
-
-    # 左足
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x8d\xb6\x91\xab' # '左足'
-    bf.rotation = left_leg_rotation
-    bone_frame_dic["左足"].append(bf)
-    
-    # 左ひざ
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x8d\xb6\x82\xd0\x82\xb4' # '左ひざ'
-    bf.rotation = left_knee_rotation
-    bone_frame_dic["左ひざ"].append(bf)
-
-    # 右足と右ひざの回転
-    right_leg_rotation, right_knee_rotation = \
-        position_to_frame_leg_one_side(frame, pos, pos_gan, lower_correctqq, lower_body_rotation, RIGHT_POINT, ["右足", "右ひざ"], is_gan, slope_motion, "右")
+    return True
 
-    # 膝がまっすぐのときつま先が不自然に回転することがあり、対策のため膝を20mmから100mm前へ移動する
-    leg_v = right_leg_rotation.toVector4D()
-    leg_x = leg_v.x()
-    leg_y = leg_v.y()
-    leg_z = leg_v.z()
-    leg_w = leg_v.w()
-    m20 = 2.0 * leg_x * leg_z + 2.0 * leg_w * leg_y
-    m22 = 1.0 - 2.0 * leg_x * leg_x - 2.0 * leg_y * leg_y
-    # 右足の角度y
-    ty = -math.degrees(math.atan2(m20, m22))
-    # LHip, RHip, RFootでできる平面の垂直方向へ移動
-    up = QVector3D.crossProduct((pos[3] - pos[1]), (pos[1] - pos[4])).normalized()
-    # 右足の回転が大きいほど膝の移動量を増やす(20mmから100mm)
-    pos[2] += up * (20 + 80 * abs(ty) / 180.0)
-
-    # 右足と右ひざの回転の再計算
-    right_leg_rotation, right_knee_rotation = \
-        position_to_frame_leg_one_side(frame, pos, pos_gan, lower_correctqq, lower_body_rotation, RIGHT_POINT, ["右足", "右ひざ"], is_gan, slope_motion, "右")
-
-    # 右足
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x89\x45\x91\xab' # '右足'
-    bf.rotation = right_leg_rotation
-    bone_frame_dic["右足"].append(bf)
-    
-    # 右ひざ
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x89\x45\x82\xd0\x82\xb4' # '右ひざ'
-    bf.rotation = right_knee_rotation
-    bone_frame_dic["右ひざ"].append(bf)
-        
-    # センター(箱だけ作る)
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x83\x5A\x83\x93\x83\x5E\x81\x5B' # 'センター'
-    bone_frame_dic["センター"].append(bf)
-
-    # グルーブ(箱だけ作る)
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x83\x4F\x83\x8B\x81\x5B\x83\x75' # 'グルーブ'
-    bone_frame_dic["グルーブ"].append(bf)
-
-    # 左足ＩＫ
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x8d\xb6\x91\xab\x82\x68\x82\x6a' # '左足ＩＫ'
-    bone_frame_dic["左足ＩＫ"].append(bf)
-
-    # 右足ＩＫ
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x89\x45\x91\xab\x82\x68\x82\x6a' # '右足ＩＫ'
-    bone_frame_dic["右足ＩＫ"].append(bf)
-
-# 右系のpos point
-RIGHT_POINT = {
-    'Hip': 1,
-    'Knee': 2,
-    'Foot': 3,
-    'Thorax': 8,
-    'Shoulder': 14,
-    'Elbow': 15,
-    'Wrist': 16,
-    'AnotherShoulder': 11
-}
-# 左系のpos point
-LEFT_POINT = {
-    'Hip': 4,
-    'Knee': 5,
-    'Foot': 6,
-    'Thorax': 8,
-    'Shoulder': 11,
-    'Elbow': 12,
-    'Wrist': 13,
-    'AnotherShoulder': 14
-}
-
-def position_to_frame_head(frame, pos, pos_gan, upper_body_rotation1, upper_body_rotation2, upper_correctqq, is_gan, slope_motion):
-    if is_gan: 
-        # 体幹が3dpose-ganで決定されている場合
+# 3dpose-gan の体幹が採用候補となるフレーム
+# 上半身・下半身のオイラー角回転がどれか45度以上の場合(体幹はY軸回転は見ない)
+def is_gan_trunk_frames(gan_trunk_eulers):
+    return np.any(np.abs(gan_trunk_eulers[:, [0, 2]][:, :, [0, 2]]) > 45, axis=(1, 2))
 
-        # 首
-        direction = pos[9] - pos[8]
-        up = QVector3D.crossProduct((pos[14] - pos[11]), direction).normalized()
-        neck_orientation = QQuaternion.fromDirection(up, direction)
-        initial_orientation = QQuaternion.fromDirection(QVector3D(0, 0, -1), QVector3D(0, 1, 0))
-        rotation = neck_orientation * initial_orientation.inverted()
-        neck_rotation = upper_body_rotation2.inverted() * upper_body_rotation1.inverted() * rotation
+# 3d-pose-baseline による体幹の回転(全フレーム分)
+# 体幹は他のボーンの親になるので、先に可動域内に収めておく
+def calc_trunk_rotations(pos, is_upper2_body, slope_motion, rom_table):
+    upper_body_rotation1, upper_body_rotation2, upper_correctqq = calc_upper_rotations(pos, is_upper2_body, slope_motion)
+    lower_body_rotation, lower_correctqq = calc_lower_rotations(pos, slope_motion)
 
-        # 頭
-        direction = pos[10] - pos[9]
-        up = QVector3D.crossProduct((pos[14] - pos[11]), (pos[10] - pos[9]))
-        orientation = QQuaternion.fromDirection(direction, up)
-        initial_orientation = QQuaternion.fromDirection(QVector3D(0, 1, 0), QVector3D(0, 0, 0))
-        rotation = upper_correctqq * orientation * initial_orientation.inverted()
-        head_rotation = neck_rotation.inverted() * upper_body_rotation2.inverted() * upper_body_rotation1.inverted() * rotation
+    trunk_rotations = rom_table.clamp(np.stack([upper_body_rotation1, upper_body_rotation2, lower_body_rotation], axis=1), ["上半身", "上半身2", "下半身"])
+    upper_body_rotation1, upper_body_rotation2, lower_body_rotation = trunk_rotations[:, 0], trunk_rotations[:, 1], trunk_rotations[:, 2]
+
+    return upper_body_rotation1, upper_body_rotation2, upper_correctqq, lower_body_rotation, lower_correctqq
 
+# 3dpose-gan による体幹の回転(全フレーム分、傾き補正・可動域制限なし)
+def calc_gan_trunk_rotations(pos_gan, is_upper2_body):
+    upper_body_rotation1, upper_body_rotation2, upper_correctqq = calc_upper_rotations(pos_gan, is_upper2_body, None)
+    lower_body_rotation, lower_correctqq = calc_lower_rotations(pos_gan, None)
+
+    return upper_body_rotation1, upper_body_rotation2, upper_correctqq, lower_body_rotation, lower_correctqq
+
+# 体幹の回転から、体幹以外も含めた関節角度 (フレーム数, ボーン数, 4) を求める
+# is_gan の場合、体幹は3dpose-ganで決定されているものとして、頭・手・足も3dpose-ganを使う
+# 体幹以外のボーンは、最後にまとめて可動域内に収める
+def calc_bone_rotations(pos, pos_gan, trunk, is_gan, slope_motion, rom_table):
+    upper_body_rotation1, upper_body_rotation2, upper_correctqq, lower_body_rotation, lower_correctqq = trunk
+
+    neck_rotation, head_rotation = calc_head_rotations(pos, upper_body_rotation1, upper_body_rotation2, upper_correctqq, is_gan, slope_motion)
+
+    # 左手系・右手系の回転
+    if is_gan:
+        # 手(3dpose-gan採用)
+        identity = pos2vmd_math.identity(pos.shape[:1])
+        left_shoulder_rotation, left_arm_rotation, left_elbow_rotation = \
+            calc_arm_rotations(pos_gan, identity, upper_body_rotation1, upper_body_rotation2, QQuaternion.fromDirection(QVector3D(1, 0, 0), QVector3D(0, 1, 0)), QQuaternion.fromDirection(QVector3D(1.73, -1, 0), QVector3D(1, 1.73, 0)), None, "左")
+        right_shoulder_rotation, right_arm_rotation, right_elbow_rotation = \
+            calc_arm_rotations(pos_gan, identity, upper_body_rotation1, upper_body_rotation2, QQuaternion.fromDirection(QVector3D(-1, 0, 0), QVector3D(0, -1, 0)), QQuaternion.fromDirection(QVector3D(-1.73, -1, 0), QVector3D(1, -1.73, 0)), None, "右")
     else:
-        # 体幹が 3d-pose-baseline で決定されている場合
+        left_shoulder_rotation, left_arm_rotation, left_elbow_rotation = \
+            calc_arm_rotations(pos, upper_correctqq, upper_body_rotation1, upper_body_rotation2, QQuaternion.fromDirection(QVector3D(2, -0.8, 0), QVector3D(0.5, -0.5, -1)), QQuaternion.fromDirection(QVector3D(1.73, -1, 0), QVector3D(1, 1.73, 0)), slope_motion, "左")
+        right_shoulder_rotation, right_arm_rotation, right_elbow_rotation = \
+            calc_arm_rotations(pos, upper_correctqq, upper_body_rotation1, upper_body_rotation2, QQuaternion.fromDirection(QVector3D(-2, -0.8, 0), QVector3D(0.5, 0.5, 1)), QQuaternion.fromDirection(QVector3D(-1.73, -1, 0), QVector3D(1, -1.73, 0)), slope_motion, "右")
 
-        # 首
-        direction = (pos[9] - pos[8])
-        up = QVector3D.crossProduct(direction, (pos[14] - pos[11])).normalized()
-        neck_orientation = QQuaternion.fromDirection(direction, up)
-        initial_orientation = QQuaternion.fromDirection(QVector3D(0, 0, -1), QVector3D(0, 1, 0))
-        rotation = neck_orientation * initial_orientation.inverted()
-        neck_rotation = upper_body_rotation2.inverted() * upper_body_rotation1.inverted() * rotation
+    # 両足と両ひざの回転(膝の位置補正込み)
+    left_leg_rotation, left_knee_rotation, right_leg_rotation, right_knee_rotation = \
+        calc_legs_rotations(pos, pos_gan, lower_correctqq, lower_body_rotation, is_gan, slope_motion)
 
-        # 頭
-        direction = (pos[10] - pos[9])
-        up = QVector3D.crossProduct(direction, pos[8] - pos[7]).normalized()
-        head_orientation = QQuaternion.fromDirection(direction, up)
-        initial_orientation = QQuaternion.fromDirection(QVector3D(0, 0, 1), QVector3D(-1, 0, 0))
-        rotation = head_orientation * initial_orientation.inverted()
-        head_rotation = neck_rotation.inverted() * upper_body_rotation2.inverted() * upper_body_rotation1.inverted() * rotation
-
-    # 首の傾きデータ
-    neck_correctqq = QQuaternion()
-    if slope_motion is not None:
-        # Y軸の回転具合を求める
-        y_degree = (180 - abs(neck_rotation.toEulerAngles().y())) / 180
-
-        # 一旦オイラー角に変換して、角度のかかり具合を補正し、再度クォータニオンに変換する
-        neck_correctqq = QQuaternion.fromEulerAngles(slope_motion.frames["首"][0].rotation.toEulerAngles() * y_degree).inverted()
-    
-    neck_rotation = neck_correctqq * neck_rotation
-
-    # 頭の傾きデータ
-    head_correctqq = QQuaternion()
-    if slope_motion is not None:
-        # Y軸の回転具合を求める
-        y_degree = (180 - abs(head_rotation.toEulerAngles().y())) / 180
-
-        # 一旦オイラー角に変換して、角度のかかり具合を補正し、再度クォータニオンに変換する
-        head_correctqq = QQuaternion.fromEulerAngles(slope_motion.frames["頭"][0].rotation.toEulerAngles() * y_degree).inverted()
-    
-    head_rotation = head_correctqq * head_rotation
-
-    neck_rotation = calc_limited_rotation(neck_rotation, -60, 50, -50, 50, -40, 40)
-    head_rotation = calc_limited_rotation(head_rotation, -30, 20, -20, 20, -30, 30)
+    rotations = np.stack([upper_body_rotation1, upper_body_rotation2, lower_body_rotation, neck_rotation, head_rotation, \
+                          left_shoulder_rotation, left_arm_rotation, left_elbow_rotation, right_shoulder_rotation, right_arm_rotation, right_elbow_rotation, \
+                          left_leg_rotation, left_knee_rotation, right_leg_rotation, right_knee_rotation], axis=1)
 
-    return neck_rotation, head_rotation
+    # 体幹(先頭3ボーン)は calc_trunk_rotations で可動域内に収めているので除く
+    rotations[:, 3:] = rom_table.clamp(rotations[:, 3:], ROTATION_BONE_NAMES[3:])
 
-# 可動域を限定した回転
-# 参考: http://www.japanpt.or.jp/upload/jspt/obj/files/publiccomment/4_rom_20140612.pdf
-def calc_limited_rotation(rot, minx, maxx, miny, maxy, minz, maxz):
-    euler = rot.toEulerAngles()
-
-    if euler.x() < minx:
-        euler.setX(minx)
-    elif euler.x() > maxx:
-        euler.setX(maxx)
-    
-    if euler.y() < miny:
-        euler.setY(miny)
-    elif euler.y() > maxy:
-        euler.setY(maxy)
-
-    if euler.z() < minz:
-        euler.setZ(minz)
-    elif euler.z() > maxz:
-        euler.setZ(maxz)
-
-    return QQuaternion.fromEulerAngles(euler)
-
-def is_smoothed_prev_frame(bone_frame_dic, frame, bone_rotation_dic, angle):
-    # 最初は問答無用でOK
-    if frame == 0:
-        return True
-
-    for bone_name, bone_rotation in bone_rotation_dic.items():    
-        if len(bone_frame_dic[bone_name]) > frame-1:
-            # 1F前の回転との差分をチェックする
-            prev_euler = bone_frame_dic[bone_name][frame-1].rotation.toEulerAngles()
-            now_euler = bone_rotation.toEulerAngles()
-
-            if abs(prev_euler.x() - now_euler.x()) > angle \
-                or abs(prev_euler.y() - now_euler.y()) > angle \
-                or abs(prev_euler.z() - now_euler.z()) > angle :
-                return False
-    
-    return True
+    return rotations
 
-def position_to_frame_trunk(bone_frame_dic, frame, pos, pos_gan, is_upper2_body, slope_motion):
+# 全フレーム分の回転をキーフレームとして登録する
+# is_frames を指定した場合、Trueのフレームのみ登録する
+def set_rotation_frames(bone_frame_dic, bone_name, rotations, is_frames=None):
+    frames = np.arange(len(rotations))
 
-    if pos_gan is not None:
-        # 3dpose-gan による上半身FK
-        g_upper_body_rotation1, g_upper_body_rotation2, g_upper_correctqq \
-            = position_to_frame_upper_calc(frame, pos_gan, is_upper2_body, None)
-        # 3dpose-gan による下半身FK
-        g_lower_body_rotation, g_lower_correctqq \
-            = position_to_frame_lower_calc(frame, pos_gan, None)
-
-        # 前フレームとの差が45度以内で、オイラー角回転がどれか45度以上の場合、3dpose-gan採用
-        # 体幹はY軸回転は見ない
-        if is_smoothed_prev_frame(bone_frame_dic, frame, { "上半身":g_upper_body_rotation1, "上半身2": g_upper_body_rotation2, "下半身":g_lower_body_rotation }, 45) \
-            and (abs(g_upper_body_rotation1.toEulerAngles().x()) > 45 or abs(g_upper_body_rotation1.toEulerAngles().z()) > 45 \
-                or abs(g_lower_body_rotation.toEulerAngles().x()) > 45 or abs(g_lower_body_rotation.toEulerAngles().z()) > 45 ):
-
-            # # Zを反転させる
-            # g_upper_body_rotation1.setZ( g_upper_body_rotation1.z() * -1 )
-            # g_lower_body_rotation.setZ( g_lower_body_rotation.z() * -1 )
-            
-            logger.debug("gan採用: %s u1=%s u2=%s l=%s", frame, g_upper_body_rotation1, g_upper_body_rotation2, g_lower_body_rotation)
-
-            return g_upper_body_rotation1, g_upper_body_rotation2, g_upper_correctqq, g_lower_body_rotation, g_lower_correctqq, True
-
-    # 3d-pose-baseline による上半身FK
-    upper_body_rotation1, upper_body_rotation2, upper_correctqq \
-        = position_to_frame_upper_calc(frame, pos, is_upper2_body, slope_motion)
-        
-    # 3d-pose-baseline による下半身FK
-    lower_body_rotation, lower_correctqq \
-        = position_to_frame_lower_calc(frame, pos, slope_motion)
-    
-    upper_body_rotation1 = calc_limited_rotation(upper_body_rotation1, -30, 45, -180, 180, -60, 60)
-    upper_body_rotation2 = calc_limited_rotation(upper_body_rotation2, -20, 40, -180, 180, -50, 50)
-    lower_body_rotation = calc_limited_rotation(lower_body_rotation, -15, 125, -180, 180, -40, 40)
-
-    return upper_body_rotation1, upper_body_rotation2, upper_correctqq, lower_body_rotation, lower_correctqq, False
-
-
-# 上半身FK（実質計算用）
-def position_to_frame_upper_calc(frame, pos, is_upper2_body, slope_motion):
+    if is_frames is not None:
+        frames = frames[is_frames]
+        rotations = rotations[is_frames]
 
-    if is_upper2_body == True:
-        # 上半身2がある場合、分割して登録する
+    bone_frame_dic[bone_name].set_frames(frames, rotations=rotations)
 
-        # 上半身
-        direction = pos[7] - pos[0]
-        up = QVector3D.crossProduct(direction, (pos[14] - pos[11])).normalized()
-        upper_body_orientation = QQuaternion.fromDirection(direction, up)
-        initial = QQuaternion.fromDirection(QVector3D(0, 1, 0), QVector3D(0, 0, 1))
-        upper_body_rotation1 = upper_body_orientation * initial.inverted()
+# 傾き補正(全フレーム分)
+# 回転のY軸の回転具合に応じて、傾きモーションの角度のかかり具合を補正する
+# bone_name にボーン名のリストを指定した場合、rotations (..., ボーン数, 4) のボーンごとに補正する
+def calc_slope_corrections(slope_motion, bone_name, rotations):
+    if slope_motion is None:
+        return pos2vmd_math.identity(rotations.shape[:-1])
 
-        # 傾き補正
-        upper_correctqq = QQuaternion()
+    # Y軸の回転具合に応じて、傾きの角度のかかり具合を補正した逆回転(補正テーブルで全フレーム分まとめて求める)
+    return slope_motion.calc_corrections(bone_name, rotations)
 
-        # 傾きデータがある場合、補正をかける
-        if slope_motion is not None:
-            # Y軸の回転具合を求める
-            y_degree = (180 - abs(upper_body_rotation1.toEulerAngles().y())) / 180
+# 初期姿勢の逆回転
+def calc_initial_inverted(initial_orientation):
+    return pos2vmd_math.inverted(pos2vmd_math.from_qquaternion(initial_orientation))
 
-            # 一旦オイラー角に変換して、角度のかかり具合を補正し、再度クォータニオンに変換する
-            upper_correctqq = QQuaternion.fromEulerAngles(slope_motion.frames["上半身"][0].rotation.toEulerAngles() * y_degree).inverted()
+# 向きと上方向から、初期姿勢からの回転を求める
+def calc_orientation_rotations(direction, up, initial_orientation):
+    orientation = pos2vmd_math.from_direction(direction, up)
+    return pos2vmd_math.multiply(orientation, calc_initial_inverted(initial_orientation))
 
-        upper_body_rotation1 = upper_correctqq * upper_body_rotation1
+# 上半身の回転(全フレーム分)
+def calc_upper_rotations(pos, is_upper2_body, slope_motion):
+    M = pos2vmd_math
+    initial = QQuaternion.fromDirection(QVector3D(0, 1, 0), QVector3D(0, 0, 1))
+    directions, ups = SKELETON.gather(pos, ["上半身", "上半身2"])
 
-        # 上半身2
-        direction = pos[8] - pos[7]
-        up = QVector3D.crossProduct(direction, (pos[14] - pos[11])).normalized()
-        upper_body_orientation = QQuaternion.fromDirection(direction, up)
-        initial = QQuaternion.fromDirection(QVector3D(0, 1, 0), QVector3D(0, 0, 1))
-        upper_body_rotation2 = upper_body_orientation * initial.inverted()
+    if is_upper2_body == True:
+        # 上半身2がある場合、分割して登録する
 
-        # 傾き補正
-        upper_correctqq = QQuaternion()
+        # 上半身
+        upper_body_rotation1 = calc_orientation_rotations(directions[:, 0], ups[:, 0], initial)
 
-        # 傾きデータがある場合、補正をかける
-        if slope_motion is not None:
-            # Y軸の回転具合を求める
-            y_degree = (180 - abs(upper_body_rotation1.toEulerAngles().y())) / 180
+        # 傾き補正
+        upper_correctqq = calc_slope_corrections(slope_motion, "上半身", upper_body_rotation1)
+        upper_body_rotation1 = M.multiply(upper_correctqq, upper_body_rotation1)
 
-            # 一旦オイラー角に変換して、角度のかかり具合を補正し、再度クォータニオンに変換する
-            upper_correctqq = QQuaternion.fromEulerAngles(slope_motion.frames["上半身2"][0].rotation.toEulerAngles() * y_degree).inverted()
+        # 上半身2
+        upper_body_rotation2 = calc_orientation_rotations(directions[:, 1], ups[:, 1], initial)
 
-        upper_body_rotation2 = upper_correctqq * upper_body_rotation1.inverted() * upper_body_rotation2
-        
+        # 傾き補正(Y軸の回転具合は上半身で判定する)
+        upper_correctqq = calc_slope_corrections(slope_motion, "上半身2", upper_body_rotation1)
+        upper_body_rotation2 = M.multiply_all(upper_correctqq, M.inverted(upper_body_rotation1), upper_body_rotation2)
     else:
         # 上半身2は初期クォータニオン
-        upper_body_rotation2 = QQuaternion()
-        
-        """convert positions to bone frames"""
-        # 上半身
-        direction = pos[8] - pos[7]
-        up = QVector3D.crossProduct(direction, (pos[14] - pos[11])).normalized()
-        upper_body_orientation = QQuaternion.fromDirection(direction, up)
-        initial = QQuaternion.fromDirection(QVector3D(0, 1, 0), QVector3D(0, 0, 1))
-        upper_body_rotation1 = upper_body_orientation * initial.inverted()
+        upper_body_rotation2 = M.identity(pos.shape[:1])
+
+        # 上半身(上半身2の向きで上半身全体を回す)
+        upper_body_rotation1 = calc_orientation_rotations(directions[:, 1], ups[:, 1], initial)
 
         # 傾き補正
-        upper_correctqq = QQuaternion()
-        
-        # 傾きデータがある場合、補正をかける
-        if slope_motion is not None:
-            # Y軸の回転具合を求める
-            y_degree = (180 - abs(upper_body_rotation1.toEulerAngles().y())) / 180
-
-            # 一旦オイラー角に変換して、角度のかかり具合を補正し、再度クォータニオンに変換する
-            upper_correctqq = QQuaternion.fromEulerAngles(slope_motion.frames["上半身"][0].rotation.toEulerAngles() * y_degree).inverted()
-
-        upper_body_rotation1 = upper_correctqq * upper_body_rotation1
-           
+        upper_correctqq = calc_slope_corrections(slope_motion, "上半身", upper_body_rotation1)
+        upper_body_rotation1 = M.multiply(upper_correctqq, upper_body_rotation1)
+
     return upper_body_rotation1, upper_body_rotation2, upper_correctqq
 
-# 下半身FK（実質計算用）
-def position_to_frame_lower_calc(frame, pos, slope_motion):
-    direction = pos[0] - pos[7]
-    up = QVector3D.crossProduct(direction, (pos[4] - pos[1]))
-    lower_body_orientation = QQuaternion.fromDirection(direction, up)
-    initial = QQuaternion.fromDirection(QVector3D(0, -1, 0), QVector3D(0, 0, 1))
-    lower_body_rotation = lower_body_orientation * initial.inverted()
+# 下半身の回転(全フレーム分)
+def calc_lower_rotations(pos, slope_motion):
+    M = pos2vmd_math
+    directions, ups = SKELETON.gather(pos, ["下半身"])
+    lower_body_rotation = calc_orientation_rotations(directions[:, 0], ups[:, 0], QQuaternion.fromDirection(QVector3D(0, -1, 0), QVector3D(0, 0, 1)))
 
     # 傾き補正
-    lower_correctqq = QQuaternion()
+    lower_correctqq = calc_slope_corrections(slope_motion, "下半身", lower_body_rotation)
+    lower_body_rotation = M.multiply(lower_correctqq, lower_body_rotation)
+
+    return lower_body_rotation, lower_correctqq
 
-    # 傾きデータがある場合、補正をかける
-    if slope_motion is not None:
-        # Y軸の回転具合を求める
-        y_degree = (180 - abs(lower_body_rotation.toEulerAngles().y())) / 180
+# 首と頭の回転(全フレーム分)
+def calc_head_rotations(pos, upper_body_rotation1, upper_body_rotation2, upper_correctqq, is_gan, slope_motion):
+    M = pos2vmd_math
+    upper_body_inverted = M.multiply(M.inverted(upper_body_rotation2), M.inverted(upper_body_rotation1))
 
-        # 一旦オイラー角に変換して、角度のかかり具合を補正し、再度クォータニオンに変換する
-        lower_correctqq = QQuaternion.fromEulerAngles(slope_motion.frames["下半身"][0].rotation.toEulerAngles() * y_degree).inverted()
+    if is_gan:
+        # 体幹が3dpose-ganで決定されている場合
 
-    lower_body_rotation = lower_correctqq * lower_body_rotation
+        directions, ups = SKELETON.gather(pos, ["首:gan", "頭:gan"])
 
-    return lower_body_rotation, lower_correctqq
+        # 首(上方向を向きとする)
+        rotation = calc_orientation_rotations(ups[:, 0], directions[:, 0], QQuaternion.fromDirection(QVector3D(0, 0, -1), QVector3D(0, 1, 0)))
+        neck_rotation = M.multiply(upper_body_inverted, rotation)
 
-# 片手のFK
-def position_to_frame_arm_one_side(frame, pos, pos_gan, upper_correctqq, upper_body_rotation1, upper_body_rotation2, gan_shoulder_initial_orientation, shoulder_initial_orientation, arm_initial_orientation, points, is_gan, slope_motion, direction_name):
+        # 頭
+        rotation = M.multiply(upper_correctqq, calc_orientation_rotations(directions[:, 1], ups[:, 1], QQuaternion.fromDirection(QVector3D(0, 1, 0), QVector3D(0, 0, 0))))
+        head_rotation = M.multiply_all(M.inverted(neck_rotation), upper_body_inverted, rotation)
+    else:
+        # 体幹が 3d-pose-baseline で決定されている場合
 
-    if pos_gan is not None and is_gan == True:
+        directions, ups = SKELETON.gather(pos, ["首", "頭"])
 
-        # 手(3dpose-gan採用)
-        return position_to_frame_shoulder_one_side_calc(frame, pos_gan, QQuaternion(), upper_body_rotation1, upper_body_rotation2, gan_shoulder_initial_orientation, arm_initial_orientation, points, None, direction_name)
+        # 首
+        rotation = calc_orientation_rotations(directions[:, 0], ups[:, 0], QQuaternion.fromDirection(QVector3D(0, 0, -1), QVector3D(0, 1, 0)))
+        neck_rotation = M.multiply(upper_body_inverted, rotation)
 
-    # 3d-pose-baseline の手FK
-    return position_to_frame_shoulder_one_side_calc(frame, pos, upper_correctqq, upper_body_rotation1, upper_body_rotation2, shoulder_initial_orientation, arm_initial_orientation, points, slope_motion, direction_name)
+        # 頭
+        rotation = calc_orientation_rotations(directions[:, 1], ups[:, 1], QQuaternion.fromDirection(QVector3D(0, 0, 1), QVector3D(-1, 0, 0)))
+        head_rotation = M.multiply_all(M.inverted(neck_rotation), upper_body_inverted, rotation)
 
+    # 首・頭の傾き補正
+    neck_rotation = M.multiply(calc_slope_corrections(slope_motion, "首", neck_rotation), neck_rotation)
+    head_rotation = M.multiply(calc_slope_corrections(slope_motion, "頭", head_rotation), head_rotation)
+
+    return neck_rotation, head_rotation
+
+# 片手の回転(全フレーム分)
+def calc_arm_rotations(pos, upper_correctqq, upper_body_rotation1, upper_body_rotation2, shoulder_initial_orientation, arm_initial_orientation, slope_motion, direction_name):
+    M = pos2vmd_math
+    upper_body_inverted = M.multiply(M.inverted(upper_body_rotation2), M.inverted(upper_body_rotation1))
+
+    # 肩・腕・ひじの向きと上方向
+    directions, ups = SKELETON.gather(pos, ["{0}{1}".format(direction_name, b) for b in ["肩", "腕", "ひじ"]])
 
-# 片方の手FKの実体
-def position_to_frame_shoulder_one_side_calc(frame, pos, upper_correctqq, upper_body_rotation1, upper_body_rotation2, shoulder_initial_orientation, arm_initial_orientation, points, slope_motion, direction_name):
     # 肩
-    direction = pos[points['Shoulder']] - pos[points['Thorax']]
-    up = QVector3D.crossProduct((pos[points['Shoulder']] - pos[points['Thorax']]), (pos[points['AnotherShoulder']] - pos[points['Shoulder']]))
-    orientation = QQuaternion.fromDirection(direction, up)
-    rotation = upper_correctqq * orientation * shoulder_initial_orientation.inverted()
-
-    # 肩の傾きデータ
-    shoulder_correctqq = QQuaternion()
-    if slope_motion is not None:
-        # Y軸の回転具合を求める
-        y_degree = (180 - abs(rotation.toEulerAngles().y())) / 180
-
-        # 一旦オイラー角に変換して、角度のかかり具合を補正し、再度クォータニオンに変換する
-        shoulder_correctqq = QQuaternion.fromEulerAngles(slope_motion.frames["{0}肩".format(direction_name)][0].rotation.toEulerAngles() * y_degree).inverted()
-
-    # 肩ポーンの回転から親ボーンの回転を差し引いてbf.rotationに格納する。
-    shoulder_rotation = shoulder_correctqq * upper_body_rotation2.inverted() * upper_body_rotation1.inverted() * rotation # 後で使うので保存しておく
-    
+    rotation = M.multiply(upper_correctqq, calc_orientation_rotations(directions[:, 0], ups[:, 0], shoulder_initial_orientation))
+
+    shoulder_correctqq = calc_slope_corrections(slope_motion, "{0}肩".format(direction_name), rotation)
+    shoulder_rotation = M.multiply_all(shoulder_correctqq, upper_body_inverted, rotation)
+
     # 腕
-    direction = pos[points['Elbow']] - pos[points['Shoulder']]
-    up = QVector3D.crossProduct((pos[points['Elbow']] - pos[points['Shoulder']]), (pos[points['Wrist']] - pos[points['Elbow']]))
-    orientation = QQuaternion.fromDirection(direction, up)
-    rotation = upper_correctqq * orientation * arm_initial_orientation.inverted()
-
-    # 腕の傾きデータ
-    arm_correctqq = QQuaternion()
-    if slope_motion is not None:
-        # Y軸の回転具合を求める
-        y_degree = (180 - abs(rotation.toEulerAngles().y())) / 180
-
-        # 一旦オイラー角に変換して、角度のかかり具合を補正し、再度クォータニオンに変換する
-        arm_correctqq = QQuaternion.fromEulerAngles(slope_motion.frames["{0}腕".format(direction_name)][0].rotation.toEulerAngles() * y_degree).inverted()
-
-    # 腕ポーンの回転から親ボーンの回転を差し引いてbf.rotationに格納する。
-    arm_rotation = arm_correctqq * shoulder_rotation.inverted() * upper_body_rotation2.inverted() * upper_body_rotation1.inverted() * rotation # 後で使うので保存しておく
-    
-    # ひじ
-    direction = pos[points['Wrist']] - pos[points['Elbow']]
-    up = QVector3D.crossProduct((pos[points['Elbow']] - pos[points['Shoulder']]), (pos[points['Wrist']] - pos[points['Elbow']]))
-    orientation = QQuaternion.fromDirection(direction, up)
-    rotation = upper_correctqq * orientation * arm_initial_orientation.inverted()
-
-    # ひじの傾きデータ
-    elbow_correctqq = QQuaternion()
-    if slope_motion is not None:
-        # Y軸の回転具合を求める
-        y_degree = (180 - abs(rotation.toEulerAngles().y())) / 180
-       
-        elbow_correctqq = QQuaternion.fromEulerAngles(slope_motion.frames["{0}ひじ".format(direction_name)][0].rotation.toEulerAngles() * y_degree).inverted()
-
-    # ひじポーンの回転から親ボーンの回転を差し引いてbf.rotationに格納する。
-    # upper_body_rotation * left_shoulder_rotation * left_arm_rotation * bf.rotation = rotation なので、
-    elbow_rotation = elbow_correctqq * arm_rotation.inverted() * shoulder_rotation.inverted() * upper_body_rotation2.inverted() * upper_body_rotation1.inverted() * rotation
-    # bf.rotation = (upper_body_rotation * left_arm_rotation).inverted() * rotation # 別の表現
-    
-    return shoulder_rotation, arm_rotation, elbow_rotation
+    rotation = M.multiply(upper_correctqq, calc_orientation_rotations(directions[:, 1], ups[:, 1], arm_initial_orientation))
+
+    arm_correctqq = calc_slope_corrections(slope_motion, "{0}腕".format(direction_name), rotation)
+    arm_rotation = M.multiply_all(arm_correctqq, M.inverted(shoulder_rotation), upper_body_inverted, rotation)
 
+    # ひじ(上方向は腕と同じ面の法線)
+    rotation = M.multiply(upper_correctqq, calc_orientation_rotations(directions[:, 2], ups[:, 2], arm_initial_orientation))
 
-# 片方の足のFK
-def position_to_frame_leg_one_side(frame, pos, pos_gan, lower_correctqq, lower_body_rotation, points, bone_names, is_gan, slope_motion, direction_name):
+    elbow_correctqq = calc_slope_corrections(slope_motion, "{0}ひじ".format(direction_name), rotation)
+    elbow_rotation = M.multiply_all(elbow_correctqq, M.inverted(arm_rotation), M.inverted(shoulder_rotation), upper_body_inverted, rotation)
+
+    return shoulder_rotation, arm_rotation, elbow_rotation
+
+# 両足の関節INDEX (左足, 右足の順)
+LEG_HIP_POINTS = SKELETON.index(["LHip", "RHip"])
+LEG_KNEE_POINTS = SKELETON.index(["LKnee", "RKnee"])
+LEG_FOOT_POINTS = SKELETON.index(["LFoot", "RFoot"])
+# 反対側の足の付け根
+LEG_ANOTHER_HIP_POINTS = SKELETON.index(["RHip", "LHip"])
+LEG_BONE_NAMES = ["左足", "右足"]
+KNEE_BONE_NAMES = ["左ひざ", "右ひざ"]
+# 膝を移動する向き(左は足と両足の付け根でできる平面の法線の逆向き、右は法線の向き)
+KNEE_MOVE_SIGNS = np.array([-1.0, 1.0])
+
+# 両足の回転(全フレーム分、左右まとめて)
+# 膝の位置補正(pos の LKnee, RKnee を直接書き換える)と、補正後の足・ひざの回転を1回で求める
+# 3dpose-gan がある場合、体幹がgan採用もしくは3dpose-ganのオイラー角回転がどれか55度以上のフレームは、3dpose-ganを採用する
+# 戻り値は 左足, 左ひざ, 右足, 右ひざ の回転
+def calc_legs_rotations(pos, pos_gan, lower_correctqq, lower_body_rotation, is_gan, slope_motion):
+    M = pos2vmd_math
+    frame_num = pos.shape[0]
+    lower_body_inverted = M.inverted(lower_body_rotation)[:, np.newaxis]
 
     if pos_gan is not None:
-        # 足(3dpose-gan採用)
-        leg_rotation, knee_rotation = \
-            position_to_frame_leg_one_side_calc(frame, pos_gan, QQuaternion(), lower_body_rotation, points, None, direction_name)
-
-        # 体幹がgan採用もしくはオイラー角回転がどれか55度以上の場合、3dpose-gan採用
-        if is_gan \
-                or (abs(leg_rotation.toEulerAngles().x()) > 55 or abs(leg_rotation.toEulerAngles().y()) > 55 or abs(leg_rotation.toEulerAngles().z()) > 55 \
-                or abs(knee_rotation.toEulerAngles().x()) > 55 or abs(knee_rotation.toEulerAngles().y()) > 55 or abs(knee_rotation.toEulerAngles().z()) > 55 ):
-            return leg_rotation, knee_rotation
-    
-    # 3d-pose-baseline のFK
-    leg_rotation, knee_rotation = \
-        position_to_frame_leg_one_side_calc(frame, pos, lower_correctqq, lower_body_rotation, points, slope_motion, direction_name)
-
-    # 足の角度が大人しい場合、3d-pose-baseline を採用
-    return leg_rotation, knee_rotation
-
-# 片方の足の実体
-def position_to_frame_leg_one_side_calc(frame, pos, lower_correctqq, lower_body_rotation, points, slope_motion, direction_name):
-    # 足
-    direction = pos[points['Knee']] - pos[points['Hip']]
-    up = QVector3D.crossProduct((pos[points['Knee']] - pos[points['Hip']]), (pos[points['Foot']] - pos[points['Knee']]))
-    orientation = QQuaternion.fromDirection(direction, up)
-    initial_orientation = QQuaternion.fromDirection(QVector3D(0, -1, 0), QVector3D(-1, 0, 0))
-    rotation = lower_correctqq * orientation * initial_orientation.inverted()
-
-    # 足の傾きデータ
-    leg_correctqq = QQuaternion()
-    if slope_motion is not None:
-        # Y軸の回転具合を求める
-        y_degree = (180 - abs(rotation.toEulerAngles().y())) / 180
-
-        # 一旦オイラー角に変換して、角度のかかり具合を補正し、再度クォータニオンに変換する
-        leg_correctqq = QQuaternion.fromEulerAngles(slope_motion.frames["{0}足".format(direction_name)][0].rotation.toEulerAngles() * y_degree).inverted()
-
-    leg_rotation = leg_correctqq * lower_body_rotation.inverted() * rotation
-    
-    # ひざ
-    bf = VmdBoneFrame(frame)
-    bf.name = b'\x8d\xb6\x82\xd0\x82\xb4' # 'ひざ'
-    direction = pos[points['Foot']] - pos[points['Knee']]
-    up = QVector3D.crossProduct((pos[points['Knee']] - pos[points['Hip']]), (pos[points['Foot']] - pos[points['Knee']]))
-    orientation = QQuaternion.fromDirection(direction, up)
-    initial_orientation = QQuaternion.fromDirection(QVector3D(0, -1, 0), QVector3D(-1, 0, 0))
-    rotation = lower_correctqq * orientation * initial_orientation.inverted()
-
-    # ひざの傾きデータ
-    knee_correctqq = QQuaternion()
-    if slope_motion is not None:
-        # Y軸の回転具合を求める
-        y_degree = (180 - abs(rotation.toEulerAngles().y())) / 180
-        
-        # 一旦オイラー角に変換して、角度のかかり具合を補正し、再度クォータニオンに変換する
-        knee_correctqq = QQuaternion.fromEulerAngles(slope_motion.frames["{0}ひざ".format(direction_name)][0].rotation.toEulerAngles() * y_degree).inverted()
-
-    knee_rotation = knee_correctqq * leg_rotation.inverted() * lower_body_rotation.inverted() * rotation
-
-    return leg_rotation, knee_rotation
+        # 足(3dpose-gan)は膝の位置補正の影響を受けないので1回だけ計算する
+        gan_leg_rotation = calc_legs_leg_rotations(pos_gan, M.identity((frame_num, 1)), lower_body_inverted, None)
+        gan_knee_rotation = calc_legs_knee_rotations(pos_gan, M.identity((frame_num, 1)), lower_body_inverted, gan_leg_rotation, None)
+
+        is_gans = np.full((frame_num, 2), is_gan) \
+            | np.any(np.abs(M.to_euler_angles(gan_leg_rotation)) > 55, axis=-1) \
+            | np.any(np.abs(M.to_euler_angles(gan_knee_rotation)) > 55, axis=-1)
+    else:
+        is_gans = np.zeros((frame_num, 2), dtype=np.bool_)
+
+    lower_correctqq = lower_correctqq[:, np.newaxis]
+    is_baseline = np.all(is_gans) == False
+
+    # 膝の位置補正に使う足の回転
+    if is_baseline:
+        leg_rotation = calc_legs_leg_rotations(pos, lower_correctqq, lower_body_inverted, slope_motion)
+        if pos_gan is not None:
+            leg_rotation = np.where(is_gans[..., np.newaxis], gan_leg_rotation, leg_rotation)
+    else:
+        leg_rotation = gan_leg_rotation
+
+    # 膝がまっすぐのときつま先が不自然に回転することがあり、対策のため膝を20mmから100mm前へ移動する
+    # 足の付け根, 反対側の足の付け根, 足首でできる平面の垂直方向へ移動
+    hip = pos[:, LEG_HIP_POINTS]
+    up = M.normalized(M.cross_product(pos[:, LEG_FOOT_POINTS] - hip, hip - pos[:, LEG_ANOTHER_HIP_POINTS]))
+    # 足の回転が大きいほど膝の移動量を増やす(20mmから100mm)
+    pos[:, LEG_KNEE_POINTS] += up * (KNEE_MOVE_SIGNS * calc_knee_move_length(leg_rotation))[..., np.newaxis]
+
+    if is_baseline:
+        # 3d-pose-baseline のFK(膝の位置補正後)
+        leg_rotation = calc_legs_leg_rotations(pos, lower_correctqq, lower_body_inverted, slope_motion)
+        knee_rotation = calc_legs_knee_rotations(pos, lower_correctqq, lower_body_inverted, leg_rotation, slope_motion)
+
+        if pos_gan is not None:
+            leg_rotation = np.where(is_gans[..., np.newaxis], gan_leg_rotation, leg_rotation)
+            knee_rotation = np.where(is_gans[..., np.newaxis], gan_knee_rotation, knee_rotation)
+    else:
+        leg_rotation, knee_rotation = gan_leg_rotation, gan_knee_rotation
+
+    return leg_rotation[:, 0], knee_rotation[:, 0], leg_rotation[:, 1], knee_rotation[:, 1]
+
+# 両足の足ボーンの回転 (フレーム数, 2, 4)
+def calc_legs_leg_rotations(pos, lower_correctqq, lower_body_inverted, slope_motion):
+    M = pos2vmd_math
+    direction, up = SKELETON.gather(pos, LEG_BONE_NAMES)
+    rotation = M.multiply(lower_correctqq, calc_orientation_rotations(direction, up, QQuaternion.fromDirection(QVector3D(0, -1, 0), QVector3D(-1, 0, 0))))
+
+    leg_correctqq = calc_slope_corrections(slope_motion, LEG_BONE_NAMES, rotation)
+
+    return M.multiply_all(leg_correctqq, lower_body_inverted, rotation)
+
+# 両足のひざボーンの回転 (フレーム数, 2, 4)
+def calc_legs_knee_rotations(pos, lower_correctqq, lower_body_inverted, leg_rotation, slope_motion):
+    M = pos2vmd_math
+    direction, up = SKELETON.gather(pos, KNEE_BONE_NAMES)
+    rotation = M.multiply(lower_correctqq, calc_orientation_rotations(direction, up, QQuaternion.fromDirection(QVector3D(0, -1, 0), QVector3D(-1, 0, 0))))
+
+    knee_correctqq = calc_slope_corrections(slope_motion, KNEE_BONE_NAMES, rotation)
+
+    return M.multiply_all(knee_correctqq, M.inverted(leg_rotation), lower_body_inverted, rotation)
+
+# 足の回転(Y軸)に応じた膝の移動量(20mmから100mm)
+def calc_knee_move_length(leg_rotation):
+    x = leg_rotation[..., pos2vmd_math.QX]
+    y = leg_rotation[..., pos2vmd_math.QY]
+    z = leg_rotation[..., pos2vmd_math.QZ]
+    w = leg_rotation[..., pos2vmd_math.QW]
+    m20 = 2.0 * x * z + 2.0 * w * y
+    m22 = 1.0 - 2.0 * x * x - 2.0 * y * y
+    # 足の角度y
+    ty = -np.degrees(np.arctan2(m20, m22))
+
+    return 20 + 80 * np.abs(ty) / 180.0
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_ik.py - 全フレーム・両足一括の2ボーンIK
+#
+# 足(太もも)とひざ(すね)の2ボーンについて、足付け根と足首の位置 (フレーム数, 3) から、
+# 余弦定理でひざの曲げ角度を求め、IKのひざ位置に合わせた足の回転を全フレーム分まとめて求める
+# ボーンモデルで決まる連鎖のローカル位置と各部の長さは、ソルバーを作るときに1回だけ求める
+#
+# 足首が届かない位置にある場合(三角形が成り立たない場合)やNaNの場合も、角度は 0〜180度 に収める
+
+import logging
+import numpy as np
+
+from applications import pos2vmd_math
+from applications import pos2vmd_fk
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# 足の並び(足IKのボーン名の左右)
+LEG_DIRECTIONS = ["左", "右"]
+
+
+class LegIKSolver():
+    def __init__(self, bone_model):
+        # 足ごとの連鎖(センター・下半身・足・ひざ・足首・つま先)の、足IKボーンからのローカル位置 (足数, 6, 3)
+        self.translations = np.stack([calc_leg_translations(bone_model, direction_name) for direction_name in LEG_DIRECTIONS])
+
+        # 足ごとの 足-ひざ, ひざ-足首 の長さ (足数,)
+        leg_lengths = np.array([bone_model.left_leg_lengths, bone_model.right_leg_lengths], dtype=np.float64)
+        self.thigh_lengths = leg_lengths[:, 1]
+        self.shin_lengths = leg_lengths[:, 0]
+
+    # 両足のIKを全フレーム分まとめて求める
+    # center_positions: センターの位置 (フレーム数, 3)
+    # lower_body_rotations: 下半身の回転 (フレーム数, 4)
+    # leg_rotations, knee_rotations: 足・ひざの回転 (足数, フレーム数, 4)
+    # 戻り値は 足IKの位置 (足数, フレーム数, 3), 足IKの回転 (足数, フレーム数, 4), IKのひざ位置に合わせた足の回転 (足数, フレーム数, 4)
+    def solve(self, center_positions, lower_body_rotations, leg_rotations, knee_rotations):
+        M = pos2vmd_math
+
+        center_positions = np.asarray(center_positions, dtype=np.float64)
+        lower_body_rotations = np.asarray(lower_body_rotations, dtype=np.float64)
+        leg_rotations = np.asarray(leg_rotations, dtype=np.float64)
+        knee_rotations = np.asarray(knee_rotations, dtype=np.float64)
+
+        leg_num = len(LEG_DIRECTIONS)
+        frame_num = center_positions.shape[0]
+
+        # 両足分の連鎖のFK (足数, フレーム数, 6, 3)
+        translations = np.broadcast_to(self.translations[:, np.newaxis], (leg_num, frame_num) + self.translations.shape[1:]).copy()
+        # センターはモーションの位置分ずらす
+        translations[:, :, pos2vmd_fk.LEG_CHAIN_CENTER] += center_positions
+
+        # センター・足首・つま先は回転させない
+        identity = M.identity((leg_num, frame_num))
+        lower_body_rotations = np.broadcast_to(lower_body_rotations, (leg_num, frame_num, 4))
+        rotations = np.stack([identity, lower_body_rotations, leg_rotations, knee_rotations, identity, identity], axis=2)
+
+        fk_positions = pos2vmd_fk.calc_fk_positions(translations, rotations)
+        leg_pos = fk_positions[:, :, pos2vmd_fk.LEG_CHAIN_LEG]
+        knee_pos = fk_positions[:, :, pos2vmd_fk.LEG_CHAIN_KNEE]
+        ankle_pos = fk_positions[:, :, pos2vmd_fk.LEG_CHAIN_ANKLE]
+
+        # 足の回転 ------------------------------
+        leg_diff_rotations = solve_two_bone(leg_pos, ankle_pos, knee_pos, self.thigh_lengths[:, np.newaxis], self.shin_lengths[:, np.newaxis])
+
+        # 足IKの回転（足首の角度）-------------------------
+
+        # FKと同じ状態の足首の向き
+        ik_rotations = M.multiply_all(lower_body_rotations, leg_rotations, knee_rotations)
+
+        return ankle_pos, ik_rotations, leg_diff_rotations
+
+
+# 片足の連鎖の、足IKボーンからのローカル位置 (6, 3)
+def calc_leg_translations(bone_model, direction_name):
+    bone_positions = [bone_model.get_position_array(bone_name.format(direction_name)) for bone_name in pos2vmd_fk.LEG_CHAIN_BONE_NAMES]
+    ik_bone = bone_model.get_position_array("{0}足ＩＫ".format(direction_name))
+
+    return pos2vmd_fk.calc_bone_translations(bone_positions, ik_bone)
+
+
+# 2ボーンIKで、IKのひざ位置に合わせた足の回転 (..., 4) を求める
+# hip_positions, ankle_positions: 足付け根・足首の位置 (..., 3)
+# knee_positions: FKのひざの位置 (..., 3)
+# thigh_lengths, shin_lengths: 足-ひざ, ひざ-足首 の長さ(hip_positions の (...) に合わせて broadcast する)
+def solve_two_bone(hip_positions, ankle_positions, knee_positions, thigh_lengths, shin_lengths):
+    M = pos2vmd_math
+
+    # 足付け根から足首までの距離
+    ankle_leg_diff = np.asarray(ankle_positions, dtype=np.float64) - np.asarray(hip_positions, dtype=np.float64)
+
+    # 三辺から足の角度を求める
+    leg_angles = calc_leg_angle(M.length(ankle_leg_diff), thigh_lengths, shin_lengths)
+
+    # 足の付け根からひざへの方向を表す青い単位ベクトル(長さ1)
+    # 足の付け根から足首へのベクトルをX軸回りに回転させる
+    leg_angle_eulers = np.zeros(ankle_leg_diff.shape)
+    leg_angle_eulers[..., 0] = leg_angles * -1
+    knee_v = M.rotated_vector(M.from_euler_angles(leg_angle_eulers), M.normalized(ankle_leg_diff))
+
+    # FKのひざの位置
+    ik_knee_3d = knee_v * np.asarray(thigh_lengths, dtype=np.float64)[..., np.newaxis] + hip_positions
+
+    # IKのひざ位置からFKのひざ位置に回転させる
+    return M.rotation_to(knee_positions, ik_knee_3d)
+
+
+# 三辺から足の角度を求める(全フレーム分)
+# a, b, c は各辺の長さ。a と b の間の角度(度)を返す
+# 三角形が成り立たない場合は 0度 か 180度、辺の長さが0やNaNの場合は 0度 とする
+def calc_leg_angle(a, b, c):
+    a, b, c = np.broadcast_arrays(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64), np.asarray(c, dtype=np.float64))
+
+    # 0割対策
+    is_zero = (a == 0) | (b == 0)
+    a_safe = np.where(is_zero, 1, a)
+    b_safe = np.where(is_zero, 1, b)
+
+    cos = ( a_safe ** 2 + b_safe ** 2 - c ** 2 ) / ( 2 * a_safe * b_safe )
+
+    # 届かない場合は -1〜1 に収め、NaNは角度0(cos=1)とする
+    cos = np.where(np.isnan(cos), 1, np.clip(cos, -1, 1))
+
+    angle = np.rad2deg(np.arccos(cos))
+
+    return np.where(is_zero, 0, angle)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_math.py - ベクトル・クォータニオンの配列計算
+#
+# QVector3D / QQuaternion と同じ計算を、全フレーム分の配列に対してまとめて行う
+# クォータニオンは (..., 4) の配列で、並びは QQuaternion(scalar, x, y, z) と同じ (w, x, y, z)
+# 角度はQtと同じく度で扱い、オイラー角の並びは toEulerAngles と同じ (x(pitch), y(yaw), z(roll))
+
+import numpy as np
+
+# クォータニオンの各要素のINDEX
+QW = 0
+QX = 1
+QY = 2
+QZ = 3
+
+# qFuzzyIsNull の閾値(float / double)
+FUZZY_FLOAT = 0.00001
+FUZZY_DOUBLE = 0.000000000001
+
+
+# 単位クォータニオンの配列
+def identity(shape=()):
+    q = np.zeros(tuple(shape) + (4,), dtype=np.float64)
+    q[..., QW] = 1
+    return q
+
+
+# 外積
+def cross_product(v1, v2):
+    return np.cross(v1, v2)
+
+
+# 内積
+def dot_product(v1, v2):
+    return np.sum(np.asarray(v1) * np.asarray(v2), axis=-1)
+
+
+# ベクトルの正規化(QVector3D.normalized と同じく、長さがほぼ0の場合は0ベクトル)
+def normalized(v):
+    v = np.asarray(v, dtype=np.float64)
+    len2 = np.sum(v * v, axis=-1, keepdims=True)
+
+    # 長さがほぼ1のものはそのまま、ほぼ0のものは0
+    is_one = np.abs(len2 - 1) <= FUZZY_DOUBLE
+    is_null = len2 <= FUZZY_DOUBLE
+    scale = np.where(is_one, 1, np.where(is_null, 0, 1 / np.sqrt(np.where(is_null, 1, len2))))
+
+    return v * scale
+
+
+# クォータニオンの積 (q1 * q2)
+def multiply(q1, q2):
+    q1 = np.asarray(q1, dtype=np.float64)
+    q2 = np.asarray(q2, dtype=np.float64)
+
+    w1, x1, y1, z1 = q1[..., QW], q1[..., QX], q1[..., QY], q1[..., QZ]
+    w2, x2, y2, z2 = q2[..., QW], q2[..., QX], q2[..., QY], q2[..., QZ]
+
+    return np.stack([
+        w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+        w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+        w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+        w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2
+    ], axis=-1)
+
+
+# 複数のクォータニオンの積 (qs[0] * qs[1] * ...)
+def multiply_all(*qs):
+    result = qs[0]
+    for q in qs[1:]:
+        result = multiply(result, q)
+    return result
+
+
+# 逆クォータニオン(QQuaternion.inverted と同じく、長さがほぼ0の場合は0クォータニオン)
+def inverted(q):
+    q = np.asarray(q, dtype=np.float64)
+    len2 = np.sum(q * q, axis=-1, keepdims=True)
+
+    is_null = len2 <= FUZZY_DOUBLE
+    result = q * np.array([1, -1, -1, -1]) / np.where(is_null, 1, len2)
+
+    return np.where(is_null, 0, result)
+
+
+# 回転行列からクォータニオン(QQuaternion.fromRotationMatrix)
+# m は (..., 3, 3) で m[..., 行, 列]
+def from_rotation_matrix(m):
+    m = np.asarray(m, dtype=np.float64)
+    q = np.zeros(m.shape[:-2] + (4,), dtype=np.float64)
+
+    trace = m[..., 0, 0] + m[..., 1, 1] + m[..., 2, 2]
+    is_trace = trace > 0.00000001
+
+    # トレースが正の場合
+    s = 2 * np.sqrt(np.where(is_trace, trace, 0) + 1)
+    q[..., QW] = 0.25 * s
+    q[..., QX] = (m[..., 2, 1] - m[..., 1, 2]) / s
+    q[..., QY] = (m[..., 0, 2] - m[..., 2, 0]) / s
+    q[..., QZ] = (m[..., 1, 0] - m[..., 0, 1]) / s
+
+    if np.all(is_trace):
+        return q
+
+    # トレースが正でない場合、対角成分が最大の軸を基準にする
+    diag = np.stack([m[..., 0, 0], m[..., 1, 1], m[..., 2, 2]], axis=-1)
+    i = np.where(diag[..., 1] > diag[..., 0], 1, 0)
+    i = np.where(diag[..., 2] > np.take_along_axis(diag, i[..., np.newaxis], axis=-1)[..., 0], 2, i)
+
+    for axis_i in range(3):
+        mask = (is_trace == False) & (i == axis_i)
+        if np.any(mask) == False:
+            continue
+
+        axis_j = (axis_i + 1) % 3
+        axis_k = (axis_j + 1) % 3
+        mm = m[mask]
+
+        s = 2 * np.sqrt(mm[:, axis_i, axis_i] - mm[:, axis_j, axis_j] - mm[:, axis_k, axis_k] + 1)
+        qq = np.zeros((mm.shape[0], 4), dtype=np.float64)
+        qq[:, 1 + axis_i] = 0.25 * s
+        qq[:, QW] = (mm[:, axis_k, axis_j] - mm[:, axis_j, axis_k]) / s
+        qq[:, 1 + axis_j] = (mm[:, axis_j, axis_i] + mm[:, axis_i, axis_j]) / s
+        qq[:, 1 + axis_k] = (mm[:, axis_k, axis_i] + mm[:, axis_i, axis_k]) / s
+        q[mask] = qq
+
+    return q
+
+
+# 3軸からクォータニオン(QQuaternion.fromAxes)
+def from_axes(x_axis, y_axis, z_axis):
+    return from_rotation_matrix(np.stack([x_axis, y_axis, z_axis], axis=-1))
+
+
+# from から to への回転(QQuaternion.rotationTo)
+def rotation_to(v_from, v_to):
+    v_from, v_to = np.broadcast_arrays(np.asarray(v_from, dtype=np.float64), np.asarray(v_to, dtype=np.float64))
+    v0 = normalized(v_from)
+    v1 = normalized(v_to)
+
+    d = dot_product(v0, v1) + 1
+    is_opposite = np.abs(d) <= FUZZY_FLOAT
+
+    # 通常
+    sd = np.sqrt(2 * np.where(is_opposite, 1, d))
+    axis = cross_product(v0, v1) / sd[..., np.newaxis]
+    q = normalized(np.concatenate([(sd * 0.5)[..., np.newaxis], axis], axis=-1))
+
+    if np.any(is_opposite):
+        # 逆向きの場合、どの軸で回してもよい
+        axis = cross_product(np.array([1.0, 0, 0]), v0)
+        axis = np.where(np.sum(axis * axis, axis=-1, keepdims=True) <= FUZZY_FLOAT, cross_product(np.array([0, 1.0, 0]), v0), axis)
+        opposite_q = np.concatenate([np.zeros(axis.shape[:-1] + (1,)), normalized(axis)], axis=-1)
+        q = np.where(is_opposite[..., np.newaxis], opposite_q, q)
+
+    return q
+
+
+# 向きと上方向からクォータニオン(QQuaternion.fromDirection)
+def from_direction(direction, up):
+    direction, up = np.broadcast_arrays(np.asarray(direction, dtype=np.float64), np.asarray(up, dtype=np.float64))
+
+    # 向きがない場合は単位クォータニオン
+    is_null = np.all(np.abs(direction) <= FUZZY_FLOAT, axis=-1)
+
+    z_axis = normalized(direction)
+    x_axis = cross_product(up, z_axis)
+    # 上方向が向きと平行(もしくは不正)な場合、Z軸からの最短回転
+    is_collinear = np.sum(x_axis * x_axis, axis=-1) <= FUZZY_FLOAT
+
+    x_axis = normalized(x_axis)
+    y_axis = cross_product(z_axis, x_axis)
+
+    q = from_axes(normalized(x_axis), y_axis, z_axis)
+
+    if np.any(is_collinear):
+        q = np.where(is_collinear[..., np.newaxis], rotation_to(np.array([0, 0, 1.0]), z_axis), q)
+
+    return np.where(is_null[..., np.newaxis], identity(), q)
+
+
+# オイラー角(度)に変換(QQuaternion.toEulerAngles)
+def to_euler_angles(q):
+    q = np.asarray(q, dtype=np.float64)
+    w, x, y, z = q[..., QW], q[..., QX], q[..., QY], q[..., QZ]
+
+    xx = x * x
+    xy = x * y
+    xz = x * z
+    xw = x * w
+    yy = y * y
+    yz = y * z
+    yw = y * w
+    zz = z * z
+    zw = z * w
+
+    # 長さが1でない場合、正規化したのと同じになるよう割る
+    len2 = xx + yy + zz + w * w
+    scale = np.where((np.abs(len2 - 1) <= FUZZY_FLOAT) | (np.abs(len2) <= FUZZY_FLOAT), 1, len2)
+    xx, xy, xz, xw, yy, yz, yw, zz, zw = [v / scale for v in [xx, xy, xz, xw, yy, yz, yw, zz, zw]]
+
+    sinp = -2 * (yz - xw)
+
+    pitch = np.arcsin(np.clip(sinp, -1, 1))
+    yaw = np.arctan2(2 * (xz + yw), 1 - 2 * (xx + yy))
+    roll = np.arctan2(2 * (xy + zw), 1 - 2 * (xx + zz))
+
+    # ジンバルロック(X軸回転がほぼ±90度)の場合、Z軸回転は0として、Y軸回転にまとめる
+    is_locked = (1 - np.abs(sinp)) <= FUZZY_FLOAT
+    pitch = np.where(is_locked, np.copysign(np.pi / 2, sinp), pitch)
+    yaw = np.where(is_locked, 2 * np.arctan2(y, w), yaw)
+    roll = np.where(is_locked, 0, roll)
+
+    return np.degrees(np.stack([pitch, yaw, roll], axis=-1))
+
+
+# オイラー角(度)からクォータニオン(QQuaternion.fromEulerAngles)
+def from_euler_angles(euler):
+    half = np.radians(np.asarray(euler, dtype=np.float64)) * 0.5
+    pitch, yaw, roll = half[..., 0], half[..., 1], half[..., 2]
+
+    c1 = np.cos(yaw)
+    s1 = np.sin(yaw)
+    c2 = np.cos(roll)
+    s2 = np.sin(roll)
+    c3 = np.cos(pitch)
+    s3 = np.sin(pitch)
+    c1c2 = c1 * c2
+    s1s2 = s1 * s2
+
+    return np.stack([
+        c1c2 * c3 + s1s2 * s3,
+        c1c2 * s3 + s1s2 * c3,
+        s1 * c2 * c3 - c1 * s2 * s3,
+        c1 * s2 * c3 - s1 * c2 * s3
+    ], axis=-1)
+
+
+# 単位クォータニオンか(QQuaternion の == と同じく、float精度で完全一致するか)
+def is_identity(q):
+    return np.all(np.asarray(q).astype(np.float32) == identity().astype(np.float32), axis=-1)
+
+
+# QQuaternion(もしくは同じメソッドを持つもの)を配列に変換
+def from_qquaternion(q):
+    return np.array([q.scalar(), q.x(), q.y(), q.z()], dtype=np.float64)
+
+
+# 共役クォータニオン
+def conjugated(q):
+    return np.asarray(q, dtype=np.float64) * np.array([1, -1, -1, -1])
+
+
+# ベクトル(クォータニオン)の長さ
+def length(v):
+    return np.sqrt(np.sum(np.asarray(v, dtype=np.float64) ** 2, axis=-1))
+
+
+# ベクトルを回転させる(QQuaternion.rotatedVector)
+def rotated_vector(q, v):
+    q = np.asarray(q, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    vq = np.concatenate([np.zeros(v.shape[:-1] + (1,)), v], axis=-1)
+
+    return multiply_all(q, vq, conjugated(q))[..., 1:]
+
+
+# 補間の両端のクォータニオンと補間位置を同じ形にそろえる
+def broadcast_interpolation(q1, q2, t):
+    q1 = np.asarray(q1, dtype=np.float64)
+    q2 = np.asarray(q2, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    shape = np.broadcast_shapes(q1.shape[:-1], q2.shape[:-1], t.shape)
+
+    return np.broadcast_to(q1, shape + (4,)), np.broadcast_to(q2, shape + (4,)), np.broadcast_to(t, shape)
+
+
+# 球面線形補間(QQuaternion.slerp)
+def slerp(q1, q2, t):
+    q1, q2, t = broadcast_interpolation(q1, q2, t)
+
+    # 遠回りしないよう、内積が負の場合は反転する
+    dot = dot_product(q1, q2)
+    q2b = np.where((dot < 0)[..., np.newaxis], -q2, q2)
+    dot = np.abs(dot)
+
+    # 角度が小さすぎる場合は線形補間
+    factor1 = 1 - t
+    factor2 = t.copy()
+    angle = np.arccos(np.clip(dot, -1, 1))
+    sin_angle = np.sin(angle)
+    is_slerp = ((1 - dot) > 0.0000001) & (sin_angle > 0.0000001)
+    sin_angle = np.where(is_slerp, sin_angle, 1)
+    factor1 = np.where(is_slerp, np.sin((1 - t) * angle) / sin_angle, factor1)
+    factor2 = np.where(is_slerp, np.sin(t * angle) / sin_angle, factor2)
+
+    q = q1 * factor1[..., np.newaxis] + q2b * factor2[..., np.newaxis]
+
+    # 範囲外はそれぞれの端
+    q = np.where((t <= 0)[..., np.newaxis], q1, q)
+    return np.where((t >= 1)[..., np.newaxis], q2, q)
+
+
+# 回転行列 (..., 3, 3) (QQuaternion.toRotationMatrix)
+def to_rotation_matrix(q):
+    q = np.asarray(q, dtype=np.float64)
+    w, x, y, z = q[..., QW], q[..., QX], q[..., QY], q[..., QZ]
+
+    f2x = x + x
+    f2y = y + y
+    f2z = z + z
+    f2xw = f2x * w
+    f2yw = f2y * w
+    f2zw = f2z * w
+    f2xx = f2x * x
+    f2xy = f2x * y
+    f2xz = f2x * z
+    f2yy = f2y * y
+    f2yz = f2y * z
+    f2zz = f2z * z
+
+    return np.stack([
+        np.stack([1 - (f2yy + f2zz), f2xy - f2zw, f2xz + f2yw], axis=-1),
+        np.stack([f2xy + f2zw, 1 - (f2xx + f2zz), f2yz - f2xw], axis=-1),
+        np.stack([f2xz - f2yw, f2yz + f2xw, 1 - (f2xx + f2yy)], axis=-1)
+    ], axis=-2)
+
+
+# 単位行列 (..., 4, 4)
+def identity_matrix(shape=()):
+    return np.broadcast_to(np.eye(4), tuple(shape) + (4, 4)).copy()
+
+
+# 移動と回転の行列 (..., 4, 4)
+# QMatrix4x4 に translate(v) → rotate(q) したのと同じ
+def translation_rotation_matrix(v, q):
+    v = np.asarray(v, dtype=np.float64)
+    q = np.asarray(q, dtype=np.float64)
+    shape = np.broadcast_shapes(v.shape[:-1], q.shape[:-1])
+
+    m = identity_matrix(shape)
+    m[..., :3, :3] = to_rotation_matrix(q)
+    m[..., :3, 3] = v
+
+    return m
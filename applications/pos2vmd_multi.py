@@ -5,7 +5,7 @@
 
 from __future__ import print_function
 
-from PyQt5.QtGui import QQuaternion, QVector4D, QVector3D, QMatrix4x4
+from applications.pos2vmd_qt import QQuaternion, QVector4D, QVector3D, QMatrix4x4
 import os
 import re
 import argparse
@@ -13,13 +13,20 @@ import logging
 import datetime
 import numpy as np
 import csv
+import concurrent.futures
 
 from applications.VmdWriter import VmdBoneFrame, VmdInfoIk, VmdShowIkFrame, VmdWriter
 from applications import pos2vmd_utils
 from applications import pos2vmd_calc
-from applications import pos2vmd_frame
 from applications import pos2vmd_filter
 from applications import pos2vmd_reduce
+from applications import pos2vmd_bundle
+from applications import pos2vmd_batch
+from applications import pos2vmd_track
+from applications import pos2vmd_parallel
+from applications import pos2vmd_contact
+from applications import pos2vmd_calibration
+from applications import pos2vmd_rom
               
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -30,40 +37,40 @@ level = {0:logging.ERROR,
             3:logging.DEBUG}
 verbose = 2
 
-# ディクショナリ型で各ボーンごとのキーフレームリストを作成する
-bone_frame_dic = {
-    "上半身":[],
-    "上半身2":[],
-    "下半身":[],
-    "首":[],
-    "頭":[],
-    "左肩":[],
-    "左腕":[],
-    "左ひじ":[],
-    "右肩":[],
-    "右腕":[],
-    "右ひじ":[],
-    "左足":[],
-    "左ひざ":[],
-    "右足":[],
-    "右ひざ":[],
-    "センター":[],
-    "グルーブ":[],
-    "左足ＩＫ":[],
-    "右足ＩＫ":[]
-}
+# 出力するボーン(VMDにはこの順で出力する)
+BONE_NAMES = ["上半身", "上半身2", "下半身", "首", "頭", "左肩", "左腕", "左ひじ", "右肩", "右腕", "右ひじ", \
+              "左足", "左ひざ", "右足", "右ひざ", "センター", "グルーブ", "左足ＩＫ", "右足ＩＫ"]
+
+# ディクショナリ型で各ボーンごとのキーフレーム列(BoneTrack)を作成する
+# 変換ごとに新しく作る(複数クリップを同じプロセスで変換しても混ざらないように)
+def make_bone_frame_dic():
+    return {bone_name: pos2vmd_track.BoneTrack(bone_name) for bone_name in BONE_NAMES}
 
 # 関節位置情報のリストからVMDを生成します
-def position_list_to_vmd_multi(positions_multi, vmd_file, smoothed_file, bone_csv_file, depth_file, conf_file, start_frame_file, center_xy_scale, center_z_scale, depth_smooth_times, smooth_times, threshold_pos, threshold_rot, is_ik, heelpos, base_dir, now_str):
+# 戻り値は出力したVMDファイルのパス
+def position_list_to_vmd_multi(positions_multi, vmd_file, smoothed_file, bone_csv_file, depth_file, conf_file, start_frame_file, center_xy_scale, center_z_scale, depth_smooth_times, smooth_times, threshold_pos, threshold_rot, is_ik, heelpos, base_dir, now_str, is_cache=False, bundle=None, positions_gan_multi=None, angle_workers=1):
     # トレースモデル
     logger.info("トレースモデル: %s", bone_csv_file)
 
+    # 各ボーンごとのキーフレームリスト
+    bone_frame_dic = make_bone_frame_dic()
+
+    if bundle is not None:
+        # バンドルが指定されている場合、テキストファイルの代わりにバンドルから読み込む
+        logger.info("バンドル: %s", bundle.bundle_file)
+
     # 開始フレームインデックス
-    start_frame = pos2vmd_utils.load_start_frame(start_frame_file)
+    if bundle is not None:
+        start_frame = bundle.start_frame
+    else:
+        start_frame = pos2vmd_utils.load_start_frame(start_frame_file)
     logger.info("開始フレームインデックス: %d", start_frame)
     
     # 関節二次元情報を読み込み
-    smoothed_2d = pos2vmd_utils.load_smoothed_2d(smoothed_file)
+    if bundle is not None:
+        smoothed_2d = bundle.smoothed_2d
+    else:
+        smoothed_2d = pos2vmd_utils.load_smoothed_2d(smoothed_file, is_cache)
 
     # 上半身2があるかチェック
     is_upper2_body = pos2vmd_utils.is_upper2_body_bone(bone_csv_file)
@@ -78,9 +85,17 @@ def position_list_to_vmd_multi(positions_multi, vmd_file, smoothed_file, bone_cs
 
     logger.info("角度計算開始")
 
-    # 各関節角度の算出
-    for frame, positions in enumerate(positions_multi):
-        pos2vmd_frame.position_to_frame(bone_frame_dic, positions, None, smoothed_2d, frame, is_upper2_body, slope_motion)   
+    # 3dpose-gan の関節位置(指定がない場合はNone)
+    positions_gan = None
+    if positions_gan_multi is not None:
+        if len(positions_gan_multi) == len(positions_multi):
+            logger.info("3dpose-gan 併用")
+            positions_gan = positions_gan_multi.positions
+        else:
+            logger.warning("3dpose-gan のフレーム数が一致しないため使用しません: %s != %s", len(positions_gan_multi), len(positions_multi))
+
+    # 各関節角度の算出(全フレーム一括、angle_workers が1でなければチャンクに分けて並列計算)
+    pos2vmd_parallel.positions_to_frames_parallel(bone_frame_dic, positions_multi.positions, positions_gan, is_upper2_body, slope_motion, angle_workers)
 
     # logger.info("直立フレーム推定開始")
 
@@ -99,28 +114,37 @@ def position_list_to_vmd_multi(positions_multi, vmd_file, smoothed_file, bone_cs
 
     logger.info("IK計算開始")
 
+    # 足の接地区間(センター・足IK・センターZで共通して使う)
+    contacts = pos2vmd_contact.calc_foot_contacts(positions_multi.positions, smoothed_2d)
+
+    # 体格キャリブレーション(キャッシュ指定時は pos.txt と同じディレクトリに保存して使い回す)
+    calibration = load_calibration(positions_multi, positions_gan_multi if positions_gan is not None else None, bone_csv_file, slope_motion, is_cache)
+
     # センターと足のIKポジションの計算
-    pos2vmd_calc.calc_center_ik_position(bone_frame_dic, positions_multi, bone_csv_file, smoothed_2d, heelpos, is_ik)
+    pos2vmd_calc.calc_center_ik_position(bone_frame_dic, positions_multi, bone_csv_file, smoothed_2d, heelpos, is_ik, contacts, calibration)
 
     if is_ik:
         # IKの計算
-        # pos2vmd_calc.calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, upright_idxs, heelpos)
+        # pos2vmd_calc.calc_IK(bone_frame_dic, bone_csv_file, smoothed_2d, depth_all_frames, upright_idxs, heelpos, contacts)
 
         # IK回転の計算
         pos2vmd_calc.calc_IK_rotation(bone_frame_dic, bone_csv_file, positions_multi)
     else:
         #　IKでない場合は登録除去
-        bone_frame_dic["左足ＩＫ"] = []
-        bone_frame_dic["右足ＩＫ"] = []
+        bone_frame_dic["左足ＩＫ"].clear()
+        bone_frame_dic["右足ＩＫ"].clear()
 
-    depths, depth_confs = pos2vmd_utils.load_depth(depth_file, conf_file)
+    if bundle is not None:
+        depths, depth_confs = bundle.depths, bundle.depth_confs
+    else:
+        depths, depth_confs = pos2vmd_utils.load_depth(depth_file, conf_file, is_cache)
 
     if depths is not None and center_z_scale > 0:
         # 深度ファイルがあり、スケールが指定されている場合のみ、Z軸計算
         logger.info("センターZ計算開始")
 
         # センターZの計算
-        pos2vmd_calc.calc_center_z(bone_frame_dic, smoothed_2d, depths, depth_confs, start_frame, center_xy_scale, center_z_scale, depth_smooth_times, is_ik, base_dir, now_str)
+        pos2vmd_calc.calc_center_z(bone_frame_dic, smoothed_2d, depths, depth_confs, start_frame, center_xy_scale, center_z_scale, depth_smooth_times, is_ik, base_dir, now_str, contacts)
 
     # # 直立関連ファイルに情報出力
     # # 直立IDX
@@ -155,6 +179,8 @@ def position_list_to_vmd_multi(positions_multi, vmd_file, smoothed_file, bone_cs
         logger.info("FULL VMD出力開始")
         full_vmd_file = pos2vmd_utils.output_vmd(bone_frame_dic, vmd_file, is_ik, "full")
         logger.info("FULL VMDファイル出力完了: {0}".format(full_vmd_file))
+
+        return full_vmd_file
     else:
         # 間引き後キーVMD出力
         logger.info("間引き開始")
@@ -164,6 +190,8 @@ def position_list_to_vmd_multi(positions_multi, vmd_file, smoothed_file, bone_cs
         reduce_vmd_file = pos2vmd_utils.output_vmd(reduce_bone_frame_dic, vmd_file, is_ik, "reduce")
         logger.info("間引き VMDファイル出力完了: {0}".format(reduce_vmd_file))
 
+        return reduce_vmd_file
+
 
 
 def position_multi_file_to_vmd(position_file, position_gan_file, upright_file, vmd_file, smoothed_file, bone_csv_file, depth_file, start_frame_file, center_xy_scale, center_z_scale, smooth_times, threshold_pos, threshold_rot, is_ik, heelpos):
@@ -178,6 +206,148 @@ def position_multi_file_to_vmd(position_file, position_gan_file, upright_file, v
     position_list_to_vmd_multi(positions_multi, positions_gan_multi, upright_file, vmd_file, smoothed_file, bone_csv_file, depth_file, start_frame_file, center_xy_scale, center_z_scale, smooth_times, threshold_pos, threshold_rot, is_ik, heelpos)
     
 
+# 体格キャリブレーションを取得する
+# キャッシュ指定があり、関節位置を pos.txt から読み込んでいる場合は、pos.txt と同じディレクトリに保存したものを使う
+# 角度計算で補正した関節位置から求めるので、補正に関わる傾きモーション・可動域・3dpose-gan のファイルも保存ファイルの有効性の判定に含める
+def load_calibration(positions_multi, positions_gan_multi, bone_csv_file, slope_motion, is_cache):
+    position_file = positions_multi.position_file if is_cache else None
+
+    if positions_gan_multi is not None and positions_gan_multi.position_file is None:
+        # 3dpose-gan の読み込み元がわからない場合は保存しない
+        position_file = None
+
+    depend_files = [pos2vmd_rom.ROM_FILE]
+    if slope_motion is not None:
+        depend_files.append(slope_motion.slope_vmd_file)
+    if positions_gan_multi is not None:
+        depend_files.append(positions_gan_multi.position_file)
+
+    return pos2vmd_calibration.load_calibration(positions_multi.positions, bone_csv_file, position_file, depend_files)
+
+
+# 出力するVMDファイル名
+def make_vmd_file(base_dir, bone_csv_file, now_str, is_depth, is_ik, heelpos, centerz, depth_smooth_times, smooth_times, threshold_pos, threshold_rot, person_id=None):
+    suffix = ""
+
+    # 複数人の場合、人物ごとに分ける
+    if person_id is not None:
+        suffix = "{0}_人物{1}".format(suffix, person_id)
+
+    # ganは使用しない
+    # if os.path.exists(position_gan_file) == False:
+    #     suffix = "_ganなし"
+    
+    # ボーンCSVファイル名・拡張子
+    bone_filename, bone_fileext = os.path.splitext(os.path.basename(bone_csv_file))
+
+    if is_depth == False:
+        suffix = "{0}_depthなし".format(suffix)
+    
+    if is_ik == False:
+        suffix = "{0}_FK".format(suffix)
+    
+    # 踵位置補正
+    suffix = "{0}_h{1}".format(suffix, str(heelpos))
+    
+    # センターXY
+    # suffix = "{0}_xy{1}".format(suffix, str(centerxy))
+
+    # センターZ        
+    suffix = "{0}_z{1}".format(suffix, str(centerz))
+
+    # センターZ円滑化回数
+    suffix = "{0}_d{1}".format(suffix, str(depth_smooth_times))
+
+    # 円滑化回数
+    suffix = "{0}_s{1}".format(suffix, str(smooth_times))
+    
+    # 移動間引き
+    suffix = "{0}_p{1}".format(suffix, str(threshold_pos))
+    
+    # 回転間引き
+    suffix = "{0}_r{1}".format(suffix, str(threshold_rot))
+    
+    return "{0}/{3}_{1}{2}_[type].vmd".format(base_dir, now_str, suffix, bone_filename)
+
+
+# 複数のresultディレクトリをまとめて変換する
+# 入力の読み込みは並列に行い、読み込めたものから順に変換する
+# is_gan: 3dpose-gan のposファイル(pos_gan.txt)がある場合は併用する
+def batch_to_vmd_multi(targets, bone_csv_file, center_xy_scale, center_z_scale, depth_smooth_times, smooth_times, threshold_pos, threshold_rot, is_ik, heelpos, is_cache=False, workers=0, is_process=False, angle_workers=1, is_gan=False):
+    error_targets = []
+
+    for clip in pos2vmd_batch.iter_ingest(targets, workers, is_cache, is_process, is_gan=is_gan):
+        if isinstance(clip, pos2vmd_batch.ClipError):
+            logger.error("読み込み失敗: %s %s", clip.target, clip.error)
+            error_targets.append(clip.target)
+            continue
+
+        logger.info("変換開始: %s", clip.target)
+
+        positions_gan_multi = clip.read_positions_gan_multi()
+        if is_gan and positions_gan_multi is None:
+            logger.warning("3dpose-gan のposファイルがありません: %s", os.path.join(clip.base_dir, pos2vmd_batch.POSITION_GAN_FILE_NAME))
+
+        now_str = "{0:%Y%m%d_%H%M%S}".format(datetime.datetime.now())
+        vmd_file = make_vmd_file(clip.base_dir, bone_csv_file, now_str, clip.has_depth, is_ik, heelpos, center_z_scale, depth_smooth_times, smooth_times, threshold_pos, threshold_rot)
+
+        try:
+            position_list_to_vmd_multi(clip.read_positions_multi(), vmd_file, None, bone_csv_file, None, None, None, center_xy_scale, center_z_scale, depth_smooth_times, smooth_times, threshold_pos, threshold_rot, is_ik, heelpos, clip.base_dir, now_str, is_cache, clip, positions_gan_multi, angle_workers)
+        except Exception:
+            logger.exception("変換失敗: %s", clip.target)
+            error_targets.append(clip.target)
+
+    return error_targets
+
+
+# 複数人の追跡結果(pos2vmd_people.PersonTrack のリスト)を、1人1つのVMDとしてプロセスプールで並列に変換する
+# workers: プロセス数(0: CPU数、1: 並列化せずにこのプロセスで変換する)
+# 戻り値は (変換できたVMDファイルのリスト, 変換に失敗した人物IDのリスト)
+def people_to_vmd_multi(people, base_dir, bone_csv_file, center_xy_scale, center_z_scale, depth_smooth_times, smooth_times, threshold_pos, threshold_rot, is_ik, heelpos, workers=0):
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    now_str = "{0:%Y%m%d_%H%M%S}".format(datetime.datetime.now())
+    args = (base_dir, bone_csv_file, center_xy_scale, center_z_scale, depth_smooth_times, smooth_times, threshold_pos, threshold_rot, is_ik, heelpos, now_str)
+
+    vmd_files = []
+    error_ids = []
+
+    if workers == 1 or len(people) <= 1:
+        for person in people:
+            try:
+                vmd_files.append(person_to_vmd_multi(person, *args))
+            except Exception:
+                logger.exception("変換失敗: 人物%s", person.person_id)
+                error_ids.append(person.person_id)
+
+        return vmd_files, error_ids
+
+    logger.info("人物ごと変換 並列: workers=%s, 人数=%s", workers, len(people))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(people))) as executor:
+        futures = [(person.person_id, executor.submit(person_to_vmd_multi, person, *args)) for person in people]
+
+        for person_id, future in futures:
+            try:
+                vmd_files.append(future.result())
+            except Exception as e:
+                logger.error("変換失敗: 人物%s %s", person_id, e)
+                error_ids.append(person_id)
+
+    return vmd_files, error_ids
+
+
+# 1人分の追跡結果をVMDに変換する(ワーカープロセスで実行)
+def person_to_vmd_multi(person, base_dir, bone_csv_file, center_xy_scale, center_z_scale, depth_smooth_times, smooth_times, threshold_pos, threshold_rot, is_ik, heelpos, now_str):
+    logger.info("変換開始: 人物%s", person.person_id)
+
+    clip = person.to_clip(base_dir)
+    vmd_file = make_vmd_file(base_dir, bone_csv_file, now_str, clip.has_depth, is_ik, heelpos, center_z_scale, depth_smooth_times, smooth_times, threshold_pos, threshold_rot, person.person_id)
+
+    return position_list_to_vmd_multi(clip.read_positions_multi(), vmd_file, None, bone_csv_file, None, None, None, center_xy_scale, center_z_scale, depth_smooth_times, smooth_times, threshold_pos, threshold_rot, is_ik, heelpos, base_dir, now_str, bundle=clip)
+
+
 def main():
     import sys
     if (len(sys.argv) < 13):
@@ -218,13 +388,52 @@ def main():
     parser.add_argument('-e', '--heel-position', dest='heelpos', type=float,
                         default=0,
                         help='heel position correction')
+    parser.add_argument('-x', '--cache', dest='cache', type=int,
+                        default=1,
+                        help='parsed input cache (.npy)')
+    parser.add_argument('-n', '--bundle', dest='bundle', type=int,
+                        default=0,
+                        help='convert inputs to session bundle (.npz) before processing')
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=0,
+                        help='parallel ingest workers for multiple targets (0: cpu count)')
+    parser.add_argument('-m', '--ingest-process', dest='ingest_process', type=int,
+                        default=0,
+                        help='ingest multiple targets in processes instead of threads')
+    parser.add_argument('-a', '--angle-workers', dest='angle_workers', type=int,
+                        default=1,
+                        help='parallel processes for joint angle calculation (0: cpu count, 1: serial)')
+    parser.add_argument('-g', '--gan', dest='gan', type=int,
+                        default=0,
+                        help='use 3dpose-gan positions (pos_gan.txt) for large trunk rotations')
     args = parser.parse_args()
 
+    # カンマ区切りで複数のresultディレクトリが指定された場合、まとめて変換する
+    targets = [t for t in args.target.split(",") if len(t) > 0]
+    if len(targets) > 1:
+        logger.setLevel(level[args.verbose])
+
+        error_targets = batch_to_vmd_multi(targets, args.bone, args.centerxy, args.centerz, args.depth_smooth_times, args.smooth_times, args.threshold_pos, args.threshold_rot, \
+            args.legik == 1, args.heelpos, args.cache == 1, args.workers, args.ingest_process == 1, args.angle_workers, args.gan == 1)
+
+        if len(error_targets) > 0:
+            logger.error("変換できなかったディレクトリ: %s", ", ".join(error_targets))
+        return
+
     # resultディレクトリだけ指定させる
-    base_dir = args.target
+    # (バンドル(.npz)が指定された場合は、その置き場所をresultディレクトリとする)
+    bundle_file = None
+    if pos2vmd_bundle.is_bundle_file(args.target):
+        bundle_file = args.target
+        base_dir = os.path.dirname(os.path.abspath(bundle_file))
+    else:
+        base_dir = args.target
 
     is_ik = True if args.legik == 1 else False
 
+    # 解析済み入力のキャッシュを使うか
+    is_cache = True if args.cache == 1 else False
+
     # 入力と出力のファイル名は固定
     position_file = base_dir + "/pos.txt"
     smoothed_file = base_dir + "/smoothed.txt"
@@ -235,45 +444,19 @@ def main():
     # 3dpose-gan のposファイル。（ない可能性あり）
     position_gan_file = base_dir + "/pos_gan.txt"
 
-    suffix = ""
+    # バンドル作成指定がある場合、resultディレクトリのテキストファイルから作成する
+    if bundle_file is None and args.bundle == 1:
+        bundle_file = pos2vmd_bundle.convert_result_dir(base_dir, is_cache=is_cache)
 
-    # ganは使用しない
-    # if os.path.exists(position_gan_file) == False:
-    #     suffix = "_ganなし"
-    
-    # ボーンCSVファイル名・拡張子
-    bone_filename, bone_fileext = os.path.splitext(os.path.basename(args.bone))
-
-    if os.path.exists(depth_file) == False:
-        suffix = "{0}_depthなし".format(suffix)
-    
-    if is_ik == False:
-        suffix = "{0}_FK".format(suffix)
-    
-    # 踵位置補正
-    suffix = "{0}_h{1}".format(suffix, str(args.heelpos))
-    
-    # センターXY
-    # suffix = "{0}_xy{1}".format(suffix, str(args.centerxy))
-
-    # センターZ        
-    suffix = "{0}_z{1}".format(suffix, str(args.centerz))
+    bundle = None
+    if bundle_file is not None:
+        bundle = pos2vmd_bundle.load_bundle(bundle_file)
 
-    # センターZ円滑化回数
-    suffix = "{0}_d{1}".format(suffix, str(args.depth_smooth_times))
+    is_depth = bundle.has_depth if bundle is not None else os.path.exists(depth_file)
 
-    # 円滑化回数
-    suffix = "{0}_s{1}".format(suffix, str(args.smooth_times))
-    
-    # 移動間引き
-    suffix = "{0}_p{1}".format(suffix, str(args.threshold_pos))
-    
-    # 回転間引き
-    suffix = "{0}_r{1}".format(suffix, str(args.threshold_rot))
-    
     now_str = "{0:%Y%m%d_%H%M%S}".format(datetime.datetime.now())
 
-    vmd_file = "{0}/{3}_{1}{2}_[type].vmd".format(base_dir, now_str, suffix, bone_filename)
+    vmd_file = make_vmd_file(base_dir, args.bone, now_str, is_depth, is_ik, args.heelpos, args.centerz, args.depth_smooth_times, args.smooth_times, args.threshold_pos, args.threshold_rot)
 
     # #直立インデックスファイル
     # upright_file = open("{0}/upright.txt".format(base_dir), 'w')
@@ -288,9 +471,24 @@ def main():
     if args.upright_target != args.target and len(args.upright_target) > 0:
         upright_target = args.upright_target
 
-    positions_multi = pos2vmd_utils.read_positions_multi(position_file)
+    if bundle is not None:
+        positions_multi = bundle.read_positions_multi()
+    else:
+        positions_multi = pos2vmd_utils.read_positions_multi(position_file, is_cache)
+
+    # 3dpose-gan は指定があり、posファイルがある場合のみ使用する
+    positions_gan_multi = None
+    if args.gan == 1:
+        if os.path.exists(position_gan_file):
+            positions_gan_multi = pos2vmd_utils.read_positions_multi(position_gan_file, is_cache)
+        else:
+            logger.warning("3dpose-gan のposファイルがありません: %s", position_gan_file)
     
-    position_list_to_vmd_multi(positions_multi, vmd_file, smoothed_file, args.bone, depth_file, conf_file, start_frame_file, args.centerxy, args.centerz, args.depth_smooth_times, args.smooth_times, args.threshold_pos, args.threshold_rot, is_ik, args.heelpos, base_dir, now_str)
+    position_list_to_vmd_multi(positions_multi, vmd_file, smoothed_file, args.bone, depth_file, conf_file, start_frame_file, args.centerxy, args.centerz, args.depth_smooth_times, args.smooth_times, args.threshold_pos, args.threshold_rot, is_ik, args.heelpos, base_dir, now_str, is_cache, bundle, \
+        positions_gan_multi, args.angle_workers)
+
+    if bundle is not None:
+        bundle.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_parallel.py - 関節角度計算の並列化
+#
+# クリップをフレームのチャンクに分け、プロセスプールで関節角度の候補を計算する
+# 各フレームについて 3d-pose-baseline と 3dpose-gan の両方の体幹で候補を作っておき、
+# 前フレームとの連続性による3dpose-gan採用判定(resolve_gan_frames)は、全チャンクを繋げた後に先頭から順に行う
+
+import os
+import math
+import logging
+import concurrent.futures
+import numpy as np
+
+from applications import pos2vmd_frame
+from applications import pos2vmd_slope_table
+from applications import pos2vmd_rom
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# 1チャンクの最小フレーム数(これより短く分けてもプロセス間の受け渡しの方が重くなる)
+MIN_CHUNK_SIZE = 200
+
+# ワーカー1つあたりのチャンク数(チャンクごとの計算時間のばらつきを均す)
+CHUNKS_PER_WORKER = 4
+
+
+# 全フレーム分の関節角度を、チャンクに分けて並列に計算する
+# 結果は pos2vmd_frame.positions_to_frames と同じ
+# workers: プロセス数(0: CPU数、1: 並列化せずにこのプロセスで計算する)
+def positions_to_frames_parallel(bone_frame_dic, positions, positions_gan, is_upper2_body, slope_motion, workers=0, chunk_size=0, rom_table=None):
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    frame_num = positions.shape[0]
+    chunks = split_chunks(frame_num, workers, chunk_size)
+
+    if workers == 1 or len(chunks) <= 1:
+        pos2vmd_frame.positions_to_frames(bone_frame_dic, positions, is_upper2_body, slope_motion, positions_gan, rom_table)
+        return
+
+    logger.info("角度計算 並列: workers=%s, chunks=%s", workers, len(chunks))
+
+    # 傾きモーションは各プロセスで読み込み直す
+    slope_vmd_file = None if slope_motion is None else os.path.abspath(slope_motion.slope_vmd_file)
+
+    # 可動域テーブルは配列だけなので、そのまま渡す
+    if rom_table is None:
+        rom_table = pos2vmd_rom.load_rom_table()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        futures = []
+        for start, end in chunks:
+            chunk_positions_gan = None if positions_gan is None else np.array(positions_gan[start:end])
+            futures.append(executor.submit(calc_chunk_candidates, np.array(positions[start:end]), chunk_positions_gan, is_upper2_body, slope_vmd_file, rom_table))
+
+        candidates = pos2vmd_frame.concat_frame_candidates([f.result() for f in futures])
+
+    # 前フレームとの連続性を見て候補を選び、キーフレームとして登録する
+    pos2vmd_frame.set_candidate_frames(bone_frame_dic, positions, candidates)
+
+
+# チャンクの (開始フレーム, 終了フレーム) のリスト
+def split_chunks(frame_num, workers, chunk_size=0):
+    if chunk_size <= 0:
+        chunk_size = max(MIN_CHUNK_SIZE, int(math.ceil(frame_num / (workers * CHUNKS_PER_WORKER))))
+
+    return [(start, min(start + chunk_size, frame_num)) for start in range(0, frame_num, chunk_size)]
+
+
+# 1チャンク分の関節角度の候補を求める(ワーカープロセスで実行)
+def calc_chunk_candidates(positions, positions_gan, is_upper2_body, slope_vmd_file, rom_table):
+    slope_motion = None
+    if slope_vmd_file is not None:
+        slope_motion = pos2vmd_slope_table.load_slope_table(slope_vmd_file)
+
+    return pos2vmd_frame.calc_frame_candidates(positions, positions_gan, is_upper2_body, slope_motion, rom_table)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_people.py - 複数人の関節位置を1人ずつの追跡結果に分ける
+#
+# フレームごとに検出された人物(並び順はフレームごとにばらばら)を、2次元の中心位置が近いもの同士で
+# 前後のフレームと対応付け、1人分ずつの関節位置・関節二次元情報の配列にする
+# 対応付けは scipy があればハンガリアン法(linear_sum_assignment)、なければ距離の近い順の貪欲法で行う
+#
+# 1人分の配列は動画の全フレーム分の長さで、検出されなかったフレームは直前(先頭側は直後)の検出結果で埋める
+# (全員のVMDが動画の先頭フレームから揃うように)
+
+import logging
+import numpy as np
+
+from applications import pos2vmd_utils
+from applications import pos2vmd_batch
+
+try:
+    from scipy.optimize import linear_sum_assignment
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# 前フレームの人物と同一とみなす中心位置の距離(px)
+MAX_DISTANCE = 150
+# 見失ってから、同じ人物として再度対応付けるまでの最大フレーム数
+MAX_GAP = 30
+# これより検出フレーム数が少ない人物は誤検出として捨てる
+MIN_FRAMES = 10
+
+# Lifting-from-the-Deep の2次元関節(14関節)は、関節二次元情報(SMOOTHED_2D_INDEX)の先頭14関節と同じ並び
+# 目と耳はないので頭(Nose)の位置を使う
+LIFTING_2D_INDEX = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 0, 0, 0, 0]
+
+# 中心位置に使う関節
+CENTER_JOINTS = [pos2vmd_utils.SMOOTHED_2D_INDEX[k] for k in ["Neck", "RHip", "LHip"]]
+
+
+# 1人分の追跡結果
+class PersonTrack():
+    def __init__(self, person_id, positions, smoothed_2d, is_detected):
+        # 人物ID(登場順)
+        self.person_id = person_id
+        # 関節位置 (フレーム数, 17, 3)
+        self.positions = positions
+        # 関節二次元情報 (フレーム数, 18, 3)
+        self.smoothed_2d = smoothed_2d
+        # 実際に検出されたフレーム (フレーム数,)
+        self.is_detected = is_detected
+
+    def __len__(self):
+        return self.positions.shape[0]
+
+    def __repr__(self):
+        return "PersonTrack({0}, frames={1}, detected={2})".format(self.person_id, len(self), np.count_nonzero(self.is_detected))
+
+    # position_list_to_vmd_multi にバンドルの代わりに渡せる入力にする
+    def to_clip(self, base_dir):
+        target = "{0}#p{1}".format(base_dir, self.person_id)
+        return pos2vmd_batch.ClipInput(target, base_dir, self.positions, self.smoothed_2d, None, None, 0)
+
+
+# Lifting-from-the-Deep の3次元関節位置 (人数, 3, 17) を (人数, 17, 3) にする
+def convert_pose_3d(pose_3d):
+    pose_3d = np.asarray(pose_3d, dtype=np.float64).reshape(-1, 3, 17)
+
+    # 元データはz軸が垂直上向き。MMDに合わせるためにyとzを入れ替える。
+    return np.ascontiguousarray(pose_3d[:, [0, 2, 1], :].transpose(0, 2, 1))
+
+
+# Lifting-from-the-Deep の2次元関節位置 (人数, 14, 2) (並びは y, x) と可視フラグ (人数, 14) を
+# 関節二次元情報 (人数, 18, 3) (並びは x, y, 信頼度) にする
+def convert_pose_2d(pose_2d, visibility):
+    pose_2d = np.asarray(pose_2d, dtype=np.float64).reshape(-1, 14, 2)
+    visibility = np.asarray(visibility, dtype=np.float64).reshape(-1, 14)
+
+    smoothed_2d = np.zeros((pose_2d.shape[0], len(pos2vmd_utils.SMOOTHED_2D_INDEX), 3), dtype=np.float64)
+    smoothed_2d[:, :, pos2vmd_utils.SMOOTHED_2D_X] = pose_2d[:, LIFTING_2D_INDEX, 1]
+    smoothed_2d[:, :, pos2vmd_utils.SMOOTHED_2D_Y] = pose_2d[:, LIFTING_2D_INDEX, 0]
+    smoothed_2d[:, :, 2] = visibility[:, LIFTING_2D_INDEX]
+
+    return smoothed_2d
+
+
+# 人物ごとの2次元の中心位置 (人数, 2)
+# 首と両足の付け根の、信頼度で重み付けした平均(どれも見えていない場合は全関節の平均)
+def calc_centers(smoothed_2d):
+    xy = smoothed_2d[:, :, :2]
+    confs = smoothed_2d[:, :, 2]
+
+    weights = np.zeros_like(confs)
+    weights[:, CENTER_JOINTS] = confs[:, CENTER_JOINTS]
+
+    is_hidden = np.sum(weights, axis=1) <= 0
+    weights[is_hidden] = np.where(np.sum(confs[is_hidden], axis=1, keepdims=True) > 0, confs[is_hidden], 1)
+
+    return np.sum(xy * weights[..., np.newaxis], axis=1) / np.sum(weights, axis=1)[:, np.newaxis]
+
+
+# 距離行列 (追跡中の人数, 検出人数) から、対応付ける (追跡INDEX, 検出INDEX) のリストを返す
+# max_distance より遠い組み合わせは対応付けない
+def match_people(costs, max_distance):
+    if costs.size == 0:
+        return []
+
+    if HAS_SCIPY:
+        # 遠すぎる組み合わせは選ばれないよう大きな値にしておき、割り当て後に除く
+        rows, cols = linear_sum_assignment(np.where(costs > max_distance, max_distance * 1000 + 1, costs))
+        return [(r, c) for r, c in zip(rows.tolist(), cols.tolist()) if costs[r, c] <= max_distance]
+
+    # 距離の近い組み合わせから順に対応付ける
+    pairs = []
+    used_rows = set()
+    used_cols = set()
+    for n in np.argsort(costs, axis=None, kind="stable").tolist():
+        r, c = divmod(n, costs.shape[1])
+        if costs[r, c] > max_distance:
+            break
+        if r in used_rows or c in used_cols:
+            continue
+
+        pairs.append((r, c))
+        used_rows.add(r)
+        used_cols.add(c)
+
+    return pairs
+
+
+# フレームごとの中心位置のリストから、フレームごとの各検出の人物IDのリストを返す
+def associate_people(centers_list, max_distance=MAX_DISTANCE, max_gap=MAX_GAP):
+    person_ids_list = []
+
+    # 人物IDごとの最後に検出された中心位置とフレーム
+    last_centers = []
+    last_frames = []
+
+    for frame, centers in enumerate(centers_list):
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        person_ids = np.full(centers.shape[0], -1, dtype=np.int64)
+
+        # 見失ってから max_gap フレーム以内の人物を対応付けの候補とする
+        active_ids = [pid for pid, last_frame in enumerate(last_frames) if frame - last_frame <= max_gap]
+
+        if len(active_ids) > 0 and centers.shape[0] > 0:
+            active_centers = np.array([last_centers[pid] for pid in active_ids])
+            costs = np.linalg.norm(active_centers[:, np.newaxis] - centers[np.newaxis], axis=-1)
+
+            for r, c in match_people(costs, max_distance):
+                person_ids[c] = active_ids[r]
+
+        for c in range(centers.shape[0]):
+            if person_ids[c] < 0:
+                # 対応する人物がいない場合、新しい人物とする
+                person_ids[c] = len(last_centers)
+                last_centers.append(None)
+                last_frames.append(None)
+
+            last_centers[person_ids[c]] = centers[c]
+            last_frames[person_ids[c]] = frame
+
+        person_ids_list.append(person_ids)
+
+    return person_ids_list
+
+
+# フレームごとの複数人の検出結果を、1人分ずつの追跡結果(PersonTrack のリスト)に分ける
+# positions_list: フレームごとの関節位置 (人数, 17, 3)
+# smoothed_2d_list: フレームごとの関節二次元情報 (人数, 18, 3)
+def split_people(positions_list, smoothed_2d_list, max_distance=MAX_DISTANCE, max_gap=MAX_GAP, min_frames=MIN_FRAMES):
+    frame_num = len(positions_list)
+    person_ids_list = associate_people([calc_centers(s) for s in smoothed_2d_list], max_distance, max_gap)
+
+    person_num = max([int(np.max(ids)) + 1 for ids in person_ids_list if len(ids) > 0], default=0)
+    logger.info("人物対応付け: %s人 (ハンガリアン法: %s)", person_num, HAS_SCIPY)
+
+    people = []
+    for pid in range(person_num):
+        # 検出されたフレームと、そのフレームでの検出INDEX
+        detected_frames = []
+        detected_idxs = []
+        for frame, person_ids in enumerate(person_ids_list):
+            idxs = np.flatnonzero(person_ids == pid)
+            if len(idxs) > 0:
+                detected_frames.append(frame)
+                detected_idxs.append(int(idxs[0]))
+
+        if len(detected_frames) < min_frames:
+            logger.debug("人物除外(検出フレーム数不足): %s %s", pid, len(detected_frames))
+            continue
+
+        positions = np.stack([positions_list[f][i] for f, i in zip(detected_frames, detected_idxs)])
+        smoothed_2d = np.stack([smoothed_2d_list[f][i] for f, i in zip(detected_frames, detected_idxs)])
+
+        # 各フレームで使う検出結果(直前の検出、先頭側は最初の検出)
+        is_detected = np.zeros(frame_num, dtype=np.bool_)
+        is_detected[detected_frames] = True
+        fill_idxs = np.maximum(np.cumsum(is_detected) - 1, 0)
+
+        people.append(PersonTrack(len(people), positions[fill_idxs], smoothed_2d[fill_idxs], is_detected))
+
+    return people
+
+
+# 1人分の関節位置を pos.txt と同じ形式で出力する
+def write_positions(position_file, positions):
+    with open(position_file, "w") as fout:
+        for joints in positions:
+            # MMDに合わせて入れ替えたyとzを元に戻す
+            fout.write("".join("{0} {1:f} {2:f} {3:f}, ".format(j, v[0], v[2], v[1]) for j, v in enumerate(joints)))
+            fout.write("\n")
@@ -0,0 +1,649 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_qt.py - QVector3D / QVector4D / QQuaternion / QMatrix4x4
+#
+# PyQt5 がある場合はそのままQtの型を使い、ない場合は同じ計算をするPython実装を使う
+# 各モジュールは PyQt5.QtGui ではなく、ここから読み込む
+# 全フレーム分をまとめて計算する場合は pos2vmd_math を使う
+#
+# Python実装はQtと同じ式・同じ閾値で計算するが、値はfloatではなくdoubleで持つため、
+# 結果は下位の桁でQtと一致しないことがある
+# 環境変数 POS2VMD_NO_QT を指定した場合、PyQt5 があってもPython実装を使う
+
+import os
+import math
+import logging
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# qFuzzyIsNull の閾値(float / double)
+FUZZY_FLOAT = 0.00001
+FUZZY_DOUBLE = 0.000000000001
+
+
+def _is_fuzzy_null(v):
+    return abs(v) <= FUZZY_FLOAT
+
+
+def _is_fuzzy_null_double(v):
+    return abs(v) <= FUZZY_DOUBLE
+
+
+class Vector3D():
+    __slots__ = ("xp", "yp", "zp")
+
+    def __init__(self, *args):
+        if len(args) == 0:
+            self.xp = self.yp = self.zp = 0.0
+        elif len(args) == 1:
+            # QVector3D(QVector3D), QVector3D(QVector4D)
+            v = args[0]
+            self.xp, self.yp, self.zp = float(v.x()), float(v.y()), float(v.z())
+        elif len(args) == 2:
+            # QVector3D(QVector2D, z) 相当
+            self.xp, self.yp, self.zp = float(args[0].x()), float(args[0].y()), float(args[1])
+        else:
+            self.xp, self.yp, self.zp = float(args[0]), float(args[1]), float(args[2])
+
+    def x(self):
+        return self.xp
+
+    def y(self):
+        return self.yp
+
+    def z(self):
+        return self.zp
+
+    def setX(self, x):
+        self.xp = float(x)
+
+    def setY(self, y):
+        self.yp = float(y)
+
+    def setZ(self, z):
+        self.zp = float(z)
+
+    def isNull(self):
+        return _is_fuzzy_null(self.xp) and _is_fuzzy_null(self.yp) and _is_fuzzy_null(self.zp)
+
+    def lengthSquared(self):
+        return self.xp * self.xp + self.yp * self.yp + self.zp * self.zp
+
+    def length(self):
+        return math.sqrt(self.lengthSquared())
+
+    def normalized(self):
+        # 長さがほぼ1のものはそのまま、ほぼ0のものは0ベクトル
+        len2 = self.lengthSquared()
+        if _is_fuzzy_null_double(len2 - 1):
+            return Vector3D(self)
+        elif _is_fuzzy_null_double(len2) == False:
+            sqrt_len = math.sqrt(len2)
+            return Vector3D(self.xp / sqrt_len, self.yp / sqrt_len, self.zp / sqrt_len)
+
+        return Vector3D()
+
+    def normalize(self):
+        v = self.normalized()
+        self.xp, self.yp, self.zp = v.xp, v.yp, v.zp
+
+    def distanceToPoint(self, point):
+        return (self - point).length()
+
+    def toVector4D(self):
+        return Vector4D(self.xp, self.yp, self.zp, 0)
+
+    def toTuple(self):
+        return (self.xp, self.yp, self.zp)
+
+    @staticmethod
+    def crossProduct(v1, v2):
+        return Vector3D(v1.yp * v2.zp - v1.zp * v2.yp, v1.zp * v2.xp - v1.xp * v2.zp, v1.xp * v2.yp - v1.yp * v2.xp)
+
+    @staticmethod
+    def dotProduct(v1, v2):
+        return v1.xp * v2.xp + v1.yp * v2.yp + v1.zp * v2.zp
+
+    def __add__(self, other):
+        return Vector3D(self.xp + other.xp, self.yp + other.yp, self.zp + other.zp)
+
+    def __sub__(self, other):
+        return Vector3D(self.xp - other.xp, self.yp - other.yp, self.zp - other.zp)
+
+    def __mul__(self, other):
+        if isinstance(other, Vector3D):
+            return Vector3D(self.xp * other.xp, self.yp * other.yp, self.zp * other.zp)
+        return Vector3D(self.xp * other, self.yp * other, self.zp * other)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, Vector3D):
+            return Vector3D(self.xp / other.xp, self.yp / other.yp, self.zp / other.zp)
+        return Vector3D(self.xp / other, self.yp / other, self.zp / other)
+
+    def __neg__(self):
+        return Vector3D(-self.xp, -self.yp, -self.zp)
+
+    def __eq__(self, other):
+        return isinstance(other, Vector3D) and self.xp == other.xp and self.yp == other.yp and self.zp == other.zp
+
+    def __ne__(self, other):
+        return self.__eq__(other) == False
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "PyQt5.QtGui.QVector3D({0}, {1}, {2})".format(self.xp, self.yp, self.zp)
+
+
+class Vector4D():
+    __slots__ = ("xp", "yp", "zp", "wp")
+
+    def __init__(self, *args):
+        if len(args) == 0:
+            self.xp = self.yp = self.zp = self.wp = 0.0
+        elif len(args) == 1:
+            # QVector4D(QVector3D) は w=0
+            v = args[0]
+            self.xp, self.yp, self.zp = float(v.x()), float(v.y()), float(v.z())
+            self.wp = float(v.w()) if isinstance(v, Vector4D) else 0.0
+        elif len(args) == 2:
+            # QVector4D(QVector3D, w)
+            v = args[0]
+            self.xp, self.yp, self.zp, self.wp = float(v.x()), float(v.y()), float(v.z()), float(args[1])
+        else:
+            self.xp, self.yp, self.zp, self.wp = float(args[0]), float(args[1]), float(args[2]), float(args[3])
+
+    def x(self):
+        return self.xp
+
+    def y(self):
+        return self.yp
+
+    def z(self):
+        return self.zp
+
+    def w(self):
+        return self.wp
+
+    def setX(self, x):
+        self.xp = float(x)
+
+    def setY(self, y):
+        self.yp = float(y)
+
+    def setZ(self, z):
+        self.zp = float(z)
+
+    def setW(self, w):
+        self.wp = float(w)
+
+    def lengthSquared(self):
+        return self.xp * self.xp + self.yp * self.yp + self.zp * self.zp + self.wp * self.wp
+
+    def length(self):
+        return math.sqrt(self.lengthSquared())
+
+    def toVector3D(self):
+        return Vector3D(self.xp, self.yp, self.zp)
+
+    def __add__(self, other):
+        return Vector4D(self.xp + other.xp, self.yp + other.yp, self.zp + other.zp, self.wp + other.wp)
+
+    def __sub__(self, other):
+        return Vector4D(self.xp - other.xp, self.yp - other.yp, self.zp - other.zp, self.wp - other.wp)
+
+    def __mul__(self, other):
+        return Vector4D(self.xp * other, self.yp * other, self.zp * other, self.wp * other)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        return Vector4D(self.xp / other, self.yp / other, self.zp / other, self.wp / other)
+
+    def __neg__(self):
+        return Vector4D(-self.xp, -self.yp, -self.zp, -self.wp)
+
+    def __eq__(self, other):
+        return isinstance(other, Vector4D) and (self.xp, self.yp, self.zp, self.wp) == (other.xp, other.yp, other.zp, other.wp)
+
+    def __ne__(self, other):
+        return self.__eq__(other) == False
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "PyQt5.QtGui.QVector4D({0}, {1}, {2}, {3})".format(self.xp, self.yp, self.zp, self.wp)
+
+
+class Quaternion():
+    __slots__ = ("wp", "xp", "yp", "zp")
+
+    def __init__(self, *args):
+        if len(args) == 0:
+            self.wp, self.xp, self.yp, self.zp = 1.0, 0.0, 0.0, 0.0
+        elif len(args) == 1:
+            # QQuaternion(QVector4D) は (x, y, z, w)
+            v = args[0]
+            self.wp, self.xp, self.yp, self.zp = float(v.w()), float(v.x()), float(v.y()), float(v.z())
+        elif len(args) == 2:
+            # QQuaternion(scalar, QVector3D)
+            v = args[1]
+            self.wp, self.xp, self.yp, self.zp = float(args[0]), float(v.x()), float(v.y()), float(v.z())
+        else:
+            self.wp, self.xp, self.yp, self.zp = float(args[0]), float(args[1]), float(args[2]), float(args[3])
+
+    def scalar(self):
+        return self.wp
+
+    def x(self):
+        return self.xp
+
+    def y(self):
+        return self.yp
+
+    def z(self):
+        return self.zp
+
+    def setScalar(self, w):
+        self.wp = float(w)
+
+    def setX(self, x):
+        self.xp = float(x)
+
+    def setY(self, y):
+        self.yp = float(y)
+
+    def setZ(self, z):
+        self.zp = float(z)
+
+    def setVector(self, *args):
+        v = Vector3D(*args)
+        self.xp, self.yp, self.zp = v.xp, v.yp, v.zp
+
+    def vector(self):
+        return Vector3D(self.xp, self.yp, self.zp)
+
+    def toVector4D(self):
+        return Vector4D(self.xp, self.yp, self.zp, self.wp)
+
+    def isNull(self):
+        return self.wp == 0 and self.xp == 0 and self.yp == 0 and self.zp == 0
+
+    def isIdentity(self):
+        return self.wp == 1 and self.xp == 0 and self.yp == 0 and self.zp == 0
+
+    def lengthSquared(self):
+        return self.wp * self.wp + self.xp * self.xp + self.yp * self.yp + self.zp * self.zp
+
+    def length(self):
+        return math.sqrt(self.lengthSquared())
+
+    def normalized(self):
+        len2 = self.lengthSquared()
+        if _is_fuzzy_null_double(len2 - 1):
+            return Quaternion(self.wp, self.xp, self.yp, self.zp)
+        elif _is_fuzzy_null_double(len2) == False:
+            sqrt_len = math.sqrt(len2)
+            return Quaternion(self.wp / sqrt_len, self.xp / sqrt_len, self.yp / sqrt_len, self.zp / sqrt_len)
+
+        return Quaternion(0, 0, 0, 0)
+
+    def normalize(self):
+        q = self.normalized()
+        self.wp, self.xp, self.yp, self.zp = q.wp, q.xp, q.yp, q.zp
+
+    def inverted(self):
+        # 長さがほぼ0の場合は0クォータニオン
+        len2 = self.lengthSquared()
+        if _is_fuzzy_null_double(len2) == False:
+            return Quaternion(self.wp / len2, -self.xp / len2, -self.yp / len2, -self.zp / len2)
+
+        return Quaternion(0, 0, 0, 0)
+
+    def conjugated(self):
+        return Quaternion(self.wp, -self.xp, -self.yp, -self.zp)
+
+    def rotatedVector(self, v):
+        return (self * Quaternion(0, v.x(), v.y(), v.z()) * self.conjugated()).vector()
+
+    def toEulerAngles(self):
+        xx = self.xp * self.xp
+        xy = self.xp * self.yp
+        xz = self.xp * self.zp
+        xw = self.xp * self.wp
+        yy = self.yp * self.yp
+        yz = self.yp * self.zp
+        yw = self.yp * self.wp
+        zz = self.zp * self.zp
+        zw = self.zp * self.wp
+
+        # 長さが1でない場合、正規化したのと同じになるよう割る
+        len2 = xx + yy + zz + self.wp * self.wp
+        if _is_fuzzy_null(len2 - 1) == False and _is_fuzzy_null(len2) == False:
+            xx, xy, xz, xw, yy, yz, yw, zz, zw = [v / len2 for v in [xx, xy, xz, xw, yy, yz, yw, zz, zw]]
+
+        sinp = -2 * (yz - xw)
+        if 1 - abs(sinp) <= FUZZY_FLOAT:
+            # ジンバルロック(X軸回転がほぼ±90度)の場合、Z軸回転は0として、Y軸回転にまとめる
+            pitch = math.copysign(math.pi / 2, sinp)
+            yaw = 2 * math.atan2(self.yp, self.wp)
+            roll = 0.0
+        else:
+            pitch = math.asin(sinp)
+            yaw = math.atan2(2 * (xz + yw), 1 - 2 * (xx + yy))
+            roll = math.atan2(2 * (xy + zw), 1 - 2 * (xx + zz))
+
+        return Vector3D(math.degrees(pitch), math.degrees(yaw), math.degrees(roll))
+
+    # 回転行列 [行][列]
+    def toRotationMatrix(self):
+        f2x = self.xp + self.xp
+        f2y = self.yp + self.yp
+        f2z = self.zp + self.zp
+        f2xw = f2x * self.wp
+        f2yw = f2y * self.wp
+        f2zw = f2z * self.wp
+        f2xx = f2x * self.xp
+        f2xy = f2x * self.yp
+        f2xz = f2x * self.zp
+        f2yy = f2y * self.yp
+        f2yz = f2y * self.zp
+        f2zz = f2z * self.zp
+
+        return [
+            [1 - (f2yy + f2zz), f2xy - f2zw, f2xz + f2yw],
+            [f2xy + f2zw, 1 - (f2xx + f2zz), f2yz - f2xw],
+            [f2xz - f2yw, f2yz + f2xw, 1 - (f2xx + f2yy)]
+        ]
+
+    @staticmethod
+    def dotProduct(q1, q2):
+        return q1.wp * q2.wp + q1.xp * q2.xp + q1.yp * q2.yp + q1.zp * q2.zp
+
+    @staticmethod
+    def fromAxisAndAngle(*args):
+        if len(args) == 2:
+            axis, angle = Vector3D(args[0]), args[1]
+        else:
+            axis, angle = Vector3D(args[0], args[1], args[2]), args[3]
+
+        a = math.radians(angle / 2)
+        s = math.sin(a)
+        c = math.cos(a)
+        ax = axis.normalized()
+
+        return Quaternion(c, ax.xp * s, ax.yp * s, ax.zp * s).normalized()
+
+    @staticmethod
+    def fromEulerAngles(*args):
+        if len(args) == 1:
+            pitch, yaw, roll = args[0].x(), args[0].y(), args[0].z()
+        else:
+            pitch, yaw, roll = args
+
+        pitch = math.radians(pitch) * 0.5
+        yaw = math.radians(yaw) * 0.5
+        roll = math.radians(roll) * 0.5
+
+        c1 = math.cos(yaw)
+        s1 = math.sin(yaw)
+        c2 = math.cos(roll)
+        s2 = math.sin(roll)
+        c3 = math.cos(pitch)
+        s3 = math.sin(pitch)
+        c1c2 = c1 * c2
+        s1s2 = s1 * s2
+
+        return Quaternion(c1c2 * c3 + s1s2 * s3, c1c2 * s3 + s1s2 * c3, s1 * c2 * c3 - c1 * s2 * s3, c1 * s2 * c3 - s1 * c2 * s3)
+
+    # 回転行列 [行][列] からクォータニオン
+    @staticmethod
+    def fromRotationMatrix(m):
+        if hasattr(m, "__getitem__") == False:
+            # QMatrix3x3 相当(m(行, 列))
+            m = [[m(r, c) for c in range(3)] for r in range(3)]
+
+        trace = m[0][0] + m[1][1] + m[2][2]
+        if trace > 0.00000001:
+            s = 2 * math.sqrt(trace + 1)
+            return Quaternion(0.25 * s, (m[2][1] - m[1][2]) / s, (m[0][2] - m[2][0]) / s, (m[1][0] - m[0][1]) / s)
+
+        # 対角成分が最大の軸を基準にする
+        i = 0
+        if m[1][1] > m[0][0]:
+            i = 1
+        if m[2][2] > m[i][i]:
+            i = 2
+        j = (i + 1) % 3
+        k = (j + 1) % 3
+
+        s = 2 * math.sqrt(m[i][i] - m[j][j] - m[k][k] + 1)
+        axis = [0.0, 0.0, 0.0]
+        axis[i] = 0.25 * s
+        axis[j] = (m[j][i] + m[i][j]) / s
+        axis[k] = (m[k][i] + m[i][k]) / s
+
+        return Quaternion((m[k][j] - m[j][k]) / s, axis[0], axis[1], axis[2])
+
+    @staticmethod
+    def fromAxes(x_axis, y_axis, z_axis):
+        return Quaternion.fromRotationMatrix([
+            [x_axis.x(), y_axis.x(), z_axis.x()],
+            [x_axis.y(), y_axis.y(), z_axis.y()],
+            [x_axis.z(), y_axis.z(), z_axis.z()]
+        ])
+
+    @staticmethod
+    def fromDirection(direction, up):
+        # 向きがない場合は単位クォータニオン
+        if direction.isNull():
+            return Quaternion()
+
+        z_axis = direction.normalized()
+        x_axis = Vector3D.crossProduct(up, z_axis)
+        # 上方向が向きと平行(もしくは不正)な場合、Z軸からの最短回転
+        if _is_fuzzy_null(x_axis.lengthSquared()):
+            return Quaternion.rotationTo(Vector3D(0, 0, 1), z_axis)
+
+        x_axis = x_axis.normalized()
+        y_axis = Vector3D.crossProduct(z_axis, x_axis)
+
+        return Quaternion.fromAxes(x_axis, y_axis, z_axis)
+
+    @staticmethod
+    def rotationTo(v_from, v_to):
+        v0 = v_from.normalized()
+        v1 = v_to.normalized()
+
+        d = Vector3D.dotProduct(v0, v1) + 1
+        if _is_fuzzy_null(d):
+            # 逆向きの場合、どの軸で回してもよい
+            axis = Vector3D.crossProduct(Vector3D(1, 0, 0), v0)
+            if _is_fuzzy_null(axis.lengthSquared()):
+                axis = Vector3D.crossProduct(Vector3D(0, 1, 0), v0)
+            axis = axis.normalized()
+
+            return Quaternion(0, axis.xp, axis.yp, axis.zp)
+
+        d = math.sqrt(2 * d)
+        axis = Vector3D.crossProduct(v0, v1) / d
+
+        return Quaternion(d * 0.5, axis.xp, axis.yp, axis.zp).normalized()
+
+    @staticmethod
+    def slerp(q1, q2, t):
+        if t <= 0:
+            return Quaternion(q1.wp, q1.xp, q1.yp, q1.zp)
+        elif t >= 1:
+            return Quaternion(q2.wp, q2.xp, q2.yp, q2.zp)
+
+        # 遠回りしないよう、内積が負の場合は反転する
+        q2b = Quaternion(q2.wp, q2.xp, q2.yp, q2.zp)
+        dot = Quaternion.dotProduct(q1, q2)
+        if dot < 0:
+            q2b = -q2b
+            dot = -dot
+
+        # 角度が小さすぎる場合は線形補間
+        factor1 = 1 - t
+        factor2 = t
+        if (1 - dot) > 0.0000001:
+            angle = math.acos(min(dot, 1))
+            sin_angle = math.sin(angle)
+            if sin_angle > 0.0000001:
+                factor1 = math.sin((1 - t) * angle) / sin_angle
+                factor2 = math.sin(t * angle) / sin_angle
+
+        return q1 * factor1 + q2b * factor2
+
+    @staticmethod
+    def nlerp(q1, q2, t):
+        if t <= 0:
+            return Quaternion(q1.wp, q1.xp, q1.yp, q1.zp)
+        elif t >= 1:
+            return Quaternion(q2.wp, q2.xp, q2.yp, q2.zp)
+
+        q2b = Quaternion(q2.wp, q2.xp, q2.yp, q2.zp)
+        if Quaternion.dotProduct(q1, q2) < 0:
+            q2b = -q2b
+
+        return (q1 * (1 - t) + q2b * t).normalized()
+
+    def __mul__(self, other):
+        if isinstance(other, Quaternion):
+            w1, x1, y1, z1 = self.wp, self.xp, self.yp, self.zp
+            w2, x2, y2, z2 = other.wp, other.xp, other.yp, other.zp
+
+            return Quaternion(
+                w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2
+            )
+        elif isinstance(other, Vector3D):
+            return self.rotatedVector(other)
+
+        return Quaternion(self.wp * other, self.xp * other, self.yp * other, self.zp * other)
+
+    def __rmul__(self, other):
+        return Quaternion(self.wp * other, self.xp * other, self.yp * other, self.zp * other)
+
+    def __truediv__(self, other):
+        return Quaternion(self.wp / other, self.xp / other, self.yp / other, self.zp / other)
+
+    def __add__(self, other):
+        return Quaternion(self.wp + other.wp, self.xp + other.xp, self.yp + other.yp, self.zp + other.zp)
+
+    def __sub__(self, other):
+        return Quaternion(self.wp - other.wp, self.xp - other.xp, self.yp - other.yp, self.zp - other.zp)
+
+    def __neg__(self):
+        return Quaternion(-self.wp, -self.xp, -self.yp, -self.zp)
+
+    def __eq__(self, other):
+        return isinstance(other, Quaternion) and (self.wp, self.xp, self.yp, self.zp) == (other.wp, other.xp, other.yp, other.zp)
+
+    def __ne__(self, other):
+        return self.__eq__(other) == False
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "PyQt5.QtGui.QQuaternion({0}, {1}, {2}, {3})".format(self.wp, self.xp, self.yp, self.zp)
+
+
+# 4x4行列 [行][列]
+class Matrix4x4():
+    __slots__ = ("m",)
+
+    def __init__(self, *args):
+        if len(args) == 16:
+            self.m = [[float(v) for v in args[r * 4:r * 4 + 4]] for r in range(4)]
+        else:
+            self.m = [[1.0 if r == c else 0.0 for c in range(4)] for r in range(4)]
+
+    def __call__(self, row, column):
+        return self.m[row][column]
+
+    def isIdentity(self):
+        return all(self.m[r][c] == (1 if r == c else 0) for r in range(4) for c in range(4))
+
+    def setToIdentity(self):
+        self.m = [[1.0 if r == c else 0.0 for c in range(4)] for r in range(4)]
+
+    # 移動を掛ける(this * 移動行列)
+    def translate(self, *args):
+        v = Vector3D(*args)
+        m = self.m
+        for r in range(4):
+            m[r][3] += m[r][0] * v.xp + m[r][1] * v.yp + m[r][2] * v.zp
+
+    # 回転を掛ける(this * 回転行列)
+    # rotate(QQuaternion) もしくは rotate(角度, 軸)
+    def rotate(self, *args):
+        if len(args) == 1:
+            q = args[0]
+        elif len(args) == 2:
+            q = Quaternion.fromAxisAndAngle(args[1], args[0])
+        else:
+            q = Quaternion.fromAxisAndAngle(args[1], args[2], args[3], args[0])
+
+        rot = Matrix4x4()
+        for r, row in enumerate(q.toRotationMatrix()):
+            rot.m[r][:3] = row
+
+        self.m = (self * rot).m
+
+    def column(self, index):
+        return Vector4D(*[self.m[r][index] for r in range(4)])
+
+    def row(self, index):
+        return Vector4D(*self.m[index])
+
+    def __mul__(self, other):
+        if isinstance(other, Matrix4x4):
+            result = Matrix4x4()
+            result.m = [[sum(self.m[r][k] * other.m[k][c] for k in range(4)) for c in range(4)] for r in range(4)]
+            return result
+        elif isinstance(other, Vector4D):
+            v = (other.xp, other.yp, other.zp, other.wp)
+            return Vector4D(*[sum(self.m[r][k] * v[k] for k in range(4)) for r in range(4)])
+        elif isinstance(other, Vector3D):
+            # 位置として変換する(w で割る)
+            v = self * Vector4D(other, 1)
+            if v.wp == 0 or v.wp == 1:
+                return v.toVector3D()
+            return v.toVector3D() / v.wp
+
+        result = Matrix4x4()
+        result.m = [[self.m[r][c] * other for c in range(4)] for r in range(4)]
+        return result
+
+    def __eq__(self, other):
+        return isinstance(other, Matrix4x4) and self.m == other.m
+
+    def __ne__(self, other):
+        return self.__eq__(other) == False
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "PyQt5.QtGui.QMatrix4x4({0})".format(", ".join(str(v) for row in self.m for v in row))
+
+
+HAS_QT = False
+if not os.environ.get("POS2VMD_NO_QT"):
+    try:
+        from PyQt5.QtGui import QQuaternion, QVector4D, QVector3D, QMatrix4x4
+        HAS_QT = True
+    except ImportError:
+        logger.debug("PyQt5 がないため、Python実装のベクトル・クォータニオンを使います")
+
+if HAS_QT == False:
+    QVector3D = Vector3D
+    QVector4D = Vector4D
+    QQuaternion = Quaternion
+    QMatrix4x4 = Matrix4x4
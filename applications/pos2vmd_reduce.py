@@ -1,82 +1,88 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 #
-from PyQt5.QtGui import QQuaternion, QVector4D, QVector3D, QMatrix4x4
 import logging
-import math
+import numpy as np
+
+from applications import pos2vmd_math
 
 logger = logging.getLogger("__main__").getChild(__name__)
 
 def reduce_frames(bone_frame_dic, is_groove, threshold_pos, threshold_rot):
     reduce_bone_frame_dic = {}
 
-    for key in bone_frame_dic.keys():
+    for key, track in bone_frame_dic.items():
         # logger.debug("key %s", key)
-        if len(bone_frame_dic[key]) > 0 and ((is_groove == False and key != "グルーブ") or is_groove):
+        if len(track) > 0 and ((is_groove == False and key != "グルーブ") or is_groove):
             if is_groove and key == "グルーブ":
-                reduce_bone_frame_dic[key] = reduce_bone_frame(bone_frame_dic[key], 0, len(bone_frame_dic[key]) - 1, threshold_pos / 2, threshold_rot)
+                reduce_idxs = reduce_bone_frame(track, 0, len(track) - 1, threshold_pos / 2, threshold_rot)
             else:
-                reduce_bone_frame_dic[key] = reduce_bone_frame(bone_frame_dic[key], 0, len(bone_frame_dic[key]) - 1, threshold_pos, threshold_rot)
+                reduce_idxs = reduce_bone_frame(track, 0, len(track) - 1, threshold_pos, threshold_rot)
+
+            reduce_bone_frame_dic[key] = track.take(reduce_idxs)
 
     return reduce_bone_frame_dic
 
-# キーフレームを間引く
+# キーフレームを間引く(残すキーフレームのINDEXのリストを返す)
 # オリジナル：https://github.com/errno-mmd/smoothvmd/blob/master/reducevmd.cc
-def reduce_bone_frame(v, head, tail, threshold_pos, threshold_rot):
-    # 移動のエラー最大値
-    max_pos_err = float(0.0)
-    # 回転のエラー最大値
-    max_rot_err = float(0.0)
-    # 移動：エラー最大値のindex
-    max_idx_pos = 0
-    # 回転：エラー最大値のindex
-    max_idx_rot = 0
+# 区間内の全フレームの誤差はまとめて計算し、区間の分割は再帰の代わりにスタックで行う
+def reduce_bone_frame(track, head, tail, threshold_pos, threshold_rot):
+    reduce_idxs = []
+
+    # 先頭側の区間から順に処理する
+    sections = [(head, tail)]
+    while len(sections) > 0:
+        head, tail = sections.pop()
+
+        max_idx_pos, max_pos_err, max_idx_rot, max_rot_err = calc_reduce_error(track, head, tail)
+
+        if max_pos_err > threshold_pos:
+            sections.append((max_idx_pos, tail))
+            sections.append((head, max_idx_pos))
+        elif max_rot_err > threshold_rot:
+            sections.append((max_idx_rot, tail))
+            sections.append((head, max_idx_rot))
+        else:
+            reduce_idxs.append(head)
+
+    return reduce_idxs
+
+# 区間の両端から補間した場合の、移動・回転のエラー最大値とそのINDEX
+def calc_reduce_error(track, head, tail):
     # 最初から最後までのフレーム数
     total = tail - head
 
-    for i in range(head + 1, tail , 1):
-        # 移動
-        ip_pos = v[head].position + (v[tail].position - v[head].position) * (i - head) / total
-        pos_err = (ip_pos - v[i].position).length()
-
-        if pos_err > max_pos_err:
-            max_idx_pos = i
-            max_pos_err = pos_err
-
-        t = float(i - head) / total
-
-        # 回転
-        ip_rot = QQuaternion.slerp(v[head].rotation, v[tail].rotation, t)
-        q_err = (ip_rot * v[i].rotation.inverted()).normalized()
-
-        # フィルタではなく、ここで正負反転させてプラスに寄せる
-        if q_err.scalar() < 0:
-            q_err.setX(q_err.x() * -1)
-            q_err.setY(q_err.y() * -1)
-            q_err.setX(q_err.z() * -1)
-            q_err.setScalar(q_err.scalar() * -1)
-            
-        #  math.acos(q_err.scalar()) * 2 * 180 / math.pi
-        rot_err = math.degrees(math.acos(q_err.scalar()))
-        # logger.info("rot_err: %s, %s", rot_err, max_rot_err)
-        
-        if rot_err > max_rot_err:
-            max_idx_rot = i
-            max_rot_err = rot_err
-
-    v1 = []
-    if max_pos_err > threshold_pos:
-        v1 = reduce_bone_frame(v, head, max_idx_pos, threshold_pos, threshold_rot)
-        v2 = reduce_bone_frame(v, max_idx_pos, tail, threshold_pos, threshold_rot)
-        
-        v1.extend(v2)
-    else:
-        if max_rot_err > threshold_rot:
-            v1 = reduce_bone_frame(v, head, max_idx_rot, threshold_pos, threshold_rot)
-            v2 = reduce_bone_frame(v, max_idx_rot, tail, threshold_pos, threshold_rot)
-
-            v1.extend(v2)
-        else:
-            v1.append(v[head])
+    idxs = np.arange(head + 1, tail)
+    if len(idxs) == 0:
+        return 0, 0.0, 0, 0.0
+
+    positions = track.positions
+    rotations = track.rotations
+
+    # 移動
+    ip_pos = positions[head] + (positions[tail] - positions[head]) * (idxs - head)[:, np.newaxis] / total
+    pos_errs = pos2vmd_math.length(ip_pos - positions[idxs])
+
+    t = (idxs - head) / total
+
+    # 回転
+    ip_rot = pos2vmd_math.slerp(rotations[head], rotations[tail], t)
+    q_err = pos2vmd_math.normalized(pos2vmd_math.multiply(ip_rot, pos2vmd_math.inverted(rotations[idxs])))
+
+    # 正負反転させてプラスに寄せる
+    rot_errs = np.degrees(np.arccos(np.clip(np.abs(q_err[:, pos2vmd_math.QW]), 0, 1)))
+
+    max_idx_pos, max_pos_err = find_max_error(idxs, pos_errs)
+    max_idx_rot, max_rot_err = find_max_error(idxs, rot_errs)
+
+    return max_idx_pos, max_pos_err, max_idx_rot, max_rot_err
+
+# エラー最大値(同じ値の場合は先のもの)とそのINDEX、0より大きいものがない場合は 0, 0
+def find_max_error(idxs, errs):
+    errs = np.where(np.isnan(errs), 0, errs)
+    n = int(np.argmax(errs))
+
+    if errs[n] > 0:
+        return int(idxs[n]), float(errs[n])
 
-    return v1
+    return 0, 0.0
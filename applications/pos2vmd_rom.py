@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_rom.py - 関節可動域(ROM)テーブル
+#
+# ボーンごとのオイラー角(X, Y, Z)の可動域を rom/config_rom.json から読み込み、
+# 複数ボーン・全フレーム分の回転 (フレーム数, ボーン数, 4) をまとめて可動域内に収める
+# 参考: http://www.japanpt.or.jp/upload/jspt/obj/files/publiccomment/4_rom_20140612.pdf
+#
+# config_rom.json の形式(可動域のないボーンは制限しない)
+#   { "ボーン名": {"x": [最小, 最大], "y": [最小, 最大], "z": [最小, 最大]}, ... }
+
+import os
+import json
+import logging
+import numpy as np
+from os.path import dirname, realpath
+
+from applications import pos2vmd_math
+from applications import pos2vmd_cache
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# 標準の可動域ファイル(カレントディレクトリによらず、プロジェクトの rom/ を読む)
+ROM_FILE = os.path.join(realpath(dirname(realpath(__file__)) + '/..'), "rom", "config_rom.json")
+
+
+class RomTable():
+    def __init__(self, limits):
+        # ボーン名の並び
+        self.bone_names = list(limits.keys())
+        # ボーンごとの最小値・最大値 (ボーン数, 3) 並びは (x, y, z)
+        self.mins = np.array([[limits[b][axis][0] for axis in ["x", "y", "z"]] for b in self.bone_names], dtype=np.float64).reshape(-1, 3)
+        self.maxs = np.array([[limits[b][axis][1] for axis in ["x", "y", "z"]] for b in self.bone_names], dtype=np.float64).reshape(-1, 3)
+
+    def __contains__(self, bone_name):
+        return bone_name in self.bone_names
+
+    # 複数ボーン・全フレーム分の回転 (..., ボーン数, 4) をまとめて可動域内に収める
+    # bone_names は回転の並びのボーン名。可動域のないボーンの回転はそのまま返す
+    def clamp(self, rotations, bone_names):
+        rotations = np.asarray(rotations, dtype=np.float64)
+
+        idxs = [n for n, bone_name in enumerate(bone_names) if bone_name in self]
+        if len(idxs) == 0:
+            return rotations
+
+        table_idxs = [self.bone_names.index(bone_names[n]) for n in idxs]
+
+        euler = pos2vmd_math.to_euler_angles(rotations[..., idxs, :])
+        euler = np.clip(euler, self.mins[table_idxs], self.maxs[table_idxs])
+
+        clamped = rotations.copy()
+        clamped[..., idxs, :] = pos2vmd_math.from_euler_angles(euler)
+
+        return clamped
+
+
+# 可動域ファイルを読み込んでテーブルにする
+def read_rom_table(rom_file):
+    with open(rom_file, "r", encoding="utf-8") as f:
+        rom_table = RomTable(json.load(f))
+
+    logger.debug("可動域読み込み: %s %s", rom_file, rom_table.bone_names)
+
+    return rom_table
+
+
+# 可動域テーブルを取得する(読み込んだテーブルはパスと更新日時で覚えておく)
+def load_rom_table(rom_file=ROM_FILE):
+    return pos2vmd_cache.load_by_mtime(rom_file, read_rom_table)
+
+
+# 覚えている可動域テーブルを破棄する
+def clear_rom_table_cache():
+    pos2vmd_cache.clear_mtime_cache(read_rom_table)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_skeleton.py - 3次元関節位置の骨格定義
+#
+# 関節名とINDEXの対応、ボーンごとの (親関節, 子関節, 上方向の基準) を宣言的に定義し、
+# NumPyのINDEX配列にしておく。全フレーム・複数ボーン分の向きと上方向を、1回のINDEX参照でまとめて求める
+#
+# ボーンの向きは 子関節 - 親関節、上方向は 向き × (上方向の基準の終点 - 始点) の外積(正規化済み)
+# 関節の並びが異なる3次元姿勢推定の出力にも、Skeleton を定義すれば同じ計算で対応できる
+
+import logging
+import collections
+import numpy as np
+
+from applications import pos2vmd_math
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# ボーン定義
+# parent, child: 向きの始点・終点の関節名
+# up_from, up_to: 上方向の基準(向きとの外積を上方向とする)の始点・終点の関節名
+BoneDef = collections.namedtuple("BoneDef", ["parent", "child", "up_from", "up_to"])
+
+
+class Skeleton():
+    def __init__(self, name, joint_names, bones):
+        self.name = name
+        # 関節名の並び
+        self.joint_names = list(joint_names)
+        self.joints = {joint_name: n for n, joint_name in enumerate(self.joint_names)}
+        # ボーン名とボーン定義
+        self.bones = collections.OrderedDict((bone_name, BoneDef(*bone)) for bone_name, bone in bones)
+
+        # ボーン定義を関節INDEXの配列にしておく (ボーン数, 4) 並びは BoneDef と同じ
+        self.bone_names = list(self.bones.keys())
+        self.bone_idxs = {bone_name: n for n, bone_name in enumerate(self.bone_names)}
+        self.bone_points = np.array([[self.joints[j] for j in bone] for bone in self.bones.values()], dtype=np.int64).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.joint_names)
+
+    def __contains__(self, joint_name):
+        return joint_name in self.joints
+
+    # 関節名のINDEX(リストを指定した場合はINDEXのリスト)
+    def index(self, joint_name):
+        if isinstance(joint_name, str):
+            return self.joints[joint_name]
+
+        return [self.joints[j] for j in joint_name]
+
+    # ボーン定義の関節INDEX (ボーン数, 4)
+    def compile(self, bone_names):
+        return self.bone_points[[self.bone_idxs[b] for b in bone_names]]
+
+    # 全フレーム分の関節位置 (..., 関節数, 3) から、ボーンごとの向きと上方向 (..., ボーン数, 3) を求める
+    def gather(self, pos, bone_names):
+        points = self.compile(bone_names)
+        # 全ボーンの4関節を1回で取り出す (..., ボーン数, 4, 3)
+        joints = np.asarray(pos)[..., points, :]
+
+        direction = joints[..., 1, :] - joints[..., 0, :]
+        up = pos2vmd_math.normalized(pos2vmd_math.cross_product(direction, joints[..., 3, :] - joints[..., 2, :]))
+
+        return direction, up
+
+
+# 3d-pose-baseline (Human3.6M) の17関節
+H36M_JOINT_NAMES = ["Hip", "RHip", "RKnee", "RFoot", "LHip", "LKnee", "LFoot", "Spine", "Thorax", "Neck/Nose", "Head", \
+                    "LShoulder", "LElbow", "LWrist", "RShoulder", "RElbow", "RWrist"]
+
+# ボーン名: (親関節, 子関節, 上方向の基準の始点, 終点)
+# 「:gan」は3dpose-gan で体幹が決定されている場合の定義
+H36M_BONES = [
+    ("上半身", ("Hip", "Spine", "LShoulder", "RShoulder")),
+    ("上半身2", ("Spine", "Thorax", "LShoulder", "RShoulder")),
+    ("下半身", ("Spine", "Hip", "RHip", "LHip")),
+    ("首", ("Thorax", "Neck/Nose", "LShoulder", "RShoulder")),
+    ("頭", ("Neck/Nose", "Head", "Spine", "Thorax")),
+    ("首:gan", ("Thorax", "Neck/Nose", "RShoulder", "LShoulder")),
+    ("頭:gan", ("Neck/Nose", "Head", "RShoulder", "LShoulder")),
+    ("左肩", ("Thorax", "LShoulder", "LShoulder", "RShoulder")),
+    ("左腕", ("LShoulder", "LElbow", "LElbow", "LWrist")),
+    ("左ひじ", ("LElbow", "LWrist", "LElbow", "LShoulder")),
+    ("右肩", ("Thorax", "RShoulder", "RShoulder", "LShoulder")),
+    ("右腕", ("RShoulder", "RElbow", "RElbow", "RWrist")),
+    ("右ひじ", ("RElbow", "RWrist", "RElbow", "RShoulder")),
+    ("左足", ("LHip", "LKnee", "LKnee", "LFoot")),
+    ("左ひざ", ("LKnee", "LFoot", "LKnee", "LHip")),
+    ("右足", ("RHip", "RKnee", "RKnee", "RFoot")),
+    ("右ひざ", ("RKnee", "RFoot", "RKnee", "RHip")),
+]
+
+H36M = Skeleton("h36m", H36M_JOINT_NAMES, H36M_BONES)
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 #
 # 初期状態の傾きを定義するモーションデータの出力処理
-from PyQt5.QtGui import QQuaternion, QVector4D, QVector3D, QMatrix4x4
+from applications.pos2vmd_qt import QQuaternion, QVector4D, QVector3D, QMatrix4x4
 import logging
 import argparse
 import glob
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_slope_table.py - 初期傾きモーションの補正テーブル
+#
+# 傾きモーション(slope/*.vmd)の各ボーンの先頭フレームの回転をオイラー角にしておき、
+# 関節角度のY軸の回転具合に応じた補正回転を、全フレーム分まとめて求める
+
+import logging
+import numpy as np
+
+from applications.VmdReader import VmdReader
+from applications import pos2vmd_math
+from applications import pos2vmd_cache
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+
+class SlopeTable():
+    def __init__(self, slope_vmd_file, motion):
+        self.slope_vmd_file = slope_vmd_file
+        # 読み込んだ傾きモーション
+        self.motion = motion
+
+        # ボーンごとの傾きのオイラー角 (3,)
+        self.eulers = {}
+
+        for bone_name, frames in motion.frames.items():
+            if len(frames) == 0:
+                continue
+
+            self.eulers[bone_name] = pos2vmd_math.to_euler_angles(pos2vmd_math.from_qquaternion(frames[0].rotation))
+
+    # 傾きモーションのキーフレーム(VmdMotion.frames と同じ)
+    @property
+    def frames(self):
+        return self.motion.frames
+
+    def __contains__(self, bone_name):
+        return bone_name in self.eulers
+
+    # 全フレーム分の補正回転 (..., 4)
+    # bone_name にボーン名のリストを指定した場合、y_degrees の最後の軸をボーンの並びとして、ボーンごとの補正回転 (..., ボーン数, 4) を返す
+    def get_corrections(self, bone_name, y_degrees):
+        y_degrees = np.asarray(y_degrees, dtype=np.float64)
+
+        if isinstance(bone_name, str):
+            eulers = self.eulers[bone_name]
+        else:
+            eulers = np.stack([self.eulers[b] for b in bone_name])
+
+        return pos2vmd_math.inverted(pos2vmd_math.from_euler_angles(eulers * y_degrees[..., np.newaxis]))
+
+    # 回転(全フレーム分)から補正回転を求める
+    def calc_corrections(self, bone_name, rotations):
+        return self.get_corrections(bone_name, calc_y_degrees(rotations))
+
+
+# Y軸の回転具合 (真正面(0度)で1、真後ろ(±180度)で0)
+def calc_y_degrees(rotations):
+    return (180 - np.abs(pos2vmd_math.to_euler_angles(rotations)[..., 1])) / 180
+
+
+# 傾きモーションを読み込んで補正テーブルにする
+def read_slope_table(slope_vmd_file):
+    return SlopeTable(slope_vmd_file, VmdReader().read_vmd_file(slope_vmd_file))
+
+
+# 補正テーブルを取得する(読み込んだテーブルはパスと更新日時で覚えておく)
+def load_slope_table(slope_vmd_file):
+    return pos2vmd_cache.load_by_mtime(slope_vmd_file, read_slope_table)
+
+
+# 覚えている補正テーブルを破棄する
+def clear_slope_table_cache():
+    pos2vmd_cache.clear_mtime_cache(read_slope_table)
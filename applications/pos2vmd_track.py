@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pos2vmd_track.py - ボーンごとのキーフレーム列
+#
+# 1ボーン分のキーフレームを、フレーム番号・位置・回転の配列としてまとめて持つ
+# bone_frame_dic の値として、VmdBoneFrame のリストの代わりに使う
+# 従来どおり bone_frame_dic[ボーン名][n] で1フレームずつ参照した場合は、配列の行を指す BoneFrameView を返す
+#
+# BoneFrameView.position / rotation は配列の値から毎回作った QVector3D / QQuaternion なので、
+# bf.position.setZ(z) のように取り出した値を書き換えても配列には反映されない
+# 書き換える場合は bf.position = v のように代入するか、track.positions を直接書き換える
+#
+# 回転のオイラー角(track.eulers)は、初めて参照した時に全キーフレーム分まとめて求めて覚えておく
+# track.rotations への代入や bf.rotation = q では覚えたオイラー角を破棄するが、
+# track.rotations[n] = q のように配列を直接書き換えた場合は invalidate_eulers を呼ぶ
+
+import logging
+import numpy as np
+
+from applications.pos2vmd_qt import QQuaternion, QVector3D
+from applications import pos2vmd_math
+
+logger = logging.getLogger("__main__").getChild(__name__)
+
+# VMDのボーンキーフレーム1件分の並び(111Byte)
+VMD_BONE_FRAME_DTYPE = np.dtype([
+    ("name", "S15"),
+    ("frame", "<u4"),
+    ("position", "<f4", (3,)),
+    ("rotation", "<f4", (4,)),
+    ("interpolation", "u1", (64,))
+])
+
+
+# 1ボーン分のキーフレーム列
+class BoneTrack():
+    __slots__ = ("bone_name", "name", "frames", "positions", "_rotations", "_eulers")
+
+    def __init__(self, bone_name, frames=None, positions=None, rotations=None):
+        # ボーン名(bone_frame_dic のキー)
+        self.bone_name = bone_name
+        # VMDに出力するボーン名(Shift-JIS)
+        self.name = bone_name.encode("shift-jis")
+
+        if frames is None:
+            frames = np.zeros(0, dtype=np.int64)
+        frames = np.array(frames, dtype=np.int64).reshape(-1)
+
+        # フレーム番号 (キーフレーム数,)
+        self.frames = frames
+        # 位置 (キーフレーム数, 3)
+        self.positions = np.zeros((len(frames), 3)) if positions is None else np.array(positions, dtype=np.float64).reshape(-1, 3)
+        # 回転 (キーフレーム数, 4) 並びは (w, x, y, z)
+        self.rotations = identity_rotations(len(frames)) if rotations is None else np.array(rotations, dtype=np.float64).reshape(-1, 4)
+
+    @property
+    def rotations(self):
+        return self._rotations
+
+    @rotations.setter
+    def rotations(self, rotations):
+        self._rotations = rotations
+        self._eulers = None
+
+    # 回転のオイラー角 (キーフレーム数, 3) 並びは (x, y, z)、単位は度
+    # 全キーフレーム分まとめて求めて覚えておく(読み取り専用)
+    @property
+    def eulers(self):
+        if self._eulers is None:
+            eulers = pos2vmd_math.to_euler_angles(self._rotations)
+            eulers.flags.writeable = False
+            self._eulers = eulers
+
+        return self._eulers
+
+    # オイラー角から回転を設定する
+    # is_frames を指定した場合、Trueのキーフレームのみ書き換える
+    def set_eulers(self, eulers, is_frames=None):
+        rotations = pos2vmd_math.from_euler_angles(eulers)
+
+        if is_frames is None:
+            self.rotations = rotations
+        else:
+            new_rotations = self._rotations.copy()
+            new_rotations[is_frames] = rotations[is_frames]
+            self.rotations = new_rotations
+
+    # 覚えているオイラー角を破棄する(回転の配列を直接書き換えた場合)
+    def invalidate_eulers(self):
+        self._eulers = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return self.take(np.arange(len(self))[n])
+
+        if n < 0:
+            n += len(self)
+        if n < 0 or n >= len(self):
+            raise IndexError("BoneTrack index out of range: {0} {1}".format(self.bone_name, n))
+
+        return BoneFrameView(self, n)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield BoneFrameView(self, n)
+
+    def __repr__(self):
+        return "BoneTrack({0}, frames={1})".format(self.bone_name, len(self))
+
+    # フレームを全て入れ替える
+    def set_frames(self, frames, positions=None, rotations=None):
+        track = BoneTrack(self.bone_name, frames, positions, rotations)
+        self.frames, self.positions, self.rotations = track.frames, track.positions, track.rotations
+
+    # VmdBoneFrame(もしくは BoneFrameView)を1件追加する
+    # 1件ずつ配列を作り直すので、まとめて作れる場合は set_frames を使う
+    def append(self, bf):
+        self.extend([bf])
+
+    def extend(self, bfs):
+        bfs = list(bfs)
+        if len(bfs) == 0:
+            return
+
+        frames = [bf.frame for bf in bfs]
+        positions = [(bf.position.x(), bf.position.y(), bf.position.z()) for bf in bfs]
+        rotations = [(bf.rotation.scalar(), bf.rotation.x(), bf.rotation.y(), bf.rotation.z()) for bf in bfs]
+
+        self.frames = np.concatenate([self.frames, np.asarray(frames, dtype=np.int64)])
+        self.positions = np.concatenate([self.positions, np.asarray(positions, dtype=np.float64)])
+        self.rotations = np.concatenate([self.rotations, np.asarray(rotations, dtype=np.float64)])
+
+    # キーフレームを全て除去する
+    def clear(self):
+        self.set_frames([])
+
+    # 指定したINDEXのキーフレームだけを持つ新しいトラック
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        return BoneTrack(self.bone_name, self.frames[indices], self.positions[indices], self.rotations[indices])
+
+    def copy(self):
+        return BoneTrack(self.bone_name, self.frames, self.positions, self.rotations)
+
+    # VMDのボーンキーフレームの並びに変換する
+    def to_records(self):
+        records = np.zeros(len(self), dtype=VMD_BONE_FRAME_DTYPE)
+        records["name"] = self.name
+        records["frame"] = self.frames
+        records["position"] = self.positions
+        # VMDの回転は (x, y, z, w) の並び
+        records["rotation"] = self.rotations[:, [1, 2, 3, 0]]
+
+        return records
+
+    # VMDファイルに書き込む(VmdBoneFrame.write と同じ形式で全キーフレーム分)
+    def write(self, fout):
+        fout.write(self.to_records().tobytes())
+
+
+# トラックの1キーフレーム分(VmdBoneFrame と同じように読み書きできる)
+class BoneFrameView():
+    __slots__ = ("track", "index")
+
+    def __init__(self, track, index):
+        self.track = track
+        self.index = index
+
+    @property
+    def name(self):
+        return self.track.name
+
+    @property
+    def frame(self):
+        return int(self.track.frames[self.index])
+
+    @frame.setter
+    def frame(self, frame):
+        self.track.frames[self.index] = frame
+
+    @property
+    def position(self):
+        return QVector3D(*self.track.positions[self.index].tolist())
+
+    @position.setter
+    def position(self, v):
+        self.track.positions[self.index] = (v.x(), v.y(), v.z())
+
+    @property
+    def rotation(self):
+        return QQuaternion(*self.track.rotations[self.index].tolist())
+
+    @rotation.setter
+    def rotation(self, q):
+        self.track.rotations[self.index] = (q.scalar(), q.x(), q.y(), q.z())
+        self.track.invalidate_eulers()
+
+    def write(self, fout):
+        fout.write(self.track.take([self.index]).to_records().tobytes())
+
+
+# 単位クォータニオンの配列
+def identity_rotations(frame_num):
+    rotations = np.zeros((frame_num, 4), dtype=np.float64)
+    rotations[:, 0] = 1
+    return rotations
+
+
+# 全フレーム分のトラック(位置は原点、回転はなし)
+def make_track(bone_name, frame_num):
+    return BoneTrack(bone_name, np.arange(frame_num))
+
+
+# ボーンキーフレーム数の合計
+def count_frames(bone_frame_dic):
+    return sum(len(v) for v in bone_frame_dic.values())
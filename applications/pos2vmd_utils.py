@@ -1,33 +1,33 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 #
-from PyQt5.QtGui import QQuaternion, QVector4D, QVector3D, QMatrix4x4
+from applications.pos2vmd_qt import QQuaternion, QVector4D, QVector3D, QMatrix4x4
 import logging
-import csv
-import re
+import io
+import itertools
+import collections
 import os
 import numpy as np
+from os.path import dirname, realpath
 
 from applications.VmdWriter import VmdWriter, VmdInfoIk, VmdShowIkFrame
 from applications.VmdReader import VmdReader, VmdMotion
+from applications import pos2vmd_cache, pos2vmd_bone, pos2vmd_slope_table
 
 logger = logging.getLogger("__main__").getChild(__name__)
 
+# 傾きモーションのディレクトリ(カレントディレクトリによらず、プロジェクトの slope/ を読む)
+SLOPE_DIR = os.path.join(realpath(dirname(realpath(__file__)) + '/..'), "slope")
+
 def output_vmd(bone_frame_dic, vmd_file, is_ik, vmd_type):
     writer = VmdWriter()
-    
-    # ディクショナリ型の疑似二次元配列から、一次元配列に変換
-    bone_frames = []
-    for k,v in bone_frame_dic.items():
-        for bf in v:
-            bone_frames.append(bf)
 
     # vmd出力ファイルにフレーム番号再設定
     output_vmd_file = vmd_file.replace("[type]", vmd_type)
 
-    # writer.write_vmd_file(vmd_file, bone_frames, showik_frames, expression_frames)
+    # ボーンごとのキーフレーム列を、ディクショナリの順にそのまま出力する
     showik_frames = make_showik_frames(is_ik)
-    writer.write_vmd_file(output_vmd_file, bone_frames, showik_frames)
+    writer.write_vmd_tracks(output_vmd_file, list(bone_frame_dic.values()), showik_frames)
 
     return output_vmd_file
 
@@ -77,38 +77,30 @@ def load_upright_target(upright_target):
 def set_groove(bone_frame_dic, bone_csv_file):
 
     # グルーブボーンがあるか
-    is_groove = False
-    # ボーンファイルを開く
-    with open(bone_csv_file, "r", encoding=get_file_encoding(bone_csv_file)) as bf:
-        reader = csv.reader(bf)
-
-        for row in reader:
-            if row[1] == "グルーブ" or row[2].lower() == "groove":
-                is_groove = True
-                break
+    is_groove = pos2vmd_bone.load_bone_model(bone_csv_file).has_groove
 
     if is_groove:
 
-        for n in range(len(bone_frame_dic["センター"])):
-            # logger.debug("グルーブ移管 frame={0}".format(n))
+        center_positions = bone_frame_dic["センター"].positions
+        groove_positions = bone_frame_dic["グルーブ"].positions
 
-            # グルーブがある場合、Y軸をグルーブに設定
-            bone_frame_dic["グルーブ"][n].position = QVector3D(0, bone_frame_dic["センター"][n].position.y(), 0)
-            bone_frame_dic["センター"][n].position = QVector3D(bone_frame_dic["センター"][n].position.x(), 0, bone_frame_dic["センター"][n].position.z())
+        # グルーブがある場合、Y軸をグルーブに設定
+        groove_positions[:] = 0
+        groove_positions[:, 1] = center_positions[:, 1]
+        center_positions[:, 1] = 0
 
     return is_groove
 
 
 
-# 初期傾きモーションデータ読み込み
+# 初期傾きモーションデータ読み込み(ボーンごとの補正テーブルにして返す)
 def load_slope_vmd(is_upper2_body):
-    reader = VmdReader()
     if is_upper2_body:
         # 上半身2がある場合
-        return reader.read_vmd_file("slope/slope_upper2.vmd")
+        return pos2vmd_slope_table.load_slope_table(os.path.join(SLOPE_DIR, "slope_upper2.vmd"))
     else:
         # 標準ボーンのみの場合
-        return reader.read_vmd_file("slope/slope_normal.vmd")
+        return pos2vmd_slope_table.load_slope_table(os.path.join(SLOPE_DIR, "slope_normal.vmd"))
 
 
 
@@ -120,32 +112,76 @@ def load_start_frame(start_frame_file):
 
 
 
+# キャッシュ指定がある場合、解析済みの.npyを経由して読み込む
+def load_with_cache(src_file, kind, loader, is_cache):
+    if is_cache:
+        return pos2vmd_cache.load_cached(src_file, kind, loader)
+
+    return loader(src_file)
+
+
 #複数フレームの読み込み
-def read_positions_multi(position_file):
+def read_positions_multi(position_file, is_cache=False):
     """Read joint position data"""
-    f = open(position_file, "r")
+    # 配列でまとめて読み込み、positions[frame][joint] で参照できるビューを返す
+    return PositionList(load_with_cache(position_file, "pos", load_positions, is_cache), position_file)
 
-    positions = []
-    while True:
-        line = f.readline()
-        if not line:
-            break
-        line = line.rstrip('\n')
-
-        # 一旦カンマで複数行に分解
-        inposition = []
-        for inline in re.split(",\s*", line):
-            if inline:
-                # 1フレーム分に分解したら、空白で分解
-                a = re.split(' ', inline)
-                # print(a)
-                # 元データはz軸が垂直上向き。MMDに合わせるためにyとzを入れ替える。
-                q = QVector3D(float(a[1]), float(a[3]), float(a[2])) # a[0]: index
-                inposition.append(q) # a[0]: index
-        
-        positions.append(inposition)
-    f.close()
-    return positions
+
+# 関節位置データを一括で読み込み、(フレーム数, 関節数, 3)の配列で返す
+def load_positions(position_file, dtype=np.float64):
+    with open(position_file, "r") as f:
+        return parse_positions(f.read(), dtype)
+
+# pos.txt 形式の文字列を配列に変換する
+def parse_positions(text, dtype=np.float64):
+    # 「index x y z, 」の並びなので、カンマを空白にしてまとめて数値化する
+    values = np.loadtxt(io.StringIO(text.replace(",", " ")), dtype=dtype, ndmin=2)
+
+    # 1行 = 1フレーム、1関節 = (index, x, y, z)
+    values = values.reshape(values.shape[0], -1, 4)
+
+    # 元データはz軸が垂直上向き。MMDに合わせるためにyとzを入れ替える。
+    return np.ascontiguousarray(values[:, :, [1, 3, 2]])
+
+
+# 関節位置の配列を positions[frame][joint] で QVector3D として参照するためのビュー
+# position_file は読み込み元の pos.txt(バンドルなど、ファイルから読み込んでいない場合はNone)
+class PositionList():
+    def __init__(self, positions, position_file=None):
+        self.positions = positions
+        self.position_file = position_file
+
+    def __len__(self):
+        return self.positions.shape[0]
+
+    def __getitem__(self, frame):
+        return PositionFrame(self.positions[frame])
+
+    def __iter__(self):
+        for frame in range(len(self)):
+            yield self[frame]
+
+
+# 1フレーム分のビュー。代入すると元の配列に書き戻す
+class PositionFrame():
+    __slots__ = ("joints",)
+
+    def __init__(self, joints):
+        self.joints = joints
+
+    def __len__(self):
+        return self.joints.shape[0]
+
+    def __getitem__(self, joint):
+        v = self.joints[joint]
+        return QVector3D(v[0], v[1], v[2])
+
+    def __setitem__(self, joint, value):
+        self.joints[joint] = (value.x(), value.y(), value.z())
+
+    def __iter__(self):
+        for joint in range(len(self)):
+            yield self[joint]
 
 
 DEPTH_INDEX = {
@@ -171,33 +207,35 @@ DEPTH_INDEX = {
 }
 
 # depthファイルの読み込み
-def load_depth(depth_file, conf_file):
+# 深度と信頼度を (フレーム数, 列数) の配列で返す
+def load_depth(depth_file, conf_file, is_cache=False):
     if os.path.exists(depth_file) == False or os.path.exists(conf_file) == False:
         return None, None
 
-    depths = []
-    depth_confs = []
+    depths = load_with_cache(depth_file, "depth", load_depth_table, is_cache)
+    depth_confs = load_with_cache(conf_file, "conf", load_depth_table, is_cache)
 
-    # n = 0
-    # 深度ファイルからフレームINDEXを取得する
-    with open(depth_file, "r") as bf:
-        # カンマ区切りなので、csvとして読み込む
-        reader = csv.reader(bf)
+    if depths.shape[0] != depth_confs.shape[0]:
+        raise ValueError("深度ファイルと信頼度ファイルのフレーム数が一致しません: {0}={1}, {2}={3}".format(depth_file, depths.shape[0], conf_file, depth_confs.shape[0]))
 
-        for row in reader:
-            depths.append([float(x.zfill(1)) for x in row])
+    return depths, depth_confs
 
-            # n += 1
-    # 深度ファイルからフレームINDEXを取得する
-    with open(conf_file, "r") as bf:
-        # カンマ区切りなので、csvとして読み込む
-        reader = csv.reader(bf)
+# 深度(信頼度)ファイルを数値の表として読み込む
+def load_depth_table(depth_file):
+    with open(depth_file, "r") as bf:
+        return parse_depth_table(bf.read())
 
-        for row in reader:
-            depth_confs.append([float(x.zfill(1)) for x in row])
+# 深度(信頼度)形式の文字列を配列に変換する
+def parse_depth_table(text):
+    # 空欄は0として扱うため、文字列の置換で0を埋めてからカンマ区切りで数値化する
+    # 途中の空欄は ",," を、行末・行頭の空欄は ",\n" と "\n," を置換する
+    # (",,," のような連続した空欄は1回の置換では半分しか埋まらないので ",," は2回置換する)
+    text = "\n" + text.replace("\r", "").rstrip("\n") + "\n"
+    text = text.replace(",,", ",0,").replace(",,", ",0,").replace(",\n", ",0\n").replace("\n,", "\n0,")
 
-    return depths, depth_confs
+    return np.loadtxt(io.StringIO(text), dtype=np.float64, delimiter=",", ndmin=2)
 
+# 関節2次元情報の関節INDEX(load_smoothed_2d の配列の2次元目)
 SMOOTHED_2D_INDEX = {
     "Nose": 0,
     "Neck": 1,
@@ -216,46 +254,104 @@ SMOOTHED_2D_INDEX = {
     "REye": 14,
     "LEye": 15,
     "REar": 16,
-    "LEar": 17,
-    "Background": 18
+    "LEar": 17
 }
 
+# 関節2次元情報の値INDEX(load_smoothed_2d の配列の3次元目)
+SMOOTHED_2D_X = 0
+SMOOTHED_2D_Y = 1
+SMOOTHED_2D_CONF = 2
+
 # 関節2次元情報を取得
-def load_smoothed_2d(smoothed_file):
-    # １次元：フレーム数分
-    # ２次元：OpenposeのINDEX分
-    smoothed_2d = [[0 for i in range(19)] for j in range(sum(1 for line in open(smoothed_file)))]
-    n = 0
-    with open(smoothed_file, "r") as sf:
-        line = sf.readline() # 1行を文字列として読み込む(改行文字も含まれる)
-        
-        while line:
-            # 空白で複数項目に分解
-            smoothed = re.split("\s+", line)
-
-            # logger.debug(smoothed)
-
-            # 首の位置
-            smoothed_2d[n][SMOOTHED_2D_INDEX["Neck"]] = QVector3D(float(smoothed[2]), float(smoothed[3]), 0)
-            # 右足付け根
-            smoothed_2d[n][SMOOTHED_2D_INDEX["RHip"]] = QVector3D(float(smoothed[16]), float(smoothed[17]), 0)
-            # 左足付け根
-            smoothed_2d[n][SMOOTHED_2D_INDEX["LHip"]] = QVector3D(float(smoothed[22]), float(smoothed[23]), 0)
-            # 右ひざ
-            smoothed_2d[n][SMOOTHED_2D_INDEX["RKnee"]] = QVector3D(float(smoothed[18]), float(smoothed[19]), 0)
-            # 左ひざ
-            smoothed_2d[n][SMOOTHED_2D_INDEX["LKnee"]] = QVector3D(float(smoothed[24]), float(smoothed[25]), 0)
-            # 右足首
-            smoothed_2d[n][SMOOTHED_2D_INDEX["RAnkle"]] = QVector3D(float(smoothed[20]), float(smoothed[21]), 0)
-            # 左足首
-            smoothed_2d[n][SMOOTHED_2D_INDEX["LAnkle"]] = QVector3D(float(smoothed[26]), float(smoothed[27]), 0)
-        
-            n += 1
+# (フレーム数, 18, 3) の配列で、3次元目は x, y, 信頼度
+def load_smoothed_2d(smoothed_file, is_cache=False):
+    table = load_with_cache(smoothed_file, "smoothed", load_smoothed_table, is_cache)
+
+    return smoothed_table_to_2d(table)
+
+# smoothed.txt の表を (フレーム数, 18, 3) の配列に変換する
+def smoothed_table_to_2d(table):
+    joint_num = len(SMOOTHED_2D_INDEX)
+
+    smoothed_2d = np.ones((table.shape[0], joint_num, 3), dtype=np.float64)
+
+    if table.shape[1] >= joint_num * 3:
+        # 関節ごとに x y 信頼度 が並んでいる場合
+        smoothed_2d[:] = table[:, :joint_num * 3].reshape(-1, joint_num, 3)
+    elif table.shape[1] >= joint_num * 2:
+        # 関節ごとに x y が並んでいる場合、信頼度は1とする
+        smoothed_2d[:, :, :2] = table[:, :joint_num * 2].reshape(-1, joint_num, 2)
+    else:
+        raise ValueError("smoothed.txt の列数が足りません: {0}".format(table.shape[1]))
 
-            line = sf.readline()
-    
     return smoothed_2d
 
+# 指定フレーム・関節の2次元位置をQVector3Dで取得する
+def get_smoothed_2d_vector(smoothed_2d, frame, joint_name):
+    v = smoothed_2d[frame, SMOOTHED_2D_INDEX[joint_name]]
+    return QVector3D(v[SMOOTHED_2D_X], v[SMOOTHED_2D_Y], 0)
+
+# smoothed.txt を数値の表として読み込む(空白区切り)
+def load_smoothed_table(smoothed_file):
+    return np.loadtxt(smoothed_file, dtype=np.float64, ndmin=2)
+
+# smoothed.txt 形式の行を配列に変換する
+def parse_smoothed_table(lines):
+    return np.loadtxt(lines, dtype=np.float64, ndmin=2)
+
+
+# 各入力ファイルのフレーム単位の塊
+# start: 塊の先頭フレームINDEX
+# positions: (フレーム数, 関節数, 3), smoothed: (フレーム数, 18, 3) (load_smoothed_2d と同じ x, y, 信頼度)
+# depths, confs: (フレーム数, 列数) (ファイルがない場合None)
+InputChunk = collections.namedtuple("InputChunk", ["start", "positions", "smoothed", "depths", "confs"])
+
+# ファイルを指定行数ずつ読み込むジェネレータ
+def iter_file_lines(src_file, chunk_size):
+    with open(src_file, "r") as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            yield lines
+
+# pos.txt, smoothed.txt, depth.txt, conf.txt を chunk_size フレームずつ揃えて返すジェネレータ
+# ファイル全体をメモリに載せないため、長時間の動画でもメモリ使用量は塊の大きさで決まる
+def iter_input_chunks(position_file, smoothed_file, depth_file=None, conf_file=None, chunk_size=1000, dtype=np.float64):
+    if chunk_size <= 0:
+        raise ValueError("chunk_size should be >0")
+
+    # 深度は深度ファイルと信頼度ファイルの両方がある場合のみ
+    is_depth = depth_file is not None and conf_file is not None and os.path.exists(depth_file) and os.path.exists(conf_file)
+
+    readers = [iter_file_lines(position_file, chunk_size), iter_file_lines(smoothed_file, chunk_size)]
+    if is_depth:
+        readers.extend([iter_file_lines(depth_file, chunk_size), iter_file_lines(conf_file, chunk_size)])
+
+    start = 0
+    for blocks in itertools.zip_longest(*readers):
+        if any(lines is None for lines in blocks):
+            # どれかのファイルが先に終わった場合、揃わない分は捨てる
+            logger.warning("入力ファイルのフレーム数が揃っていません。%sフレーム目以降は読み込みません", start)
+            break
+
+        # 最後の塊は行数が揃わないことがあるので、短い方に合わせる
+        n = min(len(lines) for lines in blocks)
+        if any(len(lines) != n for lines in blocks):
+            logger.warning("入力ファイルのフレーム数が揃っていません。%sフレーム目以降は読み込みません", start + n)
+
+        positions = parse_positions("".join(blocks[0][:n]), dtype)
+        smoothed = smoothed_table_to_2d(parse_smoothed_table(blocks[1][:n]))
+        depths = parse_depth_table("".join(blocks[2][:n])) if is_depth else None
+        confs = parse_depth_table("".join(blocks[3][:n])) if is_depth else None
+
+        yield InputChunk(start, positions, smoothed, depths, confs)
+
+        start += n
+
+        if n < chunk_size:
+            break
+
 # ファイルのエンコードを取得する
 def get_file_encoding(file_path):
 
@@ -283,16 +379,7 @@ def get_file_encoding(file_path):
     
 # 上半身2があるか    
 def is_upper2_body_bone(bone_csv_file):
-
-    # ボーンファイルを開く
-    with open(bone_csv_file, "r", encoding=get_file_encoding(bone_csv_file)) as bf:
-        reader = csv.reader(bf)
-
-        for row in reader:
-            if row[1] == "上半身2" or row[2].lower() == "upper body2":
-                return True
-    
-    return False
+    return pos2vmd_bone.load_bone_model(bone_csv_file).has_upper2
 
 
 # 直立姿勢から傾いたところの頂点を求める
@@ -342,6 +429,21 @@ def calc_triangle_area(a, b, c):
     
 
 
+# 前後の計nフレームで移動平均をとる(データ数は変わらない)
+def calc_move_average(data, n):
+    if len(data) > n:
+        move_avg = np.convolve(data, np.ones(n)/n, 'valid')
+        # 移動平均でデータ数が減るため、前と後ろに同じ値を繰り返しで補填する
+        fore_n = int((n - 1)/2)
+        back_n = n - 1 - fore_n
+        result = np.hstack((np.tile([move_avg[0]], fore_n), move_avg, np.tile([move_avg[-1]], back_n)))
+    else:
+        avg = np.mean(data)
+        result = np.tile([avg], len(data))
+
+    return result
+
+
 def make_showik_frames(is_ik):
     onoff = 1 if is_ik == True else 0
 
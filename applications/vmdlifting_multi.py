@@ -8,7 +8,7 @@
 from __future__ import print_function
 
 def usage(prog):
-    print('usage: ' + prog + ' IMAGE_FILE VMD_FILE [POSITION_FILE]')
+    print('usage: ' + prog + ' VIDEO_FILE BONE_CSV_FILE [POSITION_FILE]')
     sys.exit()
 
 import __init__
@@ -17,11 +17,11 @@ from lifting import PoseEstimator
 from lifting.utils import draw_limbs
 from lifting.utils import plot_pose
 
+import os
+import sys
 import cv2
 import matplotlib.pyplot as plt
 from os.path import dirname, realpath
-from pos2vmd_multi import pos2vmd_multi
-from head_face import head_face_estimation
 
 DIR_PATH = dirname(realpath(__file__))
 PROJECT_PATH = realpath(DIR_PATH + '/..')
@@ -29,14 +29,21 @@ SAVED_SESSIONS_DIR = PROJECT_PATH + '/data/saved_sessions'
 SESSION_PATH = SAVED_SESSIONS_DIR + '/init_session/init'
 PROB_MODEL_PATH = SAVED_SESSIONS_DIR + '/prob_model/prob_model_params.mat'
 
-def vmdlifting_multi(video_file, vmd_file, position_file):
+# applications パッケージとして変換処理を読み込む
+sys.path.append(PROJECT_PATH)
+from applications import pos2vmd_multi
+from applications import pos2vmd_people
+
+def vmdlifting_multi(video_file, bone_csv_file, position_file, workers=0):
     video_file_path = realpath(video_file)
+    base_dir = dirname(video_file_path)
     
     cap = cv2.VideoCapture(video_file_path)
     
-    pose_3d_list = []
-    head_rotation_list = []
-    expression_frames_list = []
+    # フレームごとの全員分の関節位置・関節二次元情報
+    positions_list = []
+    smoothed_2d_list = []
+    pose_estimator = None
     idx = 0
     while(cap.isOpened()):
         # Capture frame-by-frame
@@ -51,44 +58,50 @@ def vmdlifting_multi(video_file, vmd_file, position_file):
         image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)  # conversion to rgb
 
         # 念のため、フレーム画像出力
-        image_file_path = "{0}/frame_{1:012d}.png".format(dirname(video_file_path), idx)
+        image_file_path = "{0}/frame_{1:012d}.png".format(base_dir, idx)
         cv2.imwrite(image_file_path,image)
         
-        # create pose estimator
-        image_size = image.shape
+        if pose_estimator is None:
+            # create pose estimator (動画のフレームサイズは同じなので、最初のフレームで1回だけ作る)
+            image_size = image.shape
 
-        pose_estimator = PoseEstimator(image_size, SESSION_PATH, PROB_MODEL_PATH)
+            pose_estimator = PoseEstimator(image_size, SESSION_PATH, PROB_MODEL_PATH)
 
-        # load model
-        pose_estimator.initialise()
+            # load model
+            pose_estimator.initialise()
 
         # estimation
         pose_2d, visibility, pose_3d = pose_estimator.estimate(image)
 
+        positions_list.append(pos2vmd_people.convert_pose_3d(pose_3d))
+        smoothed_2d_list.append(pos2vmd_people.convert_pose_2d(pose_2d, visibility))
+
+        idx += 1
+
+    # When everything done, release the capture
+    cap.release()
+
+    if pose_estimator is not None:
         # close model
         pose_estimator.close()
 
-        if (position_file is not None):
-            # dump 3d joint position data to position_file
-            fout = open(position_file, "w")
-            for pose in pose_3d:
-                for j in range(pose.shape[1]):
-                    print(j, pose[0, j], pose[1, j], pose[2, j], file=fout)
-            fout.close()
-
-        # head position & face expression
-        head_rotation, expression_frames = head_face_estimation(image_file_path)
-        head_rotation_list.append(head_rotation)
-        expression_frames_list.append(expression_frames)
+    # フレーム間で人物を対応付け、1人分ずつに分ける
+    people = pos2vmd_people.split_people(positions_list, smoothed_2d_list)
 
-        pose_3d_list.append(pose_3d)
+    if (position_file is not None):
+        # dump 3d joint position data to position_file (人物ごと)
+        position_filename, position_fileext = os.path.splitext(position_file)
+        for person in people:
+            pos2vmd_people.write_positions("{0}_{1}{2}".format(position_filename, person.person_id, position_fileext), person.positions)
 
-        idx += 1
+    # 1人1つのVMDを並列に出力する
+    vmd_files, error_ids = pos2vmd_multi.people_to_vmd_multi(people, base_dir, bone_csv_file, 0, 0, 1, 1, 0, 0, True, 0, workers)
 
-    # When everything done, release the capture
-    cap.release()
+    for vmd_file in vmd_files:
+        print("output: {0}".format(vmd_file))
 
-    pos2vmd_multi(pose_3d_list, vmd_file, head_rotation_list, expression_frames_list)
+    for person_id in error_ids:
+        print("failed: person {0}".format(person_id))
 
     # Show 2D and 3D poses
     # display_results(image, pose_2d, visibility, pose_3d)
@@ -114,9 +127,9 @@ if __name__ == '__main__':
         usage(sys.argv[0])
         
     video_file = sys.argv[1]
-    vmd_file = sys.argv[2]
+    bone_csv_file = sys.argv[2]
     dump_file = None
     if (len(sys.argv) >3 ):
         dump_file = sys.argv[3]
 
-    vmdlifting_multi(video_file, vmd_file, dump_file)
+    vmdlifting_multi(video_file, bone_csv_file, dump_file)